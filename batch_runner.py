@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Non-interactive factor file runner: dispatches the dates of a range over
+a process pool, the workers attaching to the raw matrices the parent
+publishes in shared memory (see data_server.py).
+
+    python batch_runner.py M --start 2010-01-01 --end 2019-06-30 --workers 8
+    python batch_runner.py w                    #最近一个周四
+    python batch_runner.py M --panel            #每个worker用面板模式算一段日期
+    python batch_runner.py w --workers 1 --group-workers 6   #单日内各因子组并行
+    python batch_runner.py M --shard-size 500   #按500只股票分片计算, 限制内存峰值
+"""
+import os
+import time
+import calendar
+import argparse
+import traceback
+from datetime import datetime, timedelta
+from datetime import time as dtime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+try:
+    from WindPy import w
+except ImportError:
+    #未安装WindPy时只用本地tradedays
+    w = None
+from factor_calculate import Data, FactorProcess, FileAlreadyExistError, WORK_PATH, factor_dates
+from data_server import DataServer, registry_path
+from panel_engine import PanelFactorProcess
+
+#由父进程发布到共享内存的原始矩阵
+SHARED_NAMES = Data.pinned + ('amt', 'mkt_cap_float_d', 'adjfactor')
+
+#worker进程内的FactorProcess
+_worker = None
+
+def default_dates(updatefreq, data):
+    """Dates of the former interactive run: last two months ('M') or last Thursday ('w')."""
+    if updatefreq == 'M':
+        return list(data.month_map.keys())[-2:]
+    lastThursday = datetime.now()
+    while lastThursday.weekday() != calendar.THURSDAY:
+        lastThursday -= timedelta(days=1)
+    return [datetime.combine(lastThursday, dtime.min)]
+
+def factor_path(savepath, date):
+    return os.path.join(savepath, f"{str(date)[:10]}.csv")
+
+def _init_worker(updatefreq, storage, shared, panel, group_workers=1, factors=None, shard_size=None):
+    global _worker
+    #tradedays已由父进程同步, worker不再访问wind
+    FactorProcess.tradedays_synced = True
+    FactorProcess.group_workers = group_workers
+    FactorProcess.target_factors = factors
+    FactorProcess.shard_size = shard_size
+    cls = PanelFactorProcess if panel else FactorProcess
+    _worker = cls(updatefreq, storage=storage, shared=shared)
+
+def _run_dates(dates, savepath):
+    #返回[(date, 状态, 耗时, 各因子组耗时, 失败时的traceback)]
+    if isinstance(_worker, PanelFactorProcess):
+        _worker.prepare(dates)
+    res = []
+    for date in dates:
+        t0 = time.time()
+        _worker.group_timings = {}
+        error = None
+        try:
+            _worker.create_factor_file(date, factor_path(savepath, date))
+        except FileAlreadyExistError:
+            status = 'exists'
+        except Exception as e:
+            status = f'failed: {e!r}'
+            error = traceback.format_exc()
+        else:
+            status = 'done'
+        res.append((date, status, time.time() - t0, dict(_worker.group_timings), error))
+    return res
+
+def _chunks(dates, n):
+    #面板模式按连续日期分段, 每段只准备一次
+    size = max(-(-len(dates) // n), 1)
+    return [dates[i:i+size] for i in range(0, len(dates), size)]
+
+def run(updatefreq, dates=None, startday=None, endday=None, workers=None, savepath=None,
+        storage=None, panel=False, share=True, group_workers=1, factors=None, shard_size=None):
+    """
+        Create the factor files of dates (or of the range startday..endday,
+        or the default dates) with workers processes; dates whose file
+        already exists are skipped. group_workers runs the factor groups
+        of each date concurrently; factors limits the columns computed;
+        shard_size computes the stocks in shards of that many.
+        Returns {date: (status, seconds)}.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if savepath is None:
+        savepath = os.path.join(WORK_PATH, "factors")
+    if updatefreq not in ('M','w'):
+        raise TypeError(f'Unsupported update frequency {updatefreq}.')
+    #父进程只打开Data, 不构造FactorProcess
+    data = Data(storage, mmap=True)
+    FactorProcess.sync_tradedays(data)
+    if dates is None:
+        dates = default_dates(updatefreq, data) if startday is None else \
+                factor_dates(updatefreq, data.month_map, startday, endday or datetime.now())
+    todo = [d for d in dates if not os.path.exists(factor_path(savepath, d))]
+    for date in dates:
+        if date not in todo:
+            print(f"{str(date)[:10]}'s data already exists.")
+    if not todo:
+        return {}
+    os.makedirs(savepath, exist_ok=True)
+
+    tasks = _chunks(todo, workers) if panel else [[d] for d in todo]
+    server = None
+    if share and workers > 1:
+        #换手率面板只在父进程预处理一次, 各worker直接挂载
+        server = DataServer(data, SHARED_NAMES, FactorProcess.shared_turnover(data)).start()
+        server.arrays.clear()   #已复制进共享内存, 父进程不再持有
+    shared = registry_path(data.root) if server is not None else None
+    res = {}
+    t0 = time.time()
+    try:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), initializer=_init_worker,
+                                 initargs=(updatefreq, storage, shared, panel, group_workers, factors, 
+                                           shard_size)) as pool:
+            futures = [pool.submit(_run_dates, task, savepath) for task in tasks]
+            for future in as_completed(futures):
+                for date, status, seconds, timings, error in future.result():
+                    res[date] = (status, seconds)
+                    groups = ', '.join(f'{k} {v:.1f}s' for k, v in timings.items())
+                    print(f"{str(date)[:10]}: {status} in {seconds:.1f}s" + (f" ({groups})." if groups else "."))
+                    if error is not None:
+                        print(error)
+    finally:
+        if server is not None:
+            server.close()
+    failed = sum(status.startswith('failed') for status, _ in res.values())
+    print(f"{len(res)} dates in {time.time()-t0:.1f}s with {workers} workers, {failed} failed.")
+    return res
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Create factor files over a process pool.')
+    parser.add_argument('freq', choices=['w', 'M'])
+    parser.add_argument('--start', default=None, help='first date, default: latest dates only')
+    parser.add_argument('--end', default=None, help='last date, default: today')
+    parser.add_argument('--workers', type=int, default=None, help='default: cpu count')
+    parser.add_argument('--savepath', default=None)
+    parser.add_argument('--storage', default=None)
+    parser.add_argument('--panel', action='store_true', help='panel mode per chunk of dates')
+    parser.add_argument('--group-workers', type=int, default=1,
+                        help='threads running the factor groups of one date')
+    parser.add_argument('--factors', default=None, 
+                        help='comma separated factor columns, default: all registered')
+    parser.add_argument('--shard-size', type=int, default=None,
+                        help='stocks per shard, default: whole universe at once')
+    parser.add_argument('--no-share', dest='share', action='store_false',
+                        help='workers read the store themselves')
+    args = parser.parse_args(argv)
+    if w is not None:
+        w.start()
+    try:
+        run(args.freq, startday=args.start, endday=args.end, workers=args.workers,
+            savepath=args.savepath, storage=args.storage, panel=args.panel, share=args.share,
+            group_workers=args.group_workers, 
+            factors=args.factors.split(',') if args.factors else None, shard_size=args.shard_size)
+    finally:
+        if w is not None:
+            w.close()
+
+if __name__ == '__main__':
+    main()
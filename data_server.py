@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Local data server: loads raw matrices once into shared memory so that
+several FactorProcess workers on the same machine can attach to them
+read-only instead of each parsing and holding its own copy.
+
+    python data_server.py pct_chg hfq_close turn ...
+
+Workers pick the matrices up through Data(shared=True) (or the path of
+the registry file); names not published fall back to the normal store.
+"""
+import os
+import time
+import pickle
+import argparse
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker, parent_process
+from data_store import MmapMatrix, EncodedMatrix
+
+SHM_REGISTRY = 'shm_registry.pkl'
+
+#worker进程持有的共享内存句柄, 防止被回收
+_attached = {}
+#本进程创建(由本进程tracker负责unlink)的共享内存
+_created = set()
+
+def registry_path(root):
+    return os.path.join(root, SHM_REGISTRY)
+
+def _share(values):
+    values = np.asarray(values)
+    shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+    _created.add(shm.name)
+    arr = np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf, order='F')
+    arr[...] = values
+    return shm
+
+def attach_shared(fpath):
+    """
+        Map every matrix published in the registry file into this process
+        as a read-only MmapMatrix (an EncodedMatrix over the shared codes
+        for dictionary-encoded matrices). Returns {name: (matrix, version)}.
+    """
+    if not os.path.exists(fpath):
+        return {}
+    with open(fpath, 'rb') as f:
+        registry = pickle.load(f)
+    res = {}
+    for name, info in registry.items():
+        shm = _attached.get(info['shm'])
+        if shm is None:
+            try:
+                shm = shared_memory.SharedMemory(name=info['shm'])
+            except FileNotFoundError:
+                print(f'Shared block of {name} is gone, falling back to disk.')
+                continue
+            #attach不应由本进程的resource_tracker负责unlink;
+            #multiprocessing子进程与父进程共用tracker, 由父进程负责; 本进程创建的块仍由其负责
+            if parent_process() is None and info['shm'] not in _created:
+                resource_tracker.unregister(shm._name, 'shared_memory')
+            _attached[info['shm']] = shm
+        values = np.ndarray(info['shape'], dtype=np.dtype(info['dtype']),
+                            buffer=shm.buf, order='F')
+        values.flags.writeable = False
+        dat = MmapMatrix(values, info['index'], info['columns'])
+        if info.get('categories') is not None:
+            dat = EncodedMatrix(dat, info['categories'])
+        res[name] = (dat, info['version'])
+    return res
+
+class DataServer:
+    """
+        Owner of the shared blocks. Loads each requested matrix through a
+        Data instance, copies it into shared memory and publishes the
+        registry file; close() unlinks everything and removes the registry.
+        arrays publishes precomputed arrays as well, given as 
+        {name: (values, index, columns, version)}.
+    """
+    def __init__(self, data, names, arrays=None):
+        self.data = data
+        self.names = list(names)
+        self.arrays = dict(arrays or {})
+        self.fpath = registry_path(data.root)
+        self.blocks = {}
+        self.registry = {}
+
+    def start(self):
+        for name in self.names:
+            dat = self.data.open_file(name)
+            #编码矩阵只共享整数编码, 字符串表随注册表发布
+            categories = list(dat.categories) if isinstance(dat, EncodedMatrix) else None
+            if categories is not None:
+                dat = dat.codes
+            entry = self.data.catalog.get(name) or {}
+            self._publish(name, dat.values, dat.index, dat.columns, entry.get('version'), categories)
+        for name, (values, index, columns, version) in self.arrays.items():
+            self._publish(name, values, index, columns, version)
+        tmpfile = self.fpath + '.tmp'
+        with open(tmpfile, 'wb') as f:
+            pickle.dump(self.registry, f)
+        os.replace(tmpfile, self.fpath)
+        return self
+
+    def _publish(self, name, values, index, columns, version, categories=None):
+        values = np.asarray(values)
+        if values.dtype == object:
+            print(f'{name} has object dtype, not shared.')
+            return
+        shm = _share(values)
+        self.blocks[name] = shm
+        self.registry[name] = {'shm': shm.name, 'shape': values.shape,
+                               'dtype': values.dtype.str, 'index': index,
+                               'columns': columns, 'version': version,
+                               'categories': categories}
+        print(f'{name} shared, {values.nbytes/2**20:.1f}MB.')
+
+    def close(self):
+        if os.path.exists(self.fpath):
+            os.remove(self.fpath)
+        for shm in self.blocks.values():
+            shm.close()
+            shm.unlink()
+            _created.discard(shm.name)
+        self.blocks.clear()
+        self.registry.clear()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def serve_forever(self):
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+if __name__ == '__main__':
+    from factor_calculate import Data
+    parser = argparse.ArgumentParser(description='Serve raw matrices from shared memory.')
+    parser.add_argument('names', nargs='*', default=['pct_chg', 'hfq_close', 'turn'])
+    parser.add_argument('--storage', default=None)
+    args = parser.parse_args()
+    DataServer(Data(args.storage), args.names).start().serve_forever()
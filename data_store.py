@@ -0,0 +1,910 @@
+# -*- coding: utf-8 -*-
+"""
+Storage backends for the raw stocks×dates matrices kept under
+daily_data/monthly_data/quarterly_data.
+
+CsvStore is the original GBK csv layout. NpyStore keeps every matrix as a
+directory holding the raw value array plus row(wind code)/column(date) index
+sidecars, so loading is a plain np.load with typed datetime columns.
+PartitionedStore splits the same arrays into one block per calendar month
+so trailing-window reads only touch the months they need.
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import threading
+from datetime import datetime
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+RAW_DIRS = ('daily_data', 'monthly_data', 'quarterly_data')
+CATALOG_FILE = 'catalog.json'
+DATETIME_FILES = ('stm_issuingdate', 'applied_rpt_date_M')
+#0/1标志矩阵, 默认声明为int8(含nan时退为float32)
+FLAG_FILES = ('trade_status', 'maxupordown', 'listday_matrix')
+DEFAULT_DTYPES = {name: 'int8' for name in FLAG_FILES}
+#字典编码存储的字符串矩阵: 整数编码矩阵 + 共享字符串表
+ENCODED_FILES = (
+        'sec_name1', 'sec_name1_d', 'industry_citic', 'industry_citic_d',
+        'industry_citic_level2', 'industry_citic_level2_d',
+        )
+
+class StoreError(Exception):
+    pass
+
+def _unsupported(matrix, name):
+    #不隐式物化整个历史矩阵
+    if name.startswith('__'):
+        return AttributeError(name)
+    return AttributeError(f"'{type(matrix).__name__}' object has no attribute '{name}', "
+                          "call to_frame() to materialise it as a DataFrame.")
+
+class _MmapLocIndexer:
+    def __init__(self, matrix):
+        self.matrix = matrix
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows, cols = key
+        else:
+            rows, cols = key, slice(None)
+        return self.matrix._take(rows, cols)
+
+class MmapMatrix:
+    """
+        Read-only stocks×dates matrix backed by memory-mapped values.npy
+        blocks. Values are stored column-major, so one date's cross-section
+        is a contiguous view of the file and only the columns actually read
+        get paged in. Delta blocks written by NpyStore.append are overlaid
+        on the base block, later blocks winning on shared dates. Only
+        .loc/[]/.values/.index/.columns/.shape are supported, anything else
+        raises: call to_frame() explicitly to materialise the whole history.
+    """
+    def __init__(self, values, index, columns, deltas=()):
+        self.blocks = [(values, pd.Index(index), pd.Index(columns))]
+        self.blocks.extend((v, pd.Index(i), pd.Index(c)) for v, i, c in deltas)
+        self.index, self.columns = self.blocks[0][1], self.blocks[0][2]
+        if len(self.blocks) > 1:
+            for _, index, columns in self.blocks[1:]:
+                self.index = self.index.append(index.difference(self.index))
+                self.columns = self.columns.union(columns)
+            self._owner = np.zeros(len(self.columns), dtype=int)
+            self._cloc = np.zeros(len(self.columns), dtype=int)
+            for b, (_, _, columns) in enumerate(self.blocks):
+                pos = self.columns.get_indexer(columns)
+                self._owner[pos] = b
+                self._cloc[pos] = np.arange(len(columns))
+            self._rowmaps = [index.get_indexer(self.index) for _, index, _ in self.blocks]
+        self.loc = _MmapLocIndexer(self)
+
+    @property
+    def values(self):
+        if len(self.blocks) == 1:
+            return self.blocks[0][0]
+        return self._values_at(None, None)
+
+    @property
+    def shape(self):
+        return len(self.index), len(self.columns)
+
+    @property
+    def dtype(self):
+        return np.result_type(*(values.dtype for values, _, _ in self.blocks))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.columns
+
+    def __getitem__(self, key):
+        return self._take(slice(None), key)
+
+    def __getattr__(self, name):
+        raise _unsupported(self, name)
+
+    def to_frame(self):
+        return pd.DataFrame(np.asarray(self.values), index=self.index, columns=self.columns)
+
+    def column(self, date):
+        return self._values_at(None, self.columns.get_loc(date))
+
+    @staticmethod
+    def _is_mask(key):
+        if pd.api.types.is_bool_dtype(getattr(key, 'dtype', None)):
+            return True
+        return isinstance(key, list) and bool(key) and all(isinstance(k, (bool, np.bool_)) for k in key)
+
+    @staticmethod
+    def _positions(labels, key):
+        if isinstance(key, slice):
+            if key == slice(None):
+                return None, True
+            return np.arange(len(labels))[labels.slice_indexer(key.start, key.stop, key.step)], True
+        if MmapMatrix._is_mask(key):
+            #布尔掩码按位置选取, 与DataFrame.loc一致
+            if isinstance(key, pd.Series):
+                key = key.reindex(labels, fill_value=False)
+            mask = np.asarray(key, dtype=bool)
+            if len(mask) != len(labels):
+                raise IndexError(f'Boolean index has wrong length: {len(mask)} instead of {len(labels)}.')
+            return np.flatnonzero(mask), True
+        if pd.api.types.is_list_like(key):
+            return labels.get_indexer(key), True
+        loc = labels.get_loc(key)
+        if isinstance(loc, slice):
+            return np.arange(len(labels))[loc], True
+        if isinstance(loc, np.ndarray):
+            return np.flatnonzero(loc), True
+        return loc, False
+
+    def _take(self, rows, cols):
+        rpos, rlist = self._positions(self.index, rows)
+        cpos, clist = self._positions(self.columns, cols)
+        if clist and cpos is not None and (cpos < 0).any():
+            raise KeyError(f'{list(np.asarray(cols)[cpos < 0])} not in columns.')
+        arr = self._values_at(rpos, cpos)
+        if not rlist:
+            if not clist:
+                return arr
+            columns = self.columns if cpos is None else self.columns[cpos]
+            return pd.Series(arr, index=columns, name=self.index[rpos])
+        if rpos is None:
+            index = self.index
+        elif pd.api.types.is_list_like(rows) and not self._is_mask(rows):
+            #保留请求的标签, 缺失的行与reindex一致为nan
+            index = pd.Index(rows)
+        else:
+            index = self.index[rpos]
+        if clist:
+            columns = self.columns if cpos is None else self.columns[cpos]
+            return pd.DataFrame(arr, index=index, columns=columns)
+        return pd.Series(arr, index=index, name=self.columns[cpos], copy=False)
+
+    @staticmethod
+    def _na_dtype(dtype):
+        if dtype.kind in 'iub':
+            return np.dtype(float), np.nan
+        if dtype.kind == 'M':
+            return dtype, np.datetime64('NaT')
+        return dtype, np.nan
+
+    def _values_at(self, rpos, cpos):
+        #rpos/cpos为None(全部)、位置数组或单个位置；标签缺失的行(-1)按reindex语义置为nan
+        if len(self.blocks) == 1:
+            values = self.blocks[0][0]
+            arr = values[:, slice(None) if cpos is None else cpos]
+            if rpos is None or np.ndim(rpos) == 0:
+                return arr if rpos is None else arr[rpos]
+            res = np.asarray(arr[rpos])
+            missing = rpos < 0
+            if missing.any():
+                dtype, na = self._na_dtype(res.dtype)
+                res = res.astype(dtype)
+                res[missing] = na
+            return res
+
+        ridx = np.arange(len(self.index)) if rpos is None else rpos
+        cidx = np.arange(len(self.columns)) if cpos is None else cpos
+        scalar_r, scalar_c = np.ndim(ridx) == 0, np.ndim(cidx) == 0
+        ridx, cidx = np.atleast_1d(ridx), np.atleast_1d(cidx)
+        dtype, na = self._na_dtype(self.dtype)
+        res = np.full((len(ridx), len(cidx)), na, dtype=dtype)
+        for b, (values, _, _) in enumerate(self.blocks):
+            csel = np.flatnonzero(self._owner[cidx] == b)
+            if not len(csel):
+                continue
+            brows = np.where(ridx >= 0, self._rowmaps[b][ridx], -1)
+            rsel = np.flatnonzero(brows >= 0)
+            res[np.ix_(rsel, csel)] = values[np.ix_(brows[rsel], self._cloc[cidx[csel]])]
+        if scalar_r:
+            res = res[0]
+        if scalar_c:
+            res = res[..., 0]
+        return res
+
+class StringTable:
+    """
+        Append-only string table of a dictionary-encoded matrix, kept as
+        <path>/<name>.categories.json next to the code matrix. Codes index
+        into the table, -1 stands for missing.
+    """
+    suffix = '.categories.json'
+
+    def __init__(self, path, name):
+        self.fpath = os.path.join(path, name+self.suffix)
+        self.categories = []
+        if os.path.exists(self.fpath):
+            with open(self.fpath, encoding='utf-8') as f:
+                self.categories = json.load(f)
+
+    @classmethod
+    def exists(cls, path, name):
+        return os.path.isfile(os.path.join(path, name+cls.suffix))
+
+    def save(self):
+        tmpfile = self.fpath + '.tmp'
+        with open(tmpfile, 'w', encoding='utf-8') as f:
+            json.dump(self.categories, f, ensure_ascii=False)
+        os.replace(tmpfile, self.fpath)
+
+    def remove(self):
+        if os.path.exists(self.fpath):
+            os.remove(self.fpath)
+
+    def encode(self, df):
+        """
+            int32 code matrix of df; strings not yet in the table are 
+            appended to it, existing codes never change.
+        """
+        values = np.asarray(df.values, dtype=object)
+        valid = ~pd.isnull(values)
+        codes = np.full(values.shape, -1, dtype='int32')
+        if valid.any():
+            uniques, inverse = np.unique(values[valid].astype(str), return_inverse=True)
+            lookup = {cat: code for code, cat in enumerate(self.categories)}
+            for cat in uniques:
+                if cat not in lookup:
+                    lookup[cat] = len(self.categories)
+                    self.categories.append(cat)
+            codes[valid] = np.array([lookup[cat] for cat in uniques], dtype='int32')[inverse.ravel()]
+        return pd.DataFrame(codes, index=df.index, columns=df.columns)
+
+class _EncodedLocIndexer(_MmapLocIndexer):
+    def __getitem__(self, key):
+        return self.matrix.decode(self.matrix.codes.loc[key])
+
+class EncodedMatrix:
+    """
+        Dictionary-encoded stocks×dates string matrix. .loc/[] return the
+        decoded strings like the object matrix did, contains/isin evaluate
+        the predicate once on the string table and broadcast it through the
+        codes as a boolean mask.
+    """
+    def __init__(self, codes, categories):
+        self.codes = codes
+        self.categories = pd.Index(categories, dtype=object)
+        #末位对应编码-1(缺失)
+        self._lookup = np.append(np.asarray(self.categories, dtype=object), np.nan)
+        self.loc = _EncodedLocIndexer(self)
+
+    @property
+    def index(self):
+        return self.codes.index
+
+    @property
+    def columns(self):
+        return self.codes.columns
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __contains__(self, key):
+        return key in self.columns
+
+    def __getitem__(self, key):
+        return self.decode(self.codes[key])
+
+    def __getattr__(self, name):
+        raise _unsupported(self, name)
+
+    @staticmethod
+    def _code_values(codes):
+        values = np.asarray(codes.values) if hasattr(codes, 'values') else np.asarray(codes)
+        if values.dtype.kind == 'f':
+            values = np.where(np.isnan(values), -1, values)
+        return values.astype('int64')
+
+    def _broadcast(self, table, codes):
+        values = np.append(table, False)[self._code_values(codes)]
+        if np.ndim(values) == 0:
+            return values
+        if isinstance(codes, pd.Series):
+            return pd.Series(values, index=codes.index, name=codes.name)
+        return pd.DataFrame(values, index=codes.index, columns=codes.columns)
+
+    def decode(self, codes):
+        values = self._lookup[self._code_values(codes)]
+        if np.ndim(values) == 0:
+            return values
+        if isinstance(codes, pd.Series):
+            return pd.Series(values, index=codes.index, name=codes.name)
+        return pd.DataFrame(values, index=codes.index, columns=codes.columns)
+
+    def to_frame(self):
+        return self.decode(self.codes.loc[:, :])
+
+    def code_of(self, value):
+        try:
+            return self.categories.get_loc(value)
+        except KeyError:
+            return -2
+
+    def contains(self, pat, rows=slice(None), cols=slice(None), **kwargs):
+        table = np.asarray(self.categories.str.contains(pat, **kwargs), dtype=bool)
+        return self._broadcast(table, self.codes.loc[rows, cols])
+
+    def isin(self, values, rows=slice(None), cols=slice(None)):
+        table = np.asarray(self.categories.isin(values), dtype=bool)
+        return self._broadcast(table, self.codes.loc[rows, cols])
+
+def slice_window(dat, stocks=None, start=None, end=None):
+    dat = dat.loc[:, start:end]
+    return dat if stocks is None else dat.reindex(stocks)
+
+def cast_frame(df, dtype):
+    """
+        Cast df to the declared storage dtype. Integer declarations are only
+        applied when lossless, otherwise (nan, fractions) float32 is used; 
+        frames that cannot be made numeric are returned untouched.
+    """
+    if dtype is None:
+        return df
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'iub':
+        try:
+            values = np.asarray(df.values, dtype=float)
+        except (TypeError, ValueError):
+            return df
+        info = np.iinfo(dtype) if dtype.kind in 'iu' else None
+        if (np.isfinite(values).all() and (values == np.round(values)).all()
+                and (info is None or (values.min(initial=0) >= info.min 
+                                      and values.max(initial=0) <= info.max))):
+            return pd.DataFrame(values.astype(dtype), index=df.index, columns=df.columns)
+        dtype = np.dtype('float32')
+    if dtype.kind == 'f':
+        try:
+            return pd.DataFrame(np.asarray(df.values, dtype=dtype), 
+                                index=df.index, columns=df.columns)
+        except (TypeError, ValueError):
+            return df
+    return df
+
+def merge_frames(ori, new):
+    """
+        Overlay the date columns of new onto ori, new values winning on
+        shared dates and new wind codes appended as extra rows.
+    """
+    if ori is None:
+        return new
+    ori = ori.drop(ori.columns.intersection(new.columns), axis=1)
+    res = pd.concat([ori, new], axis=1)
+    return res[res.columns.sort_values()]
+
+class CsvStore:
+    fmt = 'csv'
+    #read_window是否只读取窗口覆盖的部分
+    windowed = False
+
+    def exists(self, path, name):
+        return os.path.isfile(os.path.join(path, name+'.csv'))
+
+    def list_names(self, path):
+        return [f[:-4] for f in os.listdir(path) if f.endswith('.csv')]
+
+    def read(self, path, name, mmap=False):
+        dat = pd.read_csv(os.path.join(path, name+'.csv'),
+                          index_col=[0], engine='python', encoding='gbk')
+        dat.columns = pd.to_datetime(dat.columns)
+        if name in DATETIME_FILES:
+            dat = dat.replace('0', np.nan)
+            dat = dat.applymap(pd.to_datetime)
+        return dat
+
+    def columns(self, path, name):
+        header = pd.read_csv(os.path.join(path, name+'.csv'), index_col=[0], 
+                             nrows=0, engine='python', encoding='gbk')
+        return pd.to_datetime(header.columns)
+
+    def axes(self, path, name):
+        index = pd.read_csv(os.path.join(path, name+'.csv'), usecols=[0], 
+                            engine='python', encoding='gbk').iloc[:, 0]
+        return pd.Index(index), self.columns(path, name)
+
+    def read_window(self, path, name, stocks=None, start=None, end=None, mmap=False):
+        return slice_window(self.read(path, name), stocks, start, end)
+
+    def write(self, df, path, name, **kwargs):
+        df.to_csv(os.path.join(path, name+'.csv'), encoding='gbk', **kwargs)
+
+    def append(self, df, path, name):
+        ori = self.read(path, name) if self.exists(path, name) else None
+        self.write(merge_frames(ori, df), path, name)
+
+    def compact(self, path, name):
+        pass
+
+    def remove(self, path, name):
+        os.remove(os.path.join(path, name+'.csv'))
+
+class NpyStore:
+    """
+        Layout of one matrix:
+            <path>/<name>/values.npy    --stocks×dates values, column-major
+            <path>/<name>/index.npy     --wind codes
+            <path>/<name>/columns.npy   --datetime64[ns] dates
+            <path>/<name>/delta-00001/  --same three files, appended dates
+        
+        append only writes the new (or re-fetched) date columns as a delta
+        block; once compact_every deltas pile up they are merged back into
+        the base block.
+    """
+    fmt = 'npy'
+    windowed = False
+    compact_every = 20
+    values_file = 'values.npy'
+    index_file = 'index.npy'
+    columns_file = 'columns.npy'
+
+    def exists(self, path, name):
+        return os.path.isfile(os.path.join(path, name, self.values_file))
+
+    def list_names(self, path):
+        return [f for f in os.listdir(path) if self.exists(path, f)]
+
+    @staticmethod
+    def _to_columns(columns):
+        try:
+            return pd.DatetimeIndex(columns).values
+        except (TypeError, ValueError):
+            return np.asarray(columns, dtype=object)
+
+    def _load_block(self, dirpath, mmap_mode=None):
+        values = np.load(os.path.join(dirpath, self.values_file),
+                         mmap_mode=mmap_mode, allow_pickle=True)
+        index = np.load(os.path.join(dirpath, self.index_file), allow_pickle=True)
+        columns = np.load(os.path.join(dirpath, self.columns_file), allow_pickle=True)
+        return values, index, columns
+
+    def _save_block(self, dirpath, values, index, columns):
+        os.makedirs(dirpath, exist_ok=True)
+        np.save(os.path.join(dirpath, self.values_file), np.asfortranarray(values))
+        np.save(os.path.join(dirpath, self.index_file), np.asarray(index))
+        np.save(os.path.join(dirpath, self.columns_file), self._to_columns(columns))
+
+    @staticmethod
+    def _delta_dirs(dirpath):
+        return sorted(os.path.join(dirpath, f) for f in os.listdir(dirpath) 
+                      if f.startswith('delta-'))
+
+    def read(self, path, name, mmap=False):
+        dirpath = os.path.join(path, name)
+        if not self.exists(path, name):
+            raise StoreError(f'{dirpath} is not a valid {self.fmt} matrix.')
+        deltas = self._delta_dirs(dirpath)
+        if mmap:
+            try:
+                base = self._load_block(dirpath, mmap_mode='r')
+                deltas = [self._load_block(d, mmap_mode='r') for d in deltas]
+            except ValueError:
+                #object数组（如证券简称）无法映射，退回整体读取
+                deltas = self._delta_dirs(dirpath)
+            else:
+                return MmapMatrix(*base, deltas=deltas)
+        values, index, columns = self._load_block(dirpath)
+        if deltas:
+            deltas = [self._load_block(d) for d in deltas]
+            return MmapMatrix(values, index, columns, deltas=deltas).to_frame()
+        return pd.DataFrame(values, index=pd.Index(index), columns=pd.Index(columns))
+
+    def write(self, df, path, name, **kwargs):
+        dirpath = os.path.join(path, name)
+        tmppath, oldpath = dirpath + '.__tmp__', dirpath + '.__old__'
+        for p in (tmppath, oldpath):
+            if os.path.exists(p):
+                shutil.rmtree(p)
+        index = np.asarray(df.index.astype(str))
+        self._save_block(tmppath, df.values, index, df.columns)
+        if os.path.exists(dirpath):
+            os.rename(dirpath, oldpath)
+        os.rename(tmppath, dirpath)
+        if os.path.exists(oldpath):
+            shutil.rmtree(oldpath)
+
+    def columns(self, path, name):
+        columns = pd.Index([])
+        for d in self._block_dirs(os.path.join(path, name)):
+            columns = columns.union(np.load(os.path.join(d, self.columns_file), allow_pickle=True))
+        return columns
+
+    def _block_dirs(self, dirpath):
+        return [dirpath] + self._delta_dirs(dirpath)
+
+    def axes(self, path, name):
+        index, columns = pd.Index([]), pd.Index([])
+        for d in self._block_dirs(os.path.join(path, name)):
+            block_index = pd.Index(np.load(os.path.join(d, self.index_file), allow_pickle=True))
+            index = index.append(block_index.difference(index))
+            columns = columns.union(np.load(os.path.join(d, self.columns_file), allow_pickle=True))
+        return index, columns
+
+    def read_window(self, path, name, stocks=None, start=None, end=None, mmap=True):
+        return slice_window(self.read(path, name, mmap=True), stocks, start, end)
+
+    def append(self, df, path, name):
+        if not self.exists(path, name):
+            return self.write(df, path, name)
+        dirpath = os.path.join(path, name)
+        deltas = self._delta_dirs(dirpath)
+        seq = int(os.path.basename(deltas[-1]).split('-')[1]) + 1 if deltas else 1
+        deltapath = os.path.join(dirpath, f'delta-{seq:05d}')
+        tmppath = os.path.join(dirpath, f'tmp-{seq:05d}')
+        if os.path.exists(tmppath):
+            shutil.rmtree(tmppath)
+        self._save_block(tmppath, df.values, np.asarray(df.index.astype(str)), df.columns)
+        os.rename(tmppath, deltapath)
+        if len(deltas) + 1 >= self.compact_every:
+            self.compact(path, name)
+
+    def compact(self, path, name):
+        if self._delta_dirs(os.path.join(path, name)):
+            self.write(self.read(path, name), path, name)
+
+    def remove(self, path, name):
+        shutil.rmtree(os.path.join(path, name))
+
+class PartitionedStore(NpyStore):
+    """
+        Layout of one matrix, one block per calendar month:
+            <path>/<name>/p-200601/values.npy, index.npy, columns.npy
+            <path>/<name>/p-200602/...
+        
+        read_window only loads the partitions covering [start, end], and 
+        append only rewrites the months it touches.
+    """
+    fmt = 'partitioned'
+    windowed = True
+    prefix = 'p-'
+
+    def _partitions(self, dirpath):
+        if not os.path.isdir(dirpath):
+            return []
+        return sorted(f for f in os.listdir(dirpath) 
+                      if f.startswith(self.prefix) and '.' not in f)
+
+    def exists(self, path, name):
+        return bool(self._partitions(os.path.join(path, name)))
+
+    def list_names(self, path):
+        return [f for f in os.listdir(path) if self.exists(path, f)]
+
+    @staticmethod
+    def _month_key(date):
+        date = pd.Timestamp(date)
+        return date.year * 100 + date.month
+
+    def _split(self, df):
+        columns = pd.DatetimeIndex(df.columns)
+        keys = columns.year * 100 + columns.month
+        for key in np.unique(keys):
+            yield f'{self.prefix}{key}', df.loc[:, np.asarray(keys == key)]
+
+    def _read_parts(self, parts, mmap=False):
+        try:
+            blocks = [self._load_block(p, mmap_mode='r' if mmap else None) for p in parts]
+        except ValueError:
+            blocks, mmap = [self._load_block(p) for p in parts], False
+        matrix = MmapMatrix(*blocks[0], deltas=blocks[1:])
+        return matrix if mmap else matrix.to_frame()
+
+    def read(self, path, name, mmap=False):
+        dirpath = os.path.join(path, name)
+        parts = self._partitions(dirpath)
+        if not parts:
+            raise StoreError(f'{dirpath} is not a valid {self.fmt} matrix.')
+        return self._read_parts([os.path.join(dirpath, p) for p in parts], mmap)
+
+    def read_window(self, path, name, stocks=None, start=None, end=None, mmap=True):
+        dirpath = os.path.join(path, name)
+        lo = self._month_key(start) if start is not None else 0
+        hi = self._month_key(end) if end is not None else 999999
+        parts = [os.path.join(dirpath, p) for p in self._partitions(dirpath) 
+                 if lo <= int(p[len(self.prefix):]) <= hi]
+        if stocks is None:
+            #与整体读取一致, 返回所有分区的股票
+            stocks = self.axes(path, name)[0]
+        if not parts:
+            return pd.DataFrame(index=stocks)
+        return slice_window(self._read_parts(parts, mmap=True), stocks, start, end)
+
+    def _block_dirs(self, dirpath):
+        return [os.path.join(dirpath, p) for p in self._partitions(dirpath)]
+
+    def columns(self, path, name):
+        columns = [np.load(os.path.join(d, self.columns_file), allow_pickle=True) 
+                   for d in self._block_dirs(os.path.join(path, name))]
+        return pd.Index(np.concatenate(columns)) if columns else pd.Index([])
+
+    def _swap(self, tmppath, dirpath):
+        oldpath = dirpath + '.__old__'
+        if os.path.exists(oldpath):
+            shutil.rmtree(oldpath)
+        if os.path.exists(dirpath):
+            os.rename(dirpath, oldpath)
+        os.rename(tmppath, dirpath)
+        if os.path.exists(oldpath):
+            shutil.rmtree(oldpath)
+
+    def write(self, df, path, name, **kwargs):
+        dirpath = os.path.join(path, name)
+        tmppath = dirpath + '.__tmp__'
+        if os.path.exists(tmppath):
+            shutil.rmtree(tmppath)
+        index = np.asarray(df.index.astype(str))
+        os.makedirs(tmppath)
+        for part, sub in self._split(df):
+            self._save_block(os.path.join(tmppath, part), sub.values, index, sub.columns)
+        self._swap(tmppath, dirpath)
+
+    def append(self, df, path, name):
+        if not self.exists(path, name):
+            return self.write(df, path, name)
+        dirpath = os.path.join(path, name)
+        for part, sub in self._split(df):
+            partpath = os.path.join(dirpath, part)
+            if os.path.isdir(partpath):
+                sub = merge_frames(self._read_parts([partpath]), sub)
+            tmppath = partpath + '.__tmp__'
+            if os.path.exists(tmppath):
+                shutil.rmtree(tmppath)
+            self._save_block(tmppath, sub.values, np.asarray(sub.index.astype(str)), sub.columns)
+            self._swap(tmppath, partpath)
+
+    def compact(self, path, name):
+        pass
+
+class DataCache:
+    """
+        LRU cache of loaded matrices bounded by a memory budget in bytes 
+        (None for unbounded). Pinned names are never evicted. Memory-mapped
+        and shared-memory blocks are not counted, they are not owned by the
+        process.
+    """
+    def __init__(self, budget=None, pinned=()):
+        self.budget = budget
+        self.pinned = set(pinned)
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __contains__(self, name):
+        return name in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    @staticmethod
+    def sizeof(obj):
+        if isinstance(obj, EncodedMatrix):
+            return DataCache.sizeof(obj.codes) + sys.getsizeof(obj.categories)
+        if isinstance(obj, MmapMatrix):
+            return sum(values.nbytes for values, _, _ in obj.blocks 
+                       if values.flags.owndata)
+        if isinstance(obj, pd.DataFrame):
+            return int(obj.memory_usage(index=True).sum())
+        if isinstance(obj, pd.Series):
+            return int(obj.memory_usage(index=True))
+        if isinstance(obj, list):
+            return sys.getsizeof(obj) + sum(sys.getsizeof(x) for x in obj)
+        return sys.getsizeof(obj)
+
+    def get(self, name, default=None):
+        with self._lock:
+            try:
+                obj, _ = self._items[name]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items.move_to_end(name)
+            self.hits += 1
+            return obj
+
+    def put(self, name, obj):
+        with self._lock:
+            self.pop(name)
+            size = self.sizeof(obj)
+            self._items[name] = (obj, size)
+            self.nbytes += size
+            self._evict()
+
+    def pop(self, name):
+        with self._lock:
+            item = self._items.pop(name, None)
+            if item is None:
+                return None
+            self.nbytes -= item[1]
+            return item[0]
+
+    def pin(self, *names):
+        self.pinned.update(names)
+
+    def _evict(self):
+        if self.budget is None:
+            return
+        for name in list(self._items.keys()):
+            if self.nbytes <= self.budget:
+                break
+            if name in self.pinned:
+                continue
+            self.pop(name)
+            self.evictions += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'nbytes': self.nbytes, 'budget': self.budget, 'items': len(self._items)}
+
+class Catalog:
+    """
+        Persistent manifest of the raw matrices, one json file under root.
+        Each entry records the directory, frequency, storage format, shape,
+        date range, dtype and a version bumped on every write, so lookups 
+        never have to scan the data directories. 'declared' is the storage 
+        dtype a matrix is cast to before it is written; it may be declared
+        before the matrix exists, such entries (no 'path') are not located.
+    """
+    freqs = {'daily_data': 'd', 'monthly_data': 'M', 'quarterly_data': 'q'}
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.entries = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.fpath):
+            return {}
+        with open(self.fpath, encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save(self, entries):
+        tmpfile = self.fpath + '.tmp'
+        with open(tmpfile, 'w', encoding='utf-8') as f:
+            json.dump(entries, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(tmpfile, self.fpath)
+        self.entries = entries
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __len__(self):
+        return len(self.names())
+
+    def get(self, name):
+        #只有dtype声明、尚未写入的矩阵不算已登记
+        entry = self.entries.get(name, None)
+        return entry if entry is not None and 'path' in entry else None
+
+    def names(self, dirname=None):
+        return [name for name, entry in self.entries.items() 
+                if 'path' in entry and (dirname is None or entry['path'] == dirname)]
+
+    def declared(self, name):
+        entry = self.entries.get(name) or {}
+        return entry.get('declared', DEFAULT_DTYPES.get(name, None))
+
+    def declare(self, name, dtype):
+        entries = self._load()
+        entry = entries.setdefault(name, {})
+        if dtype is None:
+            entry.pop('declared', None)
+        else:
+            entry['declared'] = np.dtype(dtype).name
+        self._save(entries)
+
+    @staticmethod
+    def _dtype(df):
+        try:
+            return str(np.result_type(*set(df.dtypes)))
+        except TypeError:
+            return 'object'
+
+    @staticmethod
+    def describe(index, columns, dtype=None):
+        info = {'shape': [len(index), len(columns)]}
+        if len(columns):
+            info.update(start=str(min(columns))[:10], end=str(max(columns))[:10])
+        if dtype is not None:
+            info['dtype'] = str(dtype)
+        return info
+
+    def record(self, name, dirname, fmt, **info):
+        #先重新读入清单再写回，避免覆盖其它进程的更新
+        entries = self._load()
+        entry = entries.get(name, {})
+        entry.update(info)
+        entry.update(path=dirname, freq=self.freqs.get(dirname, None), format=fmt,
+                     version=entry.get('version', 0) + 1, 
+                     modified=datetime.now().isoformat(timespec='seconds'))
+        entries[name] = entry
+        self._save(entries)
+        return entry
+
+    def record_frame(self, name, dirname, fmt, df):
+        return self.record(name, dirname, fmt, 
+                           **self.describe(df.index, df.columns, self._dtype(df)))
+
+    def remove(self, name):
+        entries = self._load()
+        entries.pop(name, None)
+        self._save(entries)
+
+    def rebuild(self, root, stores):
+        """
+            Scan the raw data directories once. Earlier stores win when a 
+            matrix exists in several formats; csv matrices only get their 
+            location recorded, the rest is filled in on their next write.
+        """
+        entries, declared = {}, {name: entry['declared'] for name, entry in 
+                                 self._load().items() if 'declared' in entry}
+        for dirname in RAW_DIRS:
+            path = os.path.join(root, dirname)
+            if not os.path.isdir(path):
+                continue
+            for store in stores:
+                for name in store.list_names(path):
+                    if name in entries:
+                        continue
+                    entry = {'path': dirname, 'freq': self.freqs[dirname], 
+                             'format': store.fmt, 'version': 1}
+                    if store.fmt != 'csv':
+                        entry.update(self.describe(*store.axes(path, name)))
+                    if name in declared:
+                        entry['declared'] = declared[name]
+                    entries[name] = entry
+        self._save(entries)
+
+STORES = {
+        'csv': CsvStore,
+        'npy': NpyStore,
+        'partitioned': PartitionedStore,
+        }
+
+def get_store(fmt):
+    try:
+        return STORES[fmt]()
+    except KeyError:
+        raise StoreError(f'Unsupported storage format {fmt}, choose from {list(STORES)}.')
+
+def _holds_strings(df):
+    return any(not pd.api.types.is_numeric_dtype(dtype) for dtype in df.dtypes)
+
+def migrate(root, src='csv', dst='npy', dirnames=RAW_DIRS, remove_src=False):
+    """
+        One-shot conversion of the raw data trees under root from src
+        storage format to dst storage format.
+    """
+    src_store, dst_store = get_store(src), get_store(dst)
+    catalog = Catalog(os.path.join(root, CATALOG_FILE))
+    for dirname in dirnames:
+        path = os.path.join(root, dirname)
+        if not os.path.isdir(path):
+            print(f'{path} not found, skipped.')
+            continue
+        for name in sorted(src_store.list_names(path)):
+            dat = src_store.read(path, name)
+            #源数据为字符串时编码, 已有字符串表则沿用并扩充
+            if name in ENCODED_FILES and _holds_strings(dat):
+                table = StringTable(path, name)
+                dat = table.encode(dat)
+                table.save()
+            dat = cast_frame(dat, catalog.declared(name))
+            dst_store.write(dat, path, name)
+            catalog.record_frame(name, dirname, dst_store.fmt, dat)
+            if remove_src:
+                src_store.remove(path, name)
+            print(f'{dirname}/{name} migrated to {dst}, shape={dat.shape}.')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate raw data trees between storage formats.')
+    parser.add_argument('root', nargs='?', default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    parser.add_argument('--src', default='csv', choices=list(STORES))
+    parser.add_argument('--dst', default='npy', choices=list(STORES))
+    parser.add_argument('--remove-src', action='store_true')
+    args = parser.parse_args()
+    migrate(args.root, args.src, args.dst, remove_src=args.remove_src)
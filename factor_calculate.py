@@ -6,19 +6,45 @@ Created on Wed Jul  4 16:56:01 2018
 """
 import os
 import warnings
-import calendar
+import threading
+import multiprocessing
 import numpy as np
 import pandas as pd
 import statsmodels.api as sm
 import pandas.tseries.offsets as toffsets
-from datetime import datetime, time
-from functools import reduce
-from itertools import takewhile, dropwhile
-from collections import Iterable
-from WindPy import w
+from datetime import datetime, time, timedelta
+from time import perf_counter
+from functools import reduce, partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections.abc import Iterable
+try:
+    from WindPy import w
+except ImportError:
+    #未安装WindPy时只能使用本地数据, 同步tradedays会失败
+    w = None
+from data_store import (STORES, RAW_DIRS, CATALOG_FILE, ENCODED_FILES, Catalog, DataCache, 
+                        EncodedMatrix, StringTable, get_store, merge_frames, cast_frame)
+from data_server import attach_shared, registry_path
+from trading_calendar import TradingCalendar
+from tech_state import TechState, file_lock
+from kernels import (MaskedPanel, cmra, dastd, exp_day_weights, exp_weights, growth_rate, 
+                     last_per_period, rstr, shifted_wls, wls)
+from factor_registry import default_registry
 warnings.filterwarnings('ignore')
 
 WORK_PATH = os.path.dirname(os.path.dirname(__file__))
+#预处理后的换手率面板经共享内存发布时的各部分
+TURNOVER_PARTS = ('values', 'valid', 'missing')
+
+#fork出的因子组子进程从这里取FactorProcess, 避免pickle整个实例
+_group_owner = None
+
+def _run_group(func, args, owner=None, kwargs=None):
+    owner = _group_owner if owner is None else owner
+    func = getattr(owner, func) if isinstance(func, str) else partial(func, owner)
+    t0 = perf_counter()
+    res = func(*args, **(kwargs or {}))
+    return res, perf_counter() - t0
 
 class WindQueryFailError(Exception):
     pass
@@ -26,6 +52,13 @@ class WindQueryFailError(Exception):
 class FileAlreadyExistError(Exception):
     pass
 
+def factor_dates(updatefreq, month_map, startday, endday):
+    """Factor dates of a range: month_map trade days ('M') or Thursdays ('w')."""
+    startday, endday = pd.to_datetime((startday, endday))
+    if updatefreq == 'M':
+        return [d for d in month_map.keys() if startday <= d <= endday]
+    return list(pd.date_range(startday, endday, freq='W-THU'))
+
 class lazyproperty:
     def __init__(self, func):
         self.func = func
@@ -40,31 +73,40 @@ class lazyproperty:
     
 class Data:
     startday = "20060101"
-    endday = pd.tseries.offsets.datetime.now().strftime("%Y%m%d")
+    endday = datetime.now().strftime("%Y%m%d")
     freq = "M"
     
     root = WORK_PATH
+    storage = 'npy'
+    mmap = False
+    cache_budget = None
+    shared = False
+    #为True时价格/收益/估值类矩阵按float32存储
+    float32 = False
+    float32_files = (
+            'close', 'hfq_close', 'adjfactor', 'pct_chg', 'turn',
+            'pe_ttm_d', 'val_pe_deducted_ttm_d', 'pb_lf_d', 'ps_ttm_d', 
+            'pcf_ncf_ttm_d', 'pcf_ocf_ttm_d', 'dividendyield2_d',
+            )
+    pinned = ('pct_chg', 'hfq_close', 'turn')
     metafile = 'all_stocks.xlsx'
     mmapfile = 'month_map.xlsx'
     month_group_file = 'month_group.xlsx'
     tradedays_file = 'tradedays.xlsx'
     tdays_be_m_file = 'trade_days_begin_end_of_month.xlsx'
+    src_tables = ('meta', 'month_map', 'trade_days_begin_end_of_month', 
+                  'month_group', 'tradedays')
+    cache_dir = '.cache'
+    export_excel = True
     
     value_indicators = [
             'pe_ttm', 'val_pe_deducted_ttm', 'pb_lf', 'ps_ttm', 
             'pcf_ncf_ttm', 'pcf_ocf_ttm', 'dividendyield2', 'profit_ttm'
             ]
-    value_target_indicators = [
-            "EP", "EPcut", "BP", "SP", 
-            "NCFP", "OCFP", "DP", "G/PE"
-            ]
     
     growth_indicators = [
             "qfa_yoysales", "qfa_yoyprofit", "qfa_yoyocf", "qfa_roe_G_m"
             ]
-    growth_target_indicators = [
-            "Sales_G_q", "Profit_G_q", "OCF_G_q", "ROE_G_q"
-            ]
     
     finance_indicators = [ 
             "roe_ttm2_m", "qfa_roe_m",
@@ -74,64 +116,27 @@ class Data:
             "turnover_ttm_m", "qfa_netprofitmargin_m", 
             "ocfps_ttm", "eps_ttm", "qfa_net_profit_is_m", "qfa_net_cash_flows_oper_act_m"
             ]
-    finance_target_indicators = [
-            "ROE_q", "ROE_ttm", 
-            "ROA_q", "ROA_ttm", 
-            "grossprofitmargin_q", "grossprofitmargin_ttm", 
-            "profitmargin_q", "profitmargin_ttm",
-            "assetturnover_q", "assetturnover_ttm", 
-            "operationcashflowratio_q", "operationcashflowratio_ttm"
-            ]
     
     leverage_indicators = [
             "assetstoequity_m", "longdebttoequity_m", 
             "cashtocurrentdebt_m", "current_m"
             ]
-    leverage_target_indicators = [
-            "financial_leverage", "debtequityratio", 
-            "cashratio", "currentratio"
-            ]
     
     cal_indicators = ["mkt_cap_float", "holder_avgpct", "holder_num"]
-    cal_target_indicators = [
-            "ln_capital", 
-            "HAlpha", "return_1m", "return_3m", "return_6m", "return_12m", 
-            "wgt_return_1m", "wgt_return_3m", "wgt_return_6m", "wgt_return_12m",
-            "exp_wgt_return_1m",  "exp_wgt_return_3m",  "exp_wgt_return_6m", "exp_wgt_return_12m",
-            "std_1m", "std_3m", "std_6m", "std_12m",
-            "beta",
-            "turn_1m", "turn_3m", "turn_6m", "turn_12m",
-            "bias_turn_1m", "bias_turn_3m", "bias_turn_6m", "bias_turn_12m",
-            "holder_avgpctchange",
-            ]
         
     tech_indicators = [
             "MACD", "RSI", "PSY", "BIAS"
             ]
-    tech_target_indicators = [
-            "MACD", "DEA", "DIF", "RSI", "PSY", "BIAS"
-            ]
     
     barra_quote_indicators = [
             "mkt_cap_float", "pct_chg", "amt"
             ]
-    barra_quote_target_indicators = [
-            "LNCAP_barra", "MIDCAP_barra", 
-            "BETA_barra", "HSIGMA_barra", "HALPHA_barra", 
-            "DASTD_barra", "CMRA_barra",
-            "STOM_barra", "STOQ_barra", "STOA_barra",
-            "RSTR_barra"
-            ]
     
     barra_finance_indicators = [
             "mkt_cap_ard", "longdebttodebt", "other_equity_instruments_PRE", 
             "tot_equity", "tot_liab", "tot_assets", "pb_lf", 
             "pe_ttm", "pcf_ocf_ttm", "eps_ttm", "orps"
             ]
-    barra_finance_target_indicators = [
-            "MLEV_barra", "BLEV_barra", "DTOA_barra", "BTOP_barra", 
-            "ETOP_barra", "CETOP_barra", "EGRO_barra", "SGRO_barra"
-            ]
     
     _tech_params = {
                     "BIAS": [20],
@@ -139,7 +144,6 @@ class Data:
                     "PSY": [20],
                     "RSI": [20],
                     }
-    freqmap = {}
     ind_wsscond = { 
         #日频
         'close': 'tradeDate={date};priceAdj=U;cycle=D',         #不复权收盘价/技术
@@ -263,78 +267,284 @@ class Data:
         "eps_diluted2": "{date};{date};Days=Alldays",                  #eps-期末股本摊薄/barra_finance
         }
     
-    def __init__(self):
+    def __init__(self, storage=None, mmap=None, cache_budget=None, shared=None):
+        if storage is not None:
+            self.storage = storage
+        if mmap is not None:
+            self.mmap = mmap
+        if cache_budget is not None:
+            self.cache_budget = cache_budget
+        self.cache = DataCache(self.cache_budget, self.pinned + self.src_tables)
+        self._load_locks = {}
+        self.stores = {fmt: get_store(fmt) for fmt in STORES}
+        self.store = self.stores[self.storage]
         self.dpath = os.path.join(self.root, "daily_data")
         self.mpath = os.path.join(self.root, "monthly_data")
         self.qpath = os.path.join(self.root, "quarterly_data")
         self.save_path = os.path.join(self.root, "factor_data")
-        self.__update_frepmap()
-    
-    def __update_frepmap(self):
-        self.freqmap.update({name.split(".")[0]: self.dpath for name in os.listdir(self.dpath)})
-        self.freqmap.update({name.split(".")[0]: self.mpath for name in os.listdir(self.mpath)})
-        self.freqmap.update({name.split(".")[0]: self.qpath for name in os.listdir(self.qpath)})
+        self.catalog = Catalog(os.path.join(self.root, CATALOG_FILE))
+        if not len(self.catalog):
+            self.catalog.rebuild(self.root, self.__search_order())
+        if shared is not None:
+            self.shared = shared
+        #shared为True时使用root下的默认注册表, 也可直接传入注册表路径
+        self.shared_data = {}
+        if self.shared:
+            fpath = registry_path(self.root) if self.shared is True else self.shared
+            self.shared_data = attach_shared(fpath)
+    
+    def __search_order(self):
+        return [self.store] + [store for store in self.stores.values() if store is not self.store]
 
     def open_file(self, name):
+        if name in self.src_tables:
+            return self.__read_src(name)
+        if name in self.shared_data:
+            dat, version = self.shared_data[name]
+            #编码矩阵须带字符串表共享, 否则读到的是整数编码
+            if version == (self.catalog.get(name) or {}).get('version') and \
+                    (name not in ENCODED_FILES or isinstance(dat, EncodedMatrix)):
+                return dat
+            del self.shared_data[name]
+        path, store = self.__locate(name)
+        try:
+            dat = store.read(path, name, mmap=self.mmap)
+        except TypeError:
+            print(name, path)
+            raise
+        if store.fmt == 'csv':
+            dat = cast_frame(dat, self.get_dtype(name))
+        if name in ENCODED_FILES:
+            dat = self.__decoded(dat, path, name)
+        return dat
+    
+    @staticmethod
+    def __decoded(dat, path, name):
+        if StringTable.exists(path, name):
+            return EncodedMatrix(dat, StringTable(path, name).categories)
+        #尚未编码的旧字符串矩阵, 仅在内存中编码, 下次写入时落盘
+        table = StringTable(path, name)
+        return EncodedMatrix(table.encode(dat), table.categories)
+    
+    def __encoded(self, df, path, name, store=None):
+        """
+            Code matrix of df to be written. A stored matrix not yet encoded
+            is merged in with df first, so the caller has to rewrite it whole.
+        """
+        if isinstance(df, EncodedMatrix):
+            df = df.to_frame()
+        legacy = store is not None and store.exists(path, name) and \
+                 not StringTable.exists(path, name)
+        if legacy:
+            df = merge_frames(store.read(path, name), df)
+        table = StringTable(path, name)
+        codes = table.encode(df)
+        table.save()
+        return codes, legacy
+    
+    def get_dtype(self, name):
+        dtype = self.catalog.declared(name)
+        if dtype is None and self.float32 and name in self.float32_files:
+            dtype = 'float32'
+        return dtype
+    
+    def close_file(self, df, name, **kwargs):
+        if name in self.src_tables:
+            src = self.__src_path(name)
+            if self.export_excel:
+                df.to_excel(src, encoding='gbk', **kwargs)
+            self.__write_cache(name, self.__to_read_form(name, df), self.__src_signature(src))
+        else:
+            path = self.__get_path(name)
+            if name in ['stm_issuingdate', 'applied_rpt_date_M']:
+                df = df.replace(0, pd.NaT)
+            if name in ENCODED_FILES:
+                df, _ = self.__encoded(df, path, name)
+            df = cast_frame(df, self.get_dtype(name))
+            self.store.write(df, path, name, **kwargs)
+            self.catalog.record_frame(name, os.path.relpath(path, self.root), self.store.fmt, df)
+        self.__update_attr(name)
+    
+    def __src_path(self, name):
+        fname = {
+                'meta': self.metafile,
+                'month_map': self.mmapfile,
+                'trade_days_begin_end_of_month': self.tdays_be_m_file,
+                'month_group': self.month_group_file,
+                'tradedays': self.tradedays_file,
+                }[name]
+        return os.path.join(self.root, 'src', fname)
+    
+    @staticmethod
+    def __src_signature(src):
+        try:
+            st = os.stat(src)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+    
+    def __read_src(self, name):
+        #缓存与excel源文件的mtime及大小一致时直接读取缓存，否则由excel重新生成
+        src = self.__src_path(name)
+        cache = os.path.join(self.root, 'src', self.cache_dir, name+'.pkl')
+        signature = self.__src_signature(src)
+        if os.path.exists(cache):
+            cached = pd.read_pickle(cache)
+            if signature is None or cached['source'] == signature:
+                return cached['data']
+        dat = self.__read_excel(name, src)
+        self.__write_cache(name, dat, signature)
+        return dat
+    
+    def __write_cache(self, name, dat, signature):
+        cache_path = os.path.join(self.root, 'src', self.cache_dir)
+        os.makedirs(cache_path, exist_ok=True)
+        tmpfile = os.path.join(cache_path, name+'.pkl.tmp')
+        pd.to_pickle({'source': signature, 'data': dat}, tmpfile)
+        os.replace(tmpfile, os.path.join(cache_path, name+'.pkl'))
+    
+    @staticmethod
+    def __read_excel(name, src):
         if name == 'meta':
-            return pd.read_excel(os.path.join(self.root, 'src', self.metafile), index_col=[0],
+            return pd.read_excel(src, index_col=[0],
                                  parse_dates=['ipo_date', "delist_date"], encoding='gbk')
         elif name == 'month_map':
-            return pd.read_excel(os.path.join(self.root, 'src', self.mmapfile), index_col=[0],
+            return pd.read_excel(src, index_col=[0],
                                  parse_dates=[0, 1], encoding='gbk')['calendar_date']
         elif name == 'trade_days_begin_end_of_month':
-            return pd.read_excel(os.path.join(self.root, 'src', self.tdays_be_m_file), index_col=[1],
+            return pd.read_excel(src, index_col=[1],
                                  parse_dates=[0, 1], encoding='gbk')
         elif name == 'month_group':
-            return pd.read_excel(os.path.join(self.root, 'src', self.month_group_file), index_col=[0],
+            return pd.read_excel(src, index_col=[0],
                                  parse_dates=True, encoding='gbk')
         elif name == 'tradedays':
-            return pd.read_excel(os.path.join(self.root, 'src', self.tradedays_file), index_col=[0],
+            return pd.read_excel(src, index_col=[0],
                                  parse_dates=True, encoding='gbk').index.tolist()
-        path = self.freqmap.get(name, None)
-        if path is None:
-            raise Exception(f'{name} is unrecognisable or not in file dir, please check and retry.')
-        try:
-            dat = pd.read_csv(os.path.join(path, name+'.csv'), 
-                              index_col=[0], engine='python', encoding='gbk')
-        except TypeError:
-            print(name, path)
-            raise
-        dat.columns = pd.to_datetime(dat.columns)
-        if name in ('stm_issuingdate', 'applied_rpt_date_M'):
-            dat = dat.replace('0', np.nan)
-            dat = dat.applymap(pd.to_datetime)
-        return dat
     
-    def close_file(self, df, name, **kwargs):
+    @staticmethod
+    def __to_read_form(name, df):
+        #将写入excel的表格转换为open_file读出时的形式
         if name == 'meta':
-            df.to_excel(os.path.join(self.root, 'src', self.metafile), 
-                        encoding='gbk', **kwargs)
+            df = df.copy()
+            for col in ('ipo_date', 'delist_date'):
+                df[col] = pd.to_datetime(df[col])
+            return df
         elif name == 'month_map':
-            df.to_excel(os.path.join(self.root, 'src', self.mmapfile), 
-                        encoding='gbk', **kwargs)
+            if isinstance(df, pd.DataFrame):
+                df = df['calendar_date']
+            df = pd.Series(pd.to_datetime(df.values), index=pd.to_datetime(df.index), name='calendar_date')
+            df.index.name = 'trade_date'
+            return df
         elif name == 'trade_days_begin_end_of_month':
-            df.to_excel(os.path.join(self.root, 'src', self.tdays_be_m_file),
-                        encoding='gbk', **kwargs)
+            df = df.reset_index()
+            df = df.apply(pd.to_datetime)
+            return df.set_index(df.columns[1])
+        elif name == 'month_group':
+            return df
         elif name == 'tradedays':
-            df.to_excel(os.path.join(self.root, 'src', self.tradedays_file),
-                        encoding='gbk', **kwargs)
+            return pd.to_datetime(df.index).tolist()
+    
+    def append_file(self, df, name):
+        """
+            Only write the date columns in df, stored history is left untouched 
+            and dates already stored are overwritten by the ones in df.
+        """
+        if len(df.columns) == 0:
+            return
+        path = self.__get_path(name)
+        if name in ['stm_issuingdate', 'applied_rpt_date_M']:
+            df = df.replace(0, pd.NaT)
+        store = self.__find_store(path, name)
+        legacy = False
+        if name in ENCODED_FILES:
+            df, legacy = self.__encoded(df, path, name, store)
+        df = cast_frame(df, self.get_dtype(name))
+        if legacy:
+            self.store.write(df, path, name)
+        elif store is self.store:
+            self.store.append(df, path, name)
         else:
-            path = self.freqmap.get(name, None)
-            if path is None:
-                if 'lyr' in name or '_m' in name:
-                    path = self.mpath
-                elif '_d' in name:
-                    path = self.dpath
-                elif 'qfa' in name:
-                    path = self.qpath
-                else:
-                    path = self.root
-            if name in ['stm_issuingdate', 'applied_rpt_date_M']:
-                df = df.replace(0, pd.NaT)
-            df.to_csv(os.path.join(path, name+'.csv'), encoding='gbk', **kwargs)
-            self.__update_frepmap()
-        self.__update_attr(name)
+            ori = store.read(path, name)
+            self.store.write(merge_frames(ori, df), path, name)
+        index, columns = self.store.axes(path, name)
+        entry = self.catalog.get(name) or {}
+        self.catalog.record(name, os.path.relpath(path, self.root), self.store.fmt, 
+                            **self.catalog.describe(index, columns, entry.get('dtype', None)))
+        self.cache.pop(name)
+    
+    def read_window(self, name, stocks=None, start=None, end=None):
+        """
+            stocks×dates slice of a raw matrix restricted to dates within 
+            [start, end]. Stocks missing from the matrix come back as nan rows.
+        """
+        #只取一次缓存, 判断后到读取前可能已被其他线程逐出
+        dat = self.cache.get(name)
+        if dat is None and name not in self.shared_data:
+            path, store = self.__locate(name)
+            if store.windowed:
+                #按月分区时只读取覆盖窗口的分区, 不整体载入
+                dat = store.read_window(path, name, stocks, start, end)
+                if name in ENCODED_FILES:
+                    dat = self.__decoded(dat, path, name).to_frame()
+                return dat
+        #其余格式整体读入一次(缓存/内存映射)后切片
+        if dat is None:
+            dat = getattr(self, name)
+        dat = dat.loc[:, start:end]
+        return dat if stocks is None else dat.reindex(stocks)
+    
+    def get_dates(self, name):
+        dat = self.cache.get(name)
+        if dat is not None:
+            return dat.columns
+        path, store = self.__locate(name)
+        return store.columns(path, name)
+    
+    def get_info(self, name):
+        return self.catalog.get(name)
+    
+    def compact(self, names=None):
+        if names is None:
+            names = self.catalog.names()
+        for name in names:
+            path, store = self.__locate(name)
+            store.compact(path, name)
+    
+    def __locate(self, name):
+        entry = self.catalog.get(name)
+        if entry is not None:
+            return os.path.join(self.root, entry['path']), self.stores[entry['format']]
+        #清单中没有的矩阵，在原始数据目录中查找一次并登记
+        for dirname in RAW_DIRS:
+            path = os.path.join(self.root, dirname)
+            for store in self.__search_order():
+                if store.exists(path, name):
+                    self.catalog.record(name, dirname, store.fmt)
+                    return path, store
+        raise Exception(f'{name} is unrecognisable or not in file dir, please check and retry.')
+    
+    def __find_store(self, path, name):
+        entry = self.catalog.get(name)
+        if entry is not None:
+            return self.stores[entry['format']]
+        for store in self.__search_order():
+            if store.exists(path, name):
+                return store
+        return self.store
+    
+    def __get_path(self, name):
+        entry = self.catalog.get(name)
+        path = None if entry is None else os.path.join(self.root, entry['path'])
+        if path is None:
+            if 'lyr' in name or '_m' in name:
+                path = self.mpath
+            elif '_d' in name:
+                path = self.dpath
+            elif 'qfa' in name:
+                path = self.qpath
+            else:
+                path = self.root
+        return path
     
 #    @staticmethod
 #    def _fill_nan(series, value=0, ffill=False):
@@ -346,22 +556,55 @@ class Data:
 #                series.loc[start_valid_idx:] = series.loc[start_valid_idx:].fillna(0)
 #        return series
             
+    def cache_stats(self):
+        return self.cache.stats()
+    
     def __update_attr(self, name):
-        if name in self.__dict__:
-            del self.__dict__[name]
-        self.__dict__[name] = getattr(self, name, None)
+        self.cache.pop(name)
+        getattr(self, name, None)
     
     def __getattr__(self, name):
-        if name not in self.__dict__:
-            self.__dict__[name] = self.open_file(name)
-        return self.__dict__[name]
+        if name.startswith('__') or name in ('cache', '_load_locks'):
+            raise AttributeError(name)
+        dat = self.cache.get(name)
+        if dat is None:
+            #多线程同时读取同一矩阵时只载入一次
+            with self._load_locks.setdefault(name, threading.Lock()):
+                dat = self.cache.get(name)
+                if dat is None:
+                    dat = self.open_file(name)
+                    self.cache.put(name, dat)
+        return dat
       
 class FactorProcess:
-    def __init__(self, updatefreq, sentinel=1000, update_only=False):
-        self.data = Data()
+    #本进程内tradedays是否已与wind同步
+    tradedays_synced = False
+    #为True时BETA/HALPHA/HSIGMA保留窗口内有缺失数据的股票
+    nan_tolerant = False
+    #技术指标状态文件(root/.cache下), 为None时始终按窗口重新计算
+    tech_state_file = 'tech_state.pkl'
+    #get_factor_data中因子组的并行数, 1为顺序执行
+    group_workers = 1
+    #'thread'或'process'(fork子进程, 仅限linux)
+    group_executor = 'thread'
+    #get_factor_data默认计算的因子列, None为registry中当前频率的全部因子
+    target_factors = None
+    #当日已算出的中间量 {name: (tdate, window, value)}, 只整体替换不原地修改
+    _intermediates = {}
+    #按股票分片计算的每片股票数, None为不分片; 截面回归/标准化仍对全市场进行
+    shard_size = None
+    #分片计算中当前片的股票集合
+    _shard = None
+    #分片计算中各片共用的当日全市场结果{(名称, tdate): 值}, 不分片时为None
+    _shard_day = None
+    
+    def __init__(self, updatefreq, sentinel=1000, update_only=False, storage=None, mmap=None,
+                 cache_budget=None, shared=None):
+        if mmap is None:
+            mmap = not update_only
+        self.data = Data(storage, mmap, cache_budget, shared)
         self.sentinel = sentinel
         if not update_only:
-            self._turnover_preprocessed = self.__preprocess_turn_data() 
             self.dates_d = sorted(self.adjfactor.columns)
             self.dates_m = sorted(self.pct_chg_M.columns)
         if updatefreq not in ('M','w'):
@@ -371,25 +614,63 @@ class FactorProcess:
     def __getattr__(self, name):
         return getattr(self.data, name, None)
     
-    def __preprocess_turn_data(self):
-        turnover = self.turn.copy()
-        labeled = turnover.replace(np.nan, self.sentinel)
-        row_index, col_index = turnover.index, turnover.columns
+    @property
+    def calendar(self):
+        #tradedays或month_map重新读入(或被延长)后重建
+        tdays, month_map = self.tradedays, self.month_map
+        cal = self.__dict__.get('_calendar', None)
+        if cal is None or cal.source is not tdays or len(cal) != len(tdays) \
+                or cal.month_map is not month_map:
+            cal = self._calendar = TradingCalendar(tdays, month_map)
+        return cal
+    
+    @staticmethod
+    def preprocess_turn_data(data, sentinel=1000):
+        turn = data.turn
+        row_index, col_index = turn.index, turn.columns
+        values = np.asarray(turn.values)
+        if values.dtype.kind != 'f':
+            values = values.astype(float)
+        missing = np.isnan(values) | (values == sentinel)   #无数据(未上市)
 
-        status = self.trade_status.loc[row_index, col_index]
-        tolimit = self.maxupordown.loc[row_index, col_index] 
-        liststatus = self.listday_matrix.loc[row_index, col_index]
-        cond = (status==1) & (tolimit==0) 
-        turnover = turnover.where(cond)       #将停牌和涨跌停日的数值换为nan
-        cond2 = (liststatus==1) & pd.isnull(turnover)
-        turnover = turnover.where(~cond2, 0)  #将上市但停牌或涨跌停的日期值设为0
-        turnover = labeled.where(lambda s: s==self.sentinel, turnover)
-        return turnover
-    
-    def __update_tradedays(self):
-        startday = self.tradedays[-1] + toffsets.DateOffset(1)
-        endday = datetime.combine(toffsets.datetime.now(), time.min)
+        status = np.asarray(data.trade_status.loc[row_index, col_index].values)
+        tolimit = np.asarray(data.maxupordown.loc[row_index, col_index].values)
+        liststatus = np.asarray(data.listday_matrix.loc[row_index, col_index].values)
+        traded = (status==1) & (tolimit==0)          #停牌和涨跌停日不计入
+        valid = (traded | (liststatus==1)) & ~missing  #上市但停牌或涨跌停的日期按0计入
+        values = np.where(traded & valid, values, 0).astype(values.dtype)
+        return MaskedPanel(values, valid, missing, row_index, col_index)
+    
+    @classmethod
+    def shared_turnover(cls, data, sentinel=1000):
+        """
+            The preprocessed turnover panel as arrays to publish through
+            DataServer: {name: (values, index, columns, version of turn)}.
+        """
+        panel = cls.preprocess_turn_data(data, sentinel)
+        version = (data.catalog.get('turn') or {}).get('version')
+        return {f'turnover_{part}': (getattr(panel, part), panel.index, panel.columns, version)
+                for part in TURNOVER_PARTS}
+    
+    @lazyproperty
+    def _turnover_preprocessed(self):
+        #优先使用父进程发布的面板, turn更新过则重新计算
+        shared = self.data.shared_data
+        version = (self.data.catalog.get('turn') or {}).get('version')
+        parts = [shared.get(f'turnover_{part}') for part in TURNOVER_PARTS]
+        if all(p is not None and p[1] == version for p in parts):
+            values, valid, missing = (p[0] for p in parts)
+            return MaskedPanel(values.values, valid.values, missing.values, 
+                               values.index, values.columns)
+        return self.preprocess_turn_data(self.data, self.sentinel)
+    
+    @staticmethod
+    def __update_tradedays(data):
+        startday = data.tradedays[-1] + toffsets.DateOffset(1)
+        endday = datetime.combine(datetime.now(), time.min)
         startday, endday = str(startday)[:10], str(endday)[:10]
+        if w is None:
+            raise WindQueryFailError("WindPy is not installed.")
         res = w.tdays(startday, endday, "")
         if res.ErrorCode != 0:
             raise WindQueryFailError("Get tradedays list from WindPy failed, errorcode={}.".format(res.ErrorCode))
@@ -397,20 +678,38 @@ class FactorProcess:
             new_tdays = res.Data[0]
         except IndexError:
             new_tdays = []
-        self.tradedays.extend(new_tdays)
-        tdays_series = pd.Series(index=self.tradedays)
+        if not new_tdays:
+            return
+        data.tradedays.extend(new_tdays)
+        tdays_series = pd.Series(index=data.tradedays)
         tdays_series.index.name = 'tradedays'
-        self.close_file(tdays_series, 'tradedays')
+        data.close_file(tdays_series, 'tradedays')
+    
+    @classmethod
+    def sync_tradedays(cls, data):
+        """Extend the tradedays of data from wind, see refresh_tradedays."""
+        try:
+            cls.__update_tradedays(data)
+        except WindQueryFailError:
+            #同步失败时不置标志, 下次调用时重试
+            print("Update tradedays list from wind failed...trying continue")
+        else:
+            FactorProcess.tradedays_synced = True
+    
+    def refresh_tradedays(self):
+        """
+            Extend tradedays from wind. _get_trade_days only does this until
+            the first successful sync of a session, call it explicitly to 
+            sync again.
+        """
+        self.sync_tradedays(self.data)
     
     def _get_trade_days(self, startday, endday, freq=None):
         if freq is None:
             freq = self.freq
         startday, endday = pd.to_datetime((startday, endday))
-        try:
-            self.__update_tradedays()
-        except WindQueryFailError:
-            print("Update tradedays list from wind failed...trying continue")
-            pass
+        if not self.tradedays_synced:
+            self.refresh_tradedays()
         if freq == 'd':
             try:
                 start_idx = self._get_date_idx(startday, self.tradedays)
@@ -424,12 +723,8 @@ class FactorProcess:
                 else:
                     return self.tradedays[start_idx:end_idx+1]
         else:
-            new_cdays_curfreq = pd.Series(index=self.tradedays).resample(freq).asfreq().index
-            c_to_t_dict = {cday:tday for tday, cday in self.month_map.to_dict().items()}
-            try:
-                new_tdays_curfreq = [c_to_t_dict[cday] for cday in new_cdays_curfreq]
-            except KeyError:
-                new_tdays_curfreq = [c_to_t_dict[cday] for cday in new_cdays_curfreq[:-1]]
+            new_tdays_curfreq = self.calendar.resampled(freq)
+            c_to_t_dict = self.calendar.cal_to_trade
             start_idx = self._get_date_idx(c_to_t_dict.get(startday, startday), new_tdays_curfreq) + 1
             try:
                 end_idx = self._get_date_idx(c_to_t_dict.get(endday, endday), new_tdays_curfreq)
@@ -442,6 +737,10 @@ class FactorProcess:
         self.__trade_days = self._get_trade_days(self.startday, self.endday)
         return self.__trade_days
 
+    def backfill_dates(self, startday, endday):
+        """Factor dates of a range: month_map trade days ('M') or Thursdays ('w')."""
+        return factor_dates(self.updatefreq, self.month_map, startday, endday)
+    
     def generate_factor_file(self, datepath):
         try:
             date = pd.to_datetime(datepath.split(".")[0])
@@ -463,11 +762,11 @@ class FactorProcess:
         
         for col in ['name', 'industry_sw']:
             datdf[col] = datdf[col].apply(str)
-        datdf = datdf.loc[~datdf['name'].str.contains('0')]
+        datdf = datdf.loc[~self._str_contains(datdf['name'], '0')]
         
-        save_cond1 = (~datdf['name'].str.contains('ST'))  #剔除ST股票
+        save_cond1 = (~self._str_contains(datdf['name'], 'ST'))  #剔除ST股票
         save_cond2 = (~pd.isnull(datdf['industry_sw'])) & \
-                     (~datdf['industry_sw'].str.contains('0'))   #剔除行业值为0或为空的股票
+                     (~self._str_contains(datdf['industry_sw'], '0'))   #剔除行业值为0或为空的股票
         save_cond3 = (~pd.isnull(datdf['MKT_CAP_FLOAT'])) #剔除市值为空的股票
         save_cond = save_cond1 & save_cond2 & save_cond3 
         datdf = datdf.loc[save_cond]
@@ -482,6 +781,13 @@ class FactorProcess:
         else:
             raise TypeError("Unsupportted type {}, only support csv currently.".format(path.split('.')[-1]))
     
+    @staticmethod
+    def _str_contains(series, pat):
+        #只在去重后的取值上匹配一次, 再按编码广播
+        codes, uniques = pd.factorize(series)
+        mask = np.append(pd.Index(uniques, dtype=object).str.contains(pat), False)
+        return pd.Series(mask[codes], index=series.index)
+    
     @staticmethod
     def concat_df(left, right, *, how="outer", left_index=True, 
                   right_index=True, **kwargs):
@@ -498,10 +804,11 @@ class FactorProcess:
         res = self.concat_df(dat0, dat1)
         self.save_file(res, savepath)
     
-    def _ind_map(self, inds_lv1, inds_lv2):
-        inds_lv1 = inds_lv1.values
-        inds_lv2 = inds_lv2.values
-        return np.where(inds_lv1 == '非银行金融', inds_lv2, inds_lv1)
+    def _ind_map(self, inds_lv1, inds_lv2, stocklist, date):
+        #在编码表上判断一次非银行金融, 按编码广播为掩码
+        nonbank = inds_lv1.isin(['非银行金融'], stocklist, date).values
+        return np.where(nonbank, inds_lv2.loc[stocklist, date].values, 
+                        inds_lv1.loc[stocklist, date].values)
     
     def _get_stock_list(self, tdate):
         df = self.meta[self.meta['ipo_date'] <= tdate]
@@ -509,6 +816,21 @@ class FactorProcess:
         df = df[cond]
         return df.index.tolist()
     
+    def _listed_stocks(self, tdate):
+        #分片计算时只取当前片内的上市股票
+        stocks = self._once_per_day('stock_list', tdate, self._get_stock_list)
+        if self._shard is not None:
+            stocks = [s for s in stocks if s in self._shard]
+        return stocks
+    
+    def _once_per_day(self, key, tdate, func):
+        #分片计算时全市场的结果当日只算一次, 由各片共用
+        if self._shard_day is None:
+            return func(tdate)
+        if (key, tdate) not in self._shard_day:
+            self._shard_day[(key, tdate)] = func(tdate)
+        return self._shard_day[(key, tdate)]
+    
     def get_basic_data(self, tdate):
         df0 = self.meta[self.meta['ipo_date'] <= tdate]
         cond = (pd.isnull(df0['delist_date'])) | (df0['delist_date'] >= tdate)
@@ -520,9 +842,8 @@ class FactorProcess:
         if self.updatefreq == 'w':
             df0['name'] = self.sec_name1_d.loc[stocklist, tdate]  
             
-            cur_citic_level1 = self.industry_citic_d.loc[stocklist, tdate]
-            cur_citic_level2 = self.industry_citic_level2_d.loc[stocklist, tdate]
-            cur_citic_level = self._ind_map(cur_citic_level1, cur_citic_level2)
+            cur_citic_level = self._ind_map(self.industry_citic_d, self.industry_citic_level2_d,
+                                            stocklist, tdate)
             df0["industry_sw"] = cur_citic_level
             
             df0['MKT_CAP_FLOAT'] = self.mkt_cap_float_d.loc[stocklist, tdate]   #最新日频
@@ -532,8 +853,6 @@ class FactorProcess:
             df0['name'] = self.sec_name1.loc[stocklist, caldate]  #
             
             cur_citic_level1 = self.industry_citic.loc[stocklist, caldate]
-            cur_citic_level2 = self.industry_citic_level2.loc[stocklist, caldate]
-            cur_citic_level = self._ind_map(cur_citic_level1, cur_citic_level2)
             df0["industry_sw"] = cur_citic_level1
             
             df0['MKT_CAP_FLOAT'] = self.mkt_cap_float.loc[stocklist, caldate]   #最新日频
@@ -551,18 +870,7 @@ class FactorProcess:
         return stocklist, df0
     
     def _get_next_month_first_trade_date(self, date):
-        date = pd.to_datetime(date)
-        tdates = self.trade_status.columns.tolist()
-
-        def _if_same_month(x):
-            nonlocal date
-            if date.month != 12:
-                return (x.year != date.year) or (x.month - 1 != date.month)
-            else:
-                return (x.year - 1 != date.year) or (x.month != 1)
-        
-        daterange = dropwhile(_if_same_month, tdates)
-        return list(daterange)[0]
+        return TradingCalendar.of(self.trade_status.columns).next_month_first(date)
     
     def get_next_pctchg(self, stocklist, tdate):
         try:
@@ -582,30 +890,154 @@ class FactorProcess:
             lstmonth = date.month - 1
         return datetime(lstyear, lstmonth, 1) + toffsets.MonthEnd(n=1)
     
-    def get_factor_data(self, tdate, stocklist=None):
+    def get_factor_data(self, tdate, stocklist=None, factors=None):
+        """
+            Columns factors (target_factors or every registered factor of
+            updatefreq by default) for tdate. Only the groups producing them
+            run, after the intermediates they share are computed once.
+            With shard_size set, the per-stock groups run shard by shard
+            (see _get_sharded_data).
+        """
         if stocklist is None:
             stocklist = self._get_stock_list(tdate)
+        if factors is None:
+            factors = self.target_factors
         
         if self.updatefreq == 'M':
             caldate = self.month_map[tdate]
         else:
             caldate = tdate
-        
-        dat1 = self._get_value_data(stocklist, caldate)
-        lstcaldate_cm = caldate - toffsets.timedelta(days=1) + toffsets.MonthEnd(n=1)
+        fcaldate = caldate
+        lstcaldate_cm = caldate - timedelta(days=1) + toffsets.MonthEnd(n=1)
         if self.updatefreq == 'w' and caldate != lstcaldate_cm:
-            caldate = self.get_last_month_end(caldate)
-        dat2 = self._get_growth_data(stocklist, caldate)
-        dat3 = self._get_finance_data(stocklist, caldate)
-        dat4 = self._get_leverage_data(stocklist, caldate)
-        dat5 = self._get_cal_data(stocklist, tdate)
-        dat6 = self._get_tech_data(stocklist, tdate)
-        res = reduce(self.concat_df, [dat1, dat2, dat3, dat4, dat5, dat6])
-        if self.updatefreq == 'M':
-            dat7 = self._get_barra_quote_data(stocklist, tdate)
-            dat8 = self._get_barra_finance_data(stocklist, tdate)
-            res = reduce(self.concat_df, [res, dat7, dat8])
-        return res
+            fcaldate = self.get_last_month_end(caldate)
+        ctx = {'stocks': stocklist, 'tdate': tdate, 'caldate': caldate, 'fcaldate': fcaldate,
+               'dates_d': self.dates_d}
+        
+        columns = self.registry.targets(self.updatefreq) if factors is None else factors
+        intermediates, groups = self.registry.plan(columns, self.updatefreq)
+        if self.shard_size and len(stocklist) > self.shard_size:
+            results = self._get_sharded_data(intermediates, groups, ctx)
+        else:
+            results = self._get_groups_data(intermediates, groups, ctx)
+        #各组只保留registry中声明的输出列
+        res = reduce(self.concat_df, [dat[node.outputs] for node, dat in zip(groups, results)])
+        return res if factors is None else res[list(factors)]
+    
+    def _get_groups_data(self, intermediates, groups, ctx):
+        self._prepare_intermediates(intermediates, ctx)
+        try:
+            return self._run_groups([(node.name, node.func, node.call_args(ctx), node.params) 
+                                     for node in groups])
+        finally:
+            #中间量只在当日(当片)内有效, 算完即释放
+            self._intermediates = {}
+    
+    def _get_sharded_data(self, intermediates, groups, ctx):
+        """
+            Results of groups (in group order) with the stocks split into
+            shards of shard_size: the intermediates and the per-stock groups
+            are computed one shard at a time and their rows stacked, so the
+            daily windows read per shard cover shard_size stocks only. The
+            whole-universe results of the date (stock list, tech state) are
+            computed once and shared by the shards; the cross_sectional 
+            groups run once on the whole universe.
+        """
+        stocks = ctx['stocks']
+        local = [node for node in groups if not node.cross_sectional]
+        pieces = {node.name: [] for node in local}
+        timings = dict.fromkeys(pieces, 0.)
+        self._shard_day = {}
+        try:
+            for i in range(0, len(stocks), self.shard_size):
+                shard = stocks[i:i+self.shard_size]
+                self._shard = set(shard)
+                try:
+                    done = self._get_groups_data(intermediates, local, dict(ctx, stocks=shard))
+                finally:
+                    self._shard = None
+                for node, res in zip(local, done):
+                    pieces[node.name].append(res)
+                    timings[node.name] += self.group_timings[node.name]
+        finally:
+            self._shard_day = None
+        
+        glob = [node for node in groups if node.cross_sectional]
+        glob_res = dict(zip([node.name for node in glob], 
+                            self._run_groups([(node.name, node.func, node.call_args(ctx), node.params) 
+                                              for node in glob])))
+        timings.update(self.group_timings)
+        self.group_timings = {node.name: timings[node.name] for node in groups}
+        return [glob_res[node.name] if node.cross_sectional else pd.concat(pieces[node.name]) 
+                for node in groups]
+    
+    def _eval_node(self, node, ctx):
+        func = getattr(self, node.func) if isinstance(node.func, str) else partial(node.func, self)
+        return func(*node.call_args(ctx), **node.params)
+    
+    def _prepare_intermediates(self, nodes, ctx):
+        #nodes为[(node, window)], 依赖在前; 每个中间量每日只算一次
+        cache = {}
+        for node, window in nodes:
+            node_ctx = dict(ctx, window=window)
+            #依赖截取到本节点的窗口, 记录实际行数
+            node_ctx.update((dep, cache[dep][2].iloc[-window:]) for dep in node.inputs)
+            dat = self._eval_node(node, node_ctx)
+            cache[node.name] = (ctx['tdate'], len(dat), dat)
+        self._intermediates = cache
+    
+    def _get_daily_window(self, key, stocks, tdate, offset, datelist=None):
+        """
+            Last offset days of the daily intermediate key (pct_chg_d, 
+            log_ret_d) for stocks: sliced from the one prepared for tdate when
+            it covers the request, evaluated on its own otherwise.
+        """
+        hit = self._intermediates.get(key)
+        if hit is not None and hit[0] == tdate and hit[1] >= offset and \
+                (datelist is None or datelist is self.dates_d) and \
+                pd.Index(stocks).isin(hit[2].columns).all():
+            return hit[2].iloc[-offset:].reindex(columns=stocks)
+        node = self.registry.intermediates[key]
+        ctx = {'stocks': stocks, 'tdate': tdate, 'window': offset, 
+               'dates_d': self.dates_d if datelist is None else datelist}
+        ctx.update((dep, self._get_daily_window(dep, stocks, tdate, offset, datelist)) for dep in node.inputs)
+        return self._eval_node(node, ctx).reindex(columns=stocks)
+    
+    def _daily_window(self, stocks, tdate, window, dates_d, name="pct_chg", extra=()):
+        codes = list(stocks) + [code for code in extra if code not in set(stocks)]
+        return self._get_daily_data(name, codes, tdate, window, dates_d)
+    
+    @staticmethod
+    def _log_returns(pct_chg_d):
+        return np.log(1 + pct_chg_d)
+    
+    def _run_groups(self, groups):
+        """
+            Run (name, func, args, kwargs) factor groups, concurrently when
+            group_workers > 1. Results come back in group order, seconds 
+            spent per group in self.group_timings.
+        """
+        global _group_owner
+        self.group_timings = {}
+        if self.group_workers <= 1:
+            done = [_run_group(func, args, self, kwargs) for _, func, args, kwargs in groups]
+        else:
+            if self.group_executor == 'process':
+                _group_owner = self
+                pool = ProcessPoolExecutor(self.group_workers, 
+                                           mp_context=multiprocessing.get_context('fork'))
+                owner = None
+            else:
+                pool = ThreadPoolExecutor(self.group_workers)
+                owner = self
+            with pool:
+                futures = [pool.submit(_run_group, func, args, owner, kwargs) 
+                           for _, func, args, kwargs in groups]
+                done = [future.result() for future in futures]
+            _group_owner = None
+        for (name, _, _, _), (_, seconds) in zip(groups, done):
+            self.group_timings[name] = seconds
+        return [res for res, _ in done]
     
     def _get_value_data(self, stocks, caldate):
         """
@@ -639,7 +1071,6 @@ class FactorProcess:
             dat['DP'] = self.dividendyield2.loc[stocks, date]
             dat['G/PE'] = self.profit_ttm_G.loc[stocks, date] * dat['EP']
         
-        dat = dat[self.value_target_indicators]
         return dat
     
     def _get_growth_data(self, stocks, caldate):
@@ -658,7 +1089,6 @@ class FactorProcess:
         dat["OCF_G_q"] = self.qfa_yoyocf_m.loc[stocks, date]
         dat['ROE_G_q'] = self.qfa_roe_G_m.loc[stocks, date]
             
-        dat = dat[self.growth_target_indicators]
         return dat
     
     def _get_finance_data(self, stocks, caldate):
@@ -705,7 +1135,6 @@ class FactorProcess:
         dat["operationcashflowratio_ttm"] = self.ocfps_ttm.loc[stocks, date] / \
                                             self.eps_ttm.loc[stocks, date]
         
-        dat = dat[self.finance_target_indicators]
         return dat
     
     def _get_leverage_data(self, stocks, caldate):
@@ -724,7 +1153,6 @@ class FactorProcess:
         dat["cashratio"] = self.cashtocurrentdebt_m.loc[stocks, date]
         dat["currentratio"] = self.current_m.loc[stocks, date]
         
-        dat = dat[self.leverage_target_indicators]
         return dat
     
     def _get_cal_data(self, stocks, tdate):
@@ -761,7 +1189,6 @@ class FactorProcess:
         dat3 = self._get_regress_data(stocks, tdate, self.dates_m, params=["000001.SH", 60])
         
         dat = reduce(self.concat_df, [dat, dat1, dat2, dat3])
-        dat = dat[self.cal_target_indicators]
         return dat
     
     def _get_tech_data(self, stocks, tdate):
@@ -772,6 +1199,10 @@ class FactorProcess:
             Default target technique indicators:
             "MACD", "DEA", "DIF", "RSI", "PSY", "BIAS"
         """
+        state = self._once_per_day('tech_state', tdate, self._get_tech_state)
+        if state is not None:
+            cols = [c for t in self.tech_indicators for c in (["DIF", "DEA", "MACD"] if t == "MACD" else [t])]
+            return state.frame(stocks)[cols]
         dat = pd.DataFrame(index=stocks)
         for tname in self.tech_indicators:
             calfunc = getattr(self, 'cal_'+tname, None)
@@ -785,16 +1216,58 @@ class FactorProcess:
                     dat[tname] = calfunc(stocks, tdate, self._tech_params[tname])
         return dat
     
+    def _get_tech_state(self, tdate):
+        """
+            Persisted TechState advanced to tdate: rebuilt over the cal_MACD
+            window when missing or when the buffered closes no longer match
+            hfq_close (adjfactor rewrote history). None when tdate is before
+            the state (backfills) so the window computation is used instead.
+            Processes and threads sharing the state file take turns.
+        """
+        if self.tech_state_file is None or \
+                sorted(self.tech_indicators) != sorted(self._tech_params):
+            return None
+        fpath = os.path.join(self.data.root, self.data.cache_dir, self.tech_state_file)
+        with file_lock(fpath):
+            return self.__advance_tech_state(fpath, tdate)
+    
+    def __advance_tech_state(self, fpath, tdate):
+        datelist = self.data.get_dates("hfq_close").tolist()
+        idx = self._get_date_idx(tdate, datelist)
+        offset = max(self._tech_params["MACD"]) + 240
+        state = TechState.load(fpath, self._tech_params)
+        if state is not None:
+            last_idx = self._get_date_idx(state.last_date, datelist)
+            if idx < last_idx:
+                return None
+            dates = [d for d in state.dates if d is not None]
+            if not state.matches(self.data.read_window("hfq_close", None, dates[0], dates[-1])):
+                state = None
+        #无状态、历史被改写或间隔超过一个窗口时整体重建
+        if state is None or idx - last_idx >= offset:
+            state = TechState.build(self._get_daily_data("hfq_close", None, tdate, offset), self._tech_params)
+        elif idx > last_idx:
+            new_dates = datelist[last_idx+1:idx+1]
+            state.advance(self.data.read_window("hfq_close", None, new_dates[0], new_dates[-1]).T)
+        else:
+            return state
+        state.save(fpath)
+        return state
+    
     def _get_mom_vol_data(self, stocks, qdate, dates, params=(1,3,6,12)):
-        pct_chg = self.pct_chg
-        turnover = self.turn        
         if self.updatefreq == 'M':        
             caldate = self.month_map[qdate]
         else:
             caldate = qdate
+        periods = {offset: self._get_period_d(qdate, offset=-offset, freq="M", datelist=dates)
+                   for offset in params}
+        #只读取stocks在各区间并集上的日频窗口
+        start, end = min(p[0] for p in periods.values()), max(p[-1] for p in periods.values())
+        pct_chg = self.data.read_window('pct_chg', stocks, start, end)
+        turnover = self.data.read_window('turn', stocks, start, end)
         res = pd.DataFrame(index=stocks)
         for offset in params:
-            period_d = self._get_period_d(qdate, offset=-offset, freq="M", datelist=dates)
+            period_d = periods[offset]
             
             cur_pct_chg_d = pct_chg.loc[stocks, period_d]
             
@@ -805,40 +1278,32 @@ class FactorProcess:
             
             cur_turnover = turnover.loc[cur_pct_chg_d.index, period_d]
             
-            days_wgt = cur_pct_chg_d.expanding(axis=1).\
-                       apply(lambda df: np.exp(-(len(period_d) - len(df))/4/offset))
-            wgt_pct_chg = cur_pct_chg_d * cur_turnover
+            days_wgt = exp_day_weights(len(period_d), offset)
+            wgt_pct_chg = cur_pct_chg_d.values * np.asarray(cur_turnover.values)
             exp_wgt_pct_chg = wgt_pct_chg * days_wgt          
             
+            #与原_cal_func相同: nan不计入, 含标记值(>=1000)的股票为nan
             res[f"return_{offset}m"] = cur_pct_chg_m.loc[stocks, caldate]
-            res[f"wgt_return_{offset}m"] = wgt_pct_chg.apply(self._cal_func, axis=1, args=(np.nanmean,))
-            res[f"exp_wgt_return_{offset}m"] = exp_wgt_pct_chg.apply(self._cal_func, axis=1, args=(np.nanmean,))
-            res[f"std_{offset}m"] = cur_pct_chg_d.apply(self._cal_func, axis=1, args=(np.nanstd,))
+            res[f"wgt_return_{offset}m"] = MaskedPanel.from_sentinel(wgt_pct_chg).mean().values
+            res[f"exp_wgt_return_{offset}m"] = MaskedPanel.from_sentinel(exp_wgt_pct_chg).mean().values
+            res[f"std_{offset}m"] = MaskedPanel.from_sentinel(cur_pct_chg_d).std().values
         return res
     
     def _get_turnover_data(self, stocks, qdate, dates, params=(1,3,6,12)):      
         base_period_d = self._get_period_d(qdate, offset=-2, freq="y", datelist=dates)
         cur_turnover_base = self._turnover_preprocessed.loc[stocks, base_period_d]
-        turnover_davg_base = cur_turnover_base.apply(self._cal_func, axis=1, args=(np.nanmean, self.sentinel))
+        turnover_davg_base = cur_turnover_base.mean()
 
         res = pd.DataFrame(index=stocks)        
         for offset in params:
             period_d = self._get_period_d(qdate, offset=-offset, freq="M", datelist=dates)
             cur_turnover = self._turnover_preprocessed.loc[stocks, period_d]
-            turnover_davg = cur_turnover.apply(self._cal_func, axis=1, args=(np.nanmean, self.sentinel))
+            turnover_davg = cur_turnover.mean()
 
             res[f"turn_{offset}m"] = turnover_davg
             res[f"bias_turn_{offset}m"] = turnover_davg / turnover_davg_base - 1
         return res
     
-    @staticmethod
-    def _cal_func(df, func=np.nanmean, sentinel=1000):
-        val = list(takewhile(lambda x: x < sentinel or pd.isnull(x), df.values))
-        if len(val) == len(df):
-            return func(val, axis=0)
-        else:
-            return np.nan
-    
     def _get_regress_data(self, stocks, qdate, dates, params=("000001.SH", 60)):
         """
             return value contains:
@@ -868,32 +1333,11 @@ class FactorProcess:
         res = self.concat_df(beta, Halpha)
         return res
      
-    def _get_barra_quote_data(self, stocks, tdate):
-        """
-            Default source data loaded from local file:
-            "mkt_cap_float", "pct_chg", "amt"
-            
-            Default target barra_quote indicators:
-            "LNCAP_barra", "MIDCAP_barra", 
-            "BETA_barra", "HSIGMA_barra", "HALPHA_barra",
-            "DASTD_barra", "CMRA_barra",
-            "STOM_barra", "STOQ_barra", "STOA_barra",
-            "RSTR_barra"
-        """
-        tdate = pd.to_datetime(tdate)
-        caldate = self.month_map[tdate]
-        dat = pd.DataFrame(index=stocks)
-        
-        dat1 = self._get_size_barra(stocks, caldate, self.dates_d, params=[True,True,True])
-        dat2 = self._get_regress_barra(stocks, tdate, self.dates_d, params=[4,504,252,True,'000300.SH'])
-        dat3 = self._get_dastd_barra(stocks, tdate, self.dates_d, params=[252,42])
-        dat4 = self._get_cmra_barra(stocks, tdate, self.dates_d, params=[12, 21])
-        dat5 = self._get_liquidity_barra(stocks, tdate, params=[21,1,3,12])
-        dat6 = self._get_rstr_barra(stocks, tdate, self.dates_d, params=[252,126,11,'000300.SH'])
-        
-        dat = reduce(self.concat_df, [dat, dat1, dat2, dat3, dat4, dat5, dat6])
-        dat = dat[self.barra_quote_target_indicators]
-        return dat
+    def _get_size_barra_data(self, stocks, tdate):
+        #LNCAP/MIDCAP: 截面回归与标准化, 须对全部股票一起计算
+        caldate = self.month_map[pd.to_datetime(tdate)]
+        dat = self._get_size_barra(stocks, caldate, self.dates_d, params=[True,True,True])
+        return dat[[c for c in ["LNCAP_barra", "MIDCAP_barra"] if c in dat.columns]]
     
     def _get_size_barra(self, stocks, caldate, dates, params=(True,True,True)):
         intercept, standardize, wls = params
@@ -926,34 +1370,15 @@ class FactorProcess:
         shift, window, half_life, if_intercept, index_code = params
         res = pd.DataFrame(index=stocks)
         w = self.get_exponential_weights(window, half_life)
-        idx = self._get_date_idx(tdate, dates_d)
-        date_period = dates_d[idx-window+1-shift:idx+1] 
-        pct_chgs = self.pct_chg.T.loc[date_period,:]
+        pct_chgs = self._get_daily_window("pct_chg_d", list(stocks)+[index_code], tdate, 
+                                          window+shift, dates_d)
 
-        for i in range(1,shift+1):
-            pct_chg = pct_chgs.iloc[i:i+window,:]
-            ys = pct_chg.loc[:, stocks].dropna(how='any', axis=1)
-            x = pct_chg.loc[:, index_code]
-            X, Ys = x.values, ys.values
-            try:
-                intercept, coef = self.regress(X, Ys, if_intercept, w)
-            except:
-                print(X)
-                print(Ys)
-                raise
-            alpha = pd.Series(intercept, index=ys.columns)
-            beta = pd.Series(coef[0], index=ys.columns)
-            alpha.name = f'alpha_{i}'; beta.name = f'beta_{i}'
-            res = pd.concat([res, alpha, beta], axis=1)
-            if i == shift:
-                resid = Ys - (intercept + X.reshape(-1,1) @ coef)
-                sigma = pd.Series(np.std(resid, axis=0), index=ys.columns)
-                sigma.name = 'HSIGMA_barra'
-                res = pd.concat([res, sigma], axis=1)
-        
-        res['HALPHA_barra'] = np.sum((res[f'alpha_{i}'] for i in range(1,shift+1)), axis=0)
-        res['BETA_barra'] = np.sum((res[f'beta_{i}'] for i in range(1,shift+1)), axis=0)
-        res = res[['BETA_barra', 'HALPHA_barra', 'HSIGMA_barra']]
+        const, slope, sigma = shifted_wls(pct_chgs[index_code].values, pct_chgs[stocks].values, 
+                                          w, shift, if_intercept, self.nan_tolerant)
+        #各期alpha/beta求和, HSIGMA取最后一期残差
+        res['BETA_barra'] = slope.sum(axis=0)
+        res['HALPHA_barra'] = const.sum(axis=0)
+        res['HSIGMA_barra'] = sigma[-1]
         return res
     
     def _get_dastd_barra(self, stocks, tdate, dates_d, params=(252,42)):
@@ -961,37 +1386,27 @@ class FactorProcess:
         
         res = pd.DataFrame(index=stocks)
         w = self.get_exponential_weights(window, half_life)
-        pct_chg = self._get_daily_data("pct_chg", stocks, tdate, window, dates_d)
+        pct_chg = self._get_daily_window("pct_chg_d", stocks, tdate, window, dates_d)
         pct_chg = pct_chg.dropna(how='any', axis=1)
-        res['DASTD_barra'] = pct_chg.apply(self._std_dev, args=(w,))
+        res['DASTD_barra'] = dastd(pct_chg, w)
         return res
     
-    @staticmethod
-    def _std_dev(series, weight=1):
-        mean = np.mean(series)
-        std_dev = np.sqrt(np.sum((series - mean)**2 * weight))
-        return std_dev
-    
     def _get_cmra_barra(self, stocks, tdate, dates_d, params=(12,21)):
         months, days_pm = params
         window = months * days_pm
         
         res = pd.DataFrame(index=stocks)
-        pct_chg = self._get_daily_data("pct_chg", stocks, tdate, window, dates_d)
-        pct_chg = pct_chg.dropna(how='any', axis=1)
-        res['CMRA_barra'] = np.log(1 + pct_chg).apply(self._cal_cmra, args=(months, days_pm))
+        pct_chg = self._get_daily_window("pct_chg_d", stocks, tdate, window, dates_d)
+        valid = pct_chg.columns[pct_chg.notna().all()]
+        log_ret = self._get_daily_window("log_ret_d", valid, tdate, window, dates_d)
+        res['CMRA_barra'] = cmra(log_ret, months, days_pm)
         return res
     
-    @staticmethod
-    def _cal_cmra(series, months=12, days_per_month=21):
-        z = sorted(series[-i * days_per_month:].sum() for i in range(1, months+1))
-        return z[-1] - z[0]
-    
     def _get_liquidity_barra(self, stocks, tdate, params=(21,1,3,12)):
         days_pm, freq1, freq2, freq3 = params
         window = freq3 * days_pm
         
-        stocks = self._get_stock_list(tdate)
+        stocks = self._listed_stocks(tdate)
         res = pd.DataFrame(index=stocks)
         amt = self._get_daily_data('amt', stocks, tdate, window)
         mkt_cap_float = self._get_daily_data('mkt_cap_float_d', stocks, tdate, 
@@ -1017,21 +1432,9 @@ class FactorProcess:
         
         res = pd.DataFrame(index=stocks)
         w = self.get_exponential_weights(window, half_life)
-        idx = self._get_date_idx(tdate, dates_d)
-        date_period = dates_d[idx-window-shift+1:idx+1]
-        pct_chgs = self.pct_chg.T.loc[date_period, :]
-        
-        for i in range(1,shift+1):
-            pct_chg = pct_chgs.iloc[i:i+window,:]
-            stk_ret = pct_chg[stocks]
-            bm_ret = pct_chg[index_code]
-            excess_ret = np.log(1 + stk_ret).sub(np.log(1 + bm_ret), axis=0)
-            excess_ret = excess_ret.mul(w, axis=0)
-            rs = excess_ret.apply(np.nansum, axis=0)
-            rs.name = f'rs_{i}'
-            res = pd.concat([res, rs], axis=1)
-        
-        res['RSTR_barra'] = np.sum((res[f'rs_{i}'] for i in range(1,shift+1)), axis=0) / shift
+        log_rets = self._get_daily_window("log_ret_d", list(stocks)+[index_code], tdate, 
+                                          window+shift, dates_d)
+        res['RSTR_barra'] = rstr(log_rets[stocks], log_rets[index_code], w, shift, log_ret=True)
         return res[['RSTR_barra']]
     
     def _get_barra_finance_data(self, stocks, tdate):
@@ -1053,7 +1456,6 @@ class FactorProcess:
         dat3 = self._get_growth_barra(stocks, caldate, params=(5,'y'))
 
         dat = reduce(self.concat_df, [dat, dat1, dat2, dat3])
-        dat = dat[self.barra_finance_target_indicators]
         return dat
         
         return pd.DataFrame()
@@ -1108,22 +1510,6 @@ class FactorProcess:
             except:
                 return pd.NaT
     
-    def __cal_gr(self, series, lyr_rptdates, periods=5):
-        lyr_date = lyr_rptdates[series.name]
-        if pd.isna(lyr_date):
-            return np.nan
-        idx = self._get_date_idx(lyr_date, series.index)
-        y = series.iloc[idx-periods+1:idx+1]
-        x = pd.Series(range(1, len(y)+1), index=y.index)
-        
-        x_and_y = pd.concat([x,y], axis=1).dropna(how='any', axis=1)
-        try:
-            x, y = x_and_y.iloc[:, 0].values, x_and_y.iloc[:, 1].values 
-            _, coef = self.regress(x,y)
-            return coef[0] / np.mean(y)
-        except:
-            return np.nan
-        
     def _cal_growth_rate(self, ori_data, stocks, caldate, periods=5, freq='y'):
         try:
             current_rptdates = self.applied_rpt_date_M.loc[stocks, caldate]
@@ -1132,19 +1518,20 @@ class FactorProcess:
             print(caldate)
             print(type(stocks), type(caldate))
             raise
-        current_lyr_rptdates = current_rptdates.apply(self._get_lyr_date)
+        current_rptdates = pd.to_datetime(current_rptdates)
+        #非12月的报告期取上一年年报, 与_get_lyr_date一致
+        current_lyr_rptdates = current_rptdates.where(current_rptdates.dt.month == 12, 
+                                                      current_rptdates - toffsets.YearEnd(1))
 #        tdate = pd.to_datetime('2019-03-29'); self = z; caldate = self.month_map[tdate]
 #        stocks = self._FactorProcess__get_stock_list(tdate); ori_data = self.current.loc[stocks,:]
         if ori_data.index.dtype == 'O':
             ori_data = ori_data.T
-        ori_data = ori_data.groupby(pd.Grouper(freq=freq)).apply(lambda df: df.iloc[-1])
-        res = ori_data.apply(self.__cal_gr, args=(current_lyr_rptdates, periods))
-        return res
+        ori_data = last_per_period(ori_data, freq)
+        return growth_rate(ori_data, current_lyr_rptdates, periods)
         
     @staticmethod
     def get_exponential_weights(window=12, half_life=6):
-        exp_wt = np.asarray([0.5 ** (1 / half_life)] * window) ** np.arange(window)
-        return exp_wt[::-1] 
+        return exp_weights(window, half_life)
     
     @staticmethod
     def winsorize(dat, n=5):  
@@ -1164,14 +1551,13 @@ class FactorProcess:
     
     @staticmethod
     def regress(X, y, intercept=True, weights=1, robust=False):
-        if intercept:
-            X = sm.add_constant(X)
         if robust:
+            if intercept:
+                X = sm.add_constant(X)
             model = sm.RLM(y, X, weights=weights)
+            params = model.fit().params
         else:
-            model = sm.WLS(y, X, weights=weights)
-        result = model.fit()
-        params = result.params 
+            params = wls(X, y, intercept, weights)
         return params[0], params[1:]
     
     @staticmethod
@@ -1193,17 +1579,13 @@ class FactorProcess:
         return ema
     
     def _get_daily_data(self, name, stocks, date, offset, datelist=None):
-        dat = getattr(self, name, None)
-        if dat is None:
-            raise AttributeError("{} object has no attr: {}".format(self.__class__.__name__, name))
-        
-        dat = dat.loc[stocks, :].T
         if datelist is None:
-            datelist = dat.index.tolist()
+            datelist = self.data.get_dates(name).tolist()
         idx = self._get_date_idx(date, datelist)
         start_idx, end_idx = max(idx-offset+1, 0), idx+1
         date_period = datelist[start_idx:end_idx]
-        dat = dat.loc[date_period, :]
+        dat = self.data.read_window(name, stocks, date_period[0], date_period[-1])
+        dat = dat.T.reindex(date_period)
         return dat
     
     def cal_MACD(self, stocks, date, params=(12,26,9)):
@@ -1237,7 +1619,7 @@ class FactorProcess:
 
         delta = close - close.shift(1)
         tmp1 = delta.where(delta > 0, 0)
-        tmp2 = delta.applymap(abs)
+        tmp2 = delta.abs()
         rsi = 100 * self.get_sma(tmp1, n, 1) / self.get_sma(tmp2, n, 1)
         
         return rsi.iloc[-1, :].T.values
@@ -1253,25 +1635,9 @@ class FactorProcess:
         return bias.iloc[-1, :].T.values
     
     def _get_date_idx(self, date, datelist=None, ensurein=False):
-        msg = """Date {} not in current tradedays list. If this date value is certainly a tradeday,  
-              please reset tradedays list with longer periods or higher frequency."""
-        date = pd.to_datetime(date)
         if datelist is None:
             datelist = self.trade_days
-        try:
-            datelist = sorted(datelist)
-            idx = datelist.index(date)
-        except ValueError:
-            if ensurein:
-                raise IndexError(msg.format(str(date)[:10]))
-            dlist = list(datelist)
-            dlist.append(date)
-            dlist.sort()
-            idx = dlist.index(date) 
-            if idx == len(dlist)-1:
-                raise IndexError(msg.format(str(date)[:10]))
-            return idx - 1
-        return idx
+        return TradingCalendar.of(datelist).locate(date, ensurein)
     
     def _get_date(self, date, offset=0, datelist=None):
         if datelist is None:
@@ -1401,31 +1767,9 @@ class FactorProcess:
             dat.index.name = "code"
         return dat
     
-if __name__ == "__main__":
-    updatefreq = input("Choose update frequency between 'w' and 'M': ")
-    z = FactorProcess(updatefreq)
-    if updatefreq == 'M':
-        dates = [d for d in z.month_map.keys()][-2:]
-    elif updatefreq == 'w':
-        lastThursday =  toffsets.datetime.now()
-        daydelta = toffsets.DateOffset(n=1)
-        while lastThursday.weekday() != calendar.THURSDAY:
-            lastThursday -= daydelta
-        lastThursday = datetime.combine(lastThursday, time.min)
-        dates = [lastThursday]
-    else:
-        raise TypeError(f"Current frequency type {updatefreq} is not supported!")
+FactorProcess.registry = default_registry()
 
-    w.start()
-    for date in dates:
-        try:
-            sname = str(date)[:10]
-            z.create_factor_file(date, os.path.join(WORK_PATH, "factors", f"{sname}.csv"))
-        except FileAlreadyExistError:
-            print(f"{date}'s data already exists.")
-            continue
-        else:
-            date = str(date)[:10]
-            print(f"Create {date}'s data complete.")
-    w.close()
-                 
+if __name__ == "__main__":
+    #非交互运行, 参数见batch_runner.py
+    from batch_runner import main
+    main()
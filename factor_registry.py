@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Declarative registry of the factor groups and the shared intermediates
+they read, and the per-date plan that evaluates only what the requested
+factors need, every intermediate once.
+
+    FactorProcess.registry.register("my_group", "_get_my_group", args=("stocks", "tdate"),
+                                    outputs=["MY_FACTOR"], inputs={"pct_chg_d": 60})
+"""
+import copy
+
+class Node:
+    """
+        One registry entry:
+            func     --FactorProcess method name, or a module level function
+                       taking the FactorProcess first
+            args     --names resolved per date, from the context (stocks,
+                       tdate, caldate, fcaldate, dates_d, window) or intermediates
+            outputs  --columns produced, empty for intermediates
+            inputs   --{intermediate: rows of its daily window needed}
+            params   --extra keyword arguments
+            freqs    --update frequencies the node runs in
+            cross_sectional --whether a row depends on the other stocks
+                       (regressions/standardization over the universe);
+                       such groups are never split into stock shards
+    """
+    def __init__(self, name, func, args=(), outputs=(), inputs=None, params=None, freqs=('w', 'M'),
+                 cross_sectional=False):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.outputs = list(outputs)
+        self.inputs = dict(inputs or {})
+        self.params = dict(params or {})
+        self.freqs = tuple(freqs)
+        self.cross_sectional = cross_sectional
+
+    def call_args(self, ctx):
+        return tuple(ctx[a] for a in self.args)
+
+    def __repr__(self):
+        return f"Node({self.name!r}, {self.func!r})"
+
+class FactorRegistry:
+    def __init__(self):
+        self.producers = {}
+        self.intermediates = {}
+
+    def copy(self):
+        return copy.deepcopy(self)
+
+    def register(self, name, func, args=(), outputs=(), inputs=None, params=None, freqs=('w', 'M'),
+                 cross_sectional=False):
+        """Add (or replace) a factor group producing outputs."""
+        for dep in (inputs or {}):
+            if dep not in self.intermediates:
+                raise KeyError(f"Unknown intermediate {dep}, register it first.")
+        self.producers[name] = Node(name, func, args, outputs, inputs, params, freqs, cross_sectional)
+        return self.producers[name]
+
+    def intermediate(self, name, func, args=(), inputs=None, params=None):
+        """Add a shared intermediate, evaluated at most once per date."""
+        for dep in (inputs or {}):
+            if dep not in self.intermediates:
+                raise KeyError(f"Unknown intermediate {dep}, register it first.")
+        self.intermediates[name] = Node(name, func, args, (), inputs, params)
+        return self.intermediates[name]
+
+    def targets(self, freq):
+        """Every output column of freq, in registration order."""
+        return [col for node in self.producers.values() if freq in node.freqs for col in node.outputs]
+
+    def plan(self, columns, freq):
+        """
+            Groups producing columns (registration order) and the
+            intermediates they need as [(node, window)], dependencies
+            first, each window the largest any consumer asked for.
+        """
+        wanted = set(columns)
+        groups = [node for node in self.producers.values()
+                  if freq in node.freqs and wanted & set(node.outputs)]
+        unknown = wanted.difference(col for node in groups for col in node.outputs)
+        if unknown:
+            raise KeyError(f"No factor group produces {sorted(unknown)} in freq {freq}.")
+
+        windows, order = {}, []
+        def visit(name, window):
+            windows[name] = max(windows.get(name, 0), window or 0)
+            for dep, rows in self.intermediates[name].inputs.items():
+                visit(dep, max(rows or 0, windows[name]))
+            if name not in order:
+                order.append(name)
+        for node in groups:
+            for dep, rows in node.inputs.items():
+                visit(dep, rows)
+        #后序遍历, 依赖在前
+        return [(self.intermediates[name], windows[name]) for name in order], groups
+
+def default_registry():
+    """The factor groups of FactorProcess; the outputs declared here are the columns each group yields."""
+    reg = FactorRegistry()
+    #Barra行情因子共用的日频收益窗口, 含基准指数
+    reg.intermediate("pct_chg_d", "_daily_window", args=("stocks", "tdate", "window", "dates_d"),
+                     params={"name": "pct_chg", "extra": ("000300.SH",)})
+    reg.intermediate("log_ret_d", "_log_returns", args=("pct_chg_d",), inputs={"pct_chg_d": None})
+
+    reg.register("value", "_get_value_data", ("stocks", "caldate"), 
+                 ["EP", "EPcut", "BP", "SP", 
+                  "NCFP", "OCFP", "DP", "G/PE"])
+    reg.register("growth", "_get_growth_data", ("stocks", "fcaldate"), 
+                 ["Sales_G_q", "Profit_G_q", "OCF_G_q", "ROE_G_q"])
+    reg.register("finance", "_get_finance_data", ("stocks", "fcaldate"), 
+                 ["ROE_q", "ROE_ttm", 
+                  "ROA_q", "ROA_ttm", 
+                  "grossprofitmargin_q", "grossprofitmargin_ttm", 
+                  "profitmargin_q", "profitmargin_ttm",
+                  "assetturnover_q", "assetturnover_ttm", 
+                  "operationcashflowratio_q", "operationcashflowratio_ttm"])
+    reg.register("leverage", "_get_leverage_data", ("stocks", "fcaldate"), 
+                 ["financial_leverage", "debtequityratio", 
+                  "cashratio", "currentratio"])
+    reg.register("cal", "_get_cal_data", ("stocks", "tdate"), 
+                 ["ln_capital", 
+                  "HAlpha", "return_1m", "return_3m", "return_6m", "return_12m", 
+                  "wgt_return_1m", "wgt_return_3m", "wgt_return_6m", "wgt_return_12m",
+                  "exp_wgt_return_1m",  "exp_wgt_return_3m",  "exp_wgt_return_6m", "exp_wgt_return_12m",
+                  "std_1m", "std_3m", "std_6m", "std_12m",
+                  "beta",
+                  "turn_1m", "turn_3m", "turn_6m", "turn_12m",
+                  "bias_turn_1m", "bias_turn_3m", "bias_turn_6m", "bias_turn_12m",
+                  "holder_avgpctchange"])
+    reg.register("tech", "_get_tech_data", ("stocks", "tdate"), 
+                 ["MACD", "DEA", "DIF", "RSI", "PSY", "BIAS"])
+    #LNCAP/MIDCAP为全市场截面回归与标准化, 分片时整体计算
+    reg.register("barra_size", "_get_size_barra_data", ("stocks", "tdate"),
+                 ["LNCAP_barra", "MIDCAP_barra"], freqs=('M',), cross_sectional=True)
+    #Barra行情因子各自一组, 只取自己的窗口
+    #BETA/HALPHA/HSIGMA 504+4日
+    reg.register("barra_regress", "_get_regress_barra", ("stocks", "tdate", "dates_d"),
+                 ["BETA_barra", "HSIGMA_barra", "HALPHA_barra"], inputs={"pct_chg_d": 508}, 
+                 params={"params": (4, 504, 252, True, "000300.SH")}, freqs=('M',))
+    reg.register("barra_dastd", "_get_dastd_barra", ("stocks", "tdate", "dates_d"),
+                 ["DASTD_barra"], inputs={"pct_chg_d": 252}, 
+                 params={"params": (252, 42)}, freqs=('M',))
+    reg.register("barra_cmra", "_get_cmra_barra", ("stocks", "tdate", "dates_d"),
+                 ["CMRA_barra"], inputs={"pct_chg_d": 252, "log_ret_d": 252}, 
+                 params={"params": (12, 21)}, freqs=('M',))
+    reg.register("barra_liquidity", "_get_liquidity_barra", ("stocks", "tdate"),
+                 ["STOM_barra", "STOQ_barra", "STOA_barra"], 
+                 params={"params": (21, 1, 3, 12)}, freqs=('M',))
+    #RSTR 252+11日
+    reg.register("barra_rstr", "_get_rstr_barra", ("stocks", "tdate", "dates_d"),
+                 ["RSTR_barra"], inputs={"log_ret_d": 263}, 
+                 params={"params": (252, 126, 11, "000300.SH")}, freqs=('M',))
+    reg.register("barra_finance", "_get_barra_finance_data", ("stocks", "tdate"),
+                 ["MLEV_barra", "BLEV_barra", "DTOA_barra", "BTOP_barra", 
+                  "ETOP_barra", "CETOP_barra", "EGRO_barra", "SGRO_barra"], freqs=('M',))
+    return reg
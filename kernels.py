@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized kernels over stocks×dates panels, evaluated for the whole
+stock axis at once instead of DataFrame.apply(axis=1).
+"""
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+def _as_values(df):
+    return np.asarray(df.values if hasattr(df, 'values') else df, dtype=float)
+
+def _wrap_columns(res, df):
+    if isinstance(df, pd.DataFrame):
+        return pd.Series(res, index=df.columns)
+    return res
+
+def _design(X, intercept=True):
+    X = np.asarray(X, dtype=float)
+    if X.ndim == 1:
+        X = X.reshape(-1, 1)
+    #与sm.add_constant(has_constant='skip')一致, 已含非零常数列时不再添加
+    nonzero_const = (np.ptp(X, axis=0) == 0) & np.all(X != 0, axis=0)
+    if intercept and not nonzero_const.any():
+        X = np.column_stack([np.ones(len(X)), X])
+    return X
+
+def wls(X, Y, intercept=True, weights=1):
+    """
+        Closed-form (weighted) least squares of every column of Y on the
+        same X in one solve. Returns params laid out like statsmodels
+        result.params: (k,) for 1-D Y, (k, n_cols) otherwise, the constant
+        first when intercept.
+    """
+    X, Y = _design(X, intercept), np.asarray(Y, dtype=float)
+    sw = np.sqrt(np.broadcast_to(np.asarray(weights, dtype=float), (len(X),)))
+    Xw = X * sw[:, None]
+    Yw = Y * (sw if Y.ndim == 1 else sw[:, None])
+    params, *_ = np.linalg.lstsq(Xw, Yw, rcond=None)
+    return params
+
+def wls_nan(x, Y, intercept=True, weights=1):
+    """
+        Per-column (weighted) simple regression of Y on a single regressor
+        x, each column using only its own rows where both x and y are 
+        present, so a column with gaps is not dropped. Returns intercept,
+        slope and residual std (ddof=0) arrays, nan for columns with fewer
+        than 2 (1 without intercept) observations. Leading axes are batch
+        axes: x (..., n) with Y (..., n, cols) solves them all at once.
+    """
+    x = np.asarray(x, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    if Y.ndim == x.ndim:
+        Y = Y[..., None]
+    x = x[..., None]
+    w = np.asarray(weights, dtype=float)
+    if w.ndim:
+        w = w[:, None]
+    valid = np.isfinite(Y) & np.isfinite(x)
+    W = np.where(valid, w, 0)
+    xv, yv = np.where(valid, x, 0), np.where(valid, Y, 0)
+    sw, sx, sy = W.sum(axis=-2), (W*xv).sum(axis=-2), (W*yv).sum(axis=-2)
+    sxx, sxy = (W*xv*xv).sum(axis=-2), (W*xv*yv).sum(axis=-2)
+    nobs = valid.sum(axis=-2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if intercept:
+            slope = (sw*sxy - sx*sy) / (sw*sxx - sx*sx)
+            const = (sy - slope*sx) / sw
+            const[nobs < 2] = slope[nobs < 2] = np.nan
+        else:
+            slope = sxy / sxx
+            const = np.zeros_like(slope)
+            slope[nobs < 1] = np.nan
+        resid = np.where(valid, Y - (const[..., None, :] + x*slope[..., None, :]), 0)
+        rmean = resid.sum(axis=-2) / nobs
+        sigma = np.sqrt((np.where(valid, resid - rmean[..., None, :], 0)**2).sum(axis=-2) / nobs)
+    return const, slope, sigma
+
+def shifted_windows(values, window, shift):
+    """
+        Read-only (shift, window, ...) view of the windows starting at rows
+        1..shift of the last window+shift rows of values.
+    """
+    values = np.ascontiguousarray(values, dtype=float)[-(window+shift):]
+    strides = (values.strides[0],) + values.strides
+    return np.lib.stride_tricks.as_strided(values[1:], (shift, window) + values.shape[1:],
+                                           strides, writeable=False)
+
+def shifted_wls(x, Y, weights, shift, intercept=True, nan_tolerant=False):
+    """
+        Regressions of every column of Y on x over the shift overlapping
+        windows (window = len(weights)) of a window+shift row block, solved
+        as one (shift, window, cols) tensor. Returns intercept, slope and
+        residual std as (shift, cols) arrays. Unless nan_tolerant, a column
+        with any nan in a window (or a nan in x) is nan for that window.
+    """
+    window = len(weights)
+    xs, Ys = shifted_windows(np.asarray(x, dtype=float), window, shift), shifted_windows(Y, window, shift)
+    const, slope, sigma = wls_nan(xs, Ys, intercept, weights)
+    if not nan_tolerant:
+        gaps = np.isnan(Ys).any(axis=-2) | np.isnan(xs).any(axis=-1)[:, None]
+        const[gaps] = slope[gaps] = sigma[gaps] = np.nan
+    return const, slope, sigma
+
+def shift_kernel(weights, shift):
+    """
+        Row weights over a window+shift block equal to the average of the
+        weights laid at offsets 1..shift: averaging shift weighted window
+        sums becomes one dot product.
+    """
+    window = len(weights)
+    kernel = np.zeros(window + shift)
+    for i in range(1, shift+1):
+        kernel[i:i+window] += weights
+    return kernel / shift
+
+def rstr(stk_ret, bm_ret, weights, shift, log_ret=False):
+    """
+        Barra RSTR over a dates×stocks block of window+shift returns: the
+        shift-averaged weighted sum of log excess returns (nan as 0). With
+        log_ret the returns are already log(1+r).
+    """
+    stk, bm = _as_values(stk_ret), np.asarray(bm_ret, dtype=float).reshape(-1, 1)
+    excess = stk - bm if log_ret else np.log(1 + stk) - np.log(1 + bm)
+    kernel = shift_kernel(np.asarray(weights, dtype=float), shift)[-len(excess):]
+    return _wrap_columns(kernel @ np.where(np.isnan(excess), 0, excess), stk_ret)
+
+def last_per_period(df, freq='y'):
+    """
+        Last row of every freq period of a date-indexed frame, labelled by
+        the period end (nan rows for empty periods); the vectorized form of
+        groupby(pd.Grouper(freq=freq)).apply(lambda df: df.iloc[-1]).
+    """
+    df = df.sort_index()
+    pos = pd.Series(np.arange(len(df)), index=df.index).resample(freq).max()
+    found = pos.notna().values
+    values = np.full((len(pos), df.shape[1]), np.nan)
+    values[found] = np.asarray(df.values, dtype=float)[pos.values[found].astype(int)]
+    return pd.DataFrame(values, index=pos.index, columns=df.columns)
+
+def growth_rate(panel, end_dates, periods=5):
+    """
+        Slope of each column regressed on 1..periods over the last periods
+        rows up to its own end date, divided by the window mean. Columns 
+        whose window is incomplete, holds nan or ends after the panel are
+        nan. end_dates is aligned on the columns of panel; an end date that
+        is not a row label ends the window at the row before it.
+    """
+    values = np.asarray(panel.values, dtype=float)
+    nrows, ncols = values.shape
+    labels = pd.DatetimeIndex(panel.index).values
+    ends = pd.DatetimeIndex(pd.Series(end_dates).reindex(panel.columns)).values
+    ends = ends.astype(labels.dtype)
+    pos = np.searchsorted(labels, ends, side='left')
+    exact = (pos < nrows) & (labels[np.minimum(pos, nrows-1)] == ends)
+    end = np.where(exact, pos, pos - 1)
+    invalid = np.isnat(ends) | (~exact & (pos == nrows)) | (end - periods + 1 < 0)
+    
+    rows = end[None, :] + np.arange(1-periods, 1)[:, None]
+    window = values[np.clip(rows, 0, nrows-1), np.arange(ncols)[None, :]]
+    xc = np.arange(1, periods+1) - (periods + 1) / 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (xc[:, None] * window).sum(axis=0) / (xc**2).sum()
+        res = slope / window.mean(axis=0)
+    res[invalid | np.isnan(window).any(axis=0)] = np.nan
+    return pd.Series(res, index=panel.columns)
+
+def _rolling_windows(values, window):
+    """Read-only (n-window+1, window, cols) view over the row windows of values."""
+    values = np.ascontiguousarray(values, dtype=float)
+    n, m = values.shape
+    s0, s1 = values.strides
+    return np.lib.stride_tricks.as_strided(values, (max(n-window+1, 0), window, m), 
+                                           (s0, s0, s1), writeable=False)
+
+def prefix_sums(values):
+    """
+        (n+1, ...) running sums over the rows of values, nan as 0: the rows
+        [start, stop) of values sum to res[stop] - res[start].
+    """
+    values = np.asarray(values, dtype=float)
+    res = np.zeros((len(values)+1,) + values.shape[1:])
+    np.cumsum(np.where(np.isnan(values), 0, values), axis=0, out=res[1:])
+    return res
+
+def _nan_windows(values, window):
+    #各窗口内是否含nan
+    counts = np.vstack([np.zeros((1, values.shape[1])), np.cumsum(np.isnan(values), axis=0)])
+    return (counts[window:] - counts[:-window]) > 0
+
+def _as_panel(res, df, window):
+    if isinstance(df, pd.DataFrame):
+        return pd.DataFrame(res, index=df.index[window-1:], columns=df.columns)
+    return res
+
+def cmra(log_ret, months=12, days_per_month=21):
+    """
+        Barra CMRA of a dates×stocks window of log returns (latest date 
+        last): max minus min over i=1..months of the sum of the last 
+        i*days_per_month returns, read off one reversed cumulative sum.
+    """
+    values = _as_values(log_ret)
+    rev = np.cumsum(values[::-1], axis=0)
+    ks = np.minimum(np.arange(1, months+1) * days_per_month, len(values)) - 1
+    z = rev[ks]
+    return _wrap_columns(z.max(axis=0) - z.min(axis=0), log_ret)
+
+def rolling_cmra(log_ret, months=12, days_per_month=21, ends=None):
+    """
+        CMRA for every end date of a dates×stocks panel in one pass; rows
+        are the end dates with a full window, windows holding nan are nan.
+        With ends (row positions) only those windows are evaluated, cut at
+        the first row like cmra() on a shorter block, as a (len(ends), 
+        stocks) array.
+    """
+    values = _as_values(log_ret)
+    window = months * days_per_month
+    csum = prefix_sums(values)
+    if ends is None:
+        stops = np.arange(window, len(values)+1)
+    else:
+        stops = np.asarray(ends, dtype=int) + 1
+    starts = np.maximum(stops - window, 0)
+    zmax = zmin = csum[stops] - csum[np.maximum(stops-days_per_month, starts)]
+    for i in range(2, months+1):
+        z = csum[stops] - csum[np.maximum(stops-i*days_per_month, starts)]
+        zmax, zmin = np.maximum(zmax, z), np.minimum(zmin, z)
+    res = zmax - zmin
+    nans = prefix_sums(np.isnan(values))
+    res[(nans[stops] - nans[starts]) > 0] = np.nan
+    return _as_panel(res, log_ret, window) if ends is None else res
+
+def dastd(returns, weights):
+    """
+        Barra DASTD of a dates×stocks window: sqrt of the weighted sum of
+        squared deviations from the (unweighted) mean, one matrix-vector
+        product for all stocks.
+    """
+    values = _as_values(returns)
+    dev = values - values.mean(axis=0)
+    return _wrap_columns(np.sqrt(np.asarray(weights, dtype=float) @ dev**2), returns)
+
+def rolling_dastd(returns, weights):
+    """
+        DASTD for every end date of a dates×stocks panel in one pass, using
+        sum(w*(x-m)^2) = sum(w*x^2) - 2m*sum(w*x) + m^2*sum(w) over strided
+        window views; windows holding nan are nan.
+    """
+    values = _as_values(returns)
+    w = np.asarray(weights, dtype=float)
+    window = len(w)
+    wins = _rolling_windows(values, window)
+    mean = wins.mean(axis=1)
+    wx = np.einsum('j,tjn->tn', w, wins)
+    wxx = np.einsum('j,tjn->tn', w, _rolling_windows(values**2, window))
+    with np.errstate(invalid='ignore'):
+        res = np.sqrt(np.maximum(wxx - 2*mean*wx + mean**2 * w.sum(), 0))
+    res[_nan_windows(values, window)] = np.nan
+    return _as_panel(res, returns, window)
+
+@lru_cache(maxsize=64)
+def exp_weights(window=12, half_life=6):
+    """
+        Barra exponential weights 0.5**(k/half_life), k=window-1..0 (latest
+        day weighted 1). Read-only, shared by all callers.
+    """
+    weights = (np.asarray([0.5 ** (1 / half_life)] * window) ** np.arange(window))[::-1]
+    weights.flags.writeable = False
+    return weights
+
+@lru_cache(maxsize=64)
+def exp_day_weights(n, offset):
+    """
+        Day weights exp(-(n-1-j)/4/offset), j=0..n-1, of an n-day window, 
+        the latest day weighted 1. Read-only, shared by all callers.
+    """
+    weights = np.exp(-(n - 1 - np.arange(n)) / 4 / offset)
+    weights.flags.writeable = False
+    return weights
+
+class _PanelLocIndexer:
+    def __init__(self, panel):
+        self.panel = panel
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        return self.panel.take(rows, cols)
+
+class MaskedPanel:
+    """
+        stocks×dates values with two bool masks in place of sentinel values:
+            valid   --entry enters reductions (values is 0 elsewhere)
+            missing --no data for the stock on that date (not listed yet, 
+                      formerly marked with the sentinel); a window holding
+                      any missing entry reduces to nan for that stock
+    """
+    def __init__(self, values, valid, missing, index, columns):
+        self.values = values
+        self.valid = valid
+        self.missing = missing
+        self.index = pd.Index(index)
+        self.columns = pd.Index(columns)
+        self.loc = _PanelLocIndexer(self)
+        self._prefix = None
+
+    @classmethod
+    def from_frame(cls, df, valid=None, missing=None):
+        """
+            Panel of the values of df (frame or array); entries outside
+            valid (default: the finite ones) are left out of reductions.
+        """
+        values = _as_values(df)
+        if valid is None:
+            valid = np.isfinite(values)
+        else:
+            valid = np.asarray(valid, dtype=bool) & np.isfinite(values)
+        if missing is None:
+            missing = np.zeros(values.shape, dtype=bool)
+        index = df.index if isinstance(df, pd.DataFrame) else np.arange(len(values))
+        columns = df.columns if isinstance(df, pd.DataFrame) else np.arange(values.shape[1])
+        return cls(np.where(valid, values, 0), valid, np.asarray(missing, dtype=bool), index, columns)
+
+    @classmethod
+    def from_sentinel(cls, df, sentinel=1000):
+        """
+            Panel with the rules of FactorProcess._cal_func: nan entries are
+            left out, a row holding a value >= sentinel (inf included)
+            reduces to nan, other non-finite values propagate.
+        """
+        values = _as_values(df)
+        with np.errstate(invalid='ignore'):
+            missing = values >= sentinel
+        valid = ~np.isnan(values) & ~missing
+        index = df.index if isinstance(df, pd.DataFrame) else np.arange(len(values))
+        columns = df.columns if isinstance(df, pd.DataFrame) else np.arange(values.shape[1])
+        return cls(np.where(valid, values, 0), valid, missing, index, columns)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.valid.nbytes + self.missing.nbytes
+
+    @staticmethod
+    def _positions(labels, key):
+        if isinstance(key, slice):
+            return np.arange(len(labels))[labels.slice_indexer(key.start, key.stop, key.step)]
+        return labels.get_indexer(pd.Index(key))
+
+    def take(self, rows=slice(None), cols=slice(None)):
+        """Sub-panel, labels not found come back as rows/columns without data."""
+        rpos, cpos = self._positions(self.index, rows), self._positions(self.columns, cols)
+        ix = np.ix_(np.where(rpos < 0, 0, rpos), np.where(cpos < 0, 0, cpos))
+        absent = (rpos < 0)[:, None] | (cpos < 0)[None, :]
+        values = np.where(absent, 0, self.values[ix])
+        valid = self.valid[ix] & ~absent
+        missing = self.missing[ix] & ~absent
+        index = self.index[rpos] if (rpos >= 0).all() else pd.Index(rows)
+        columns = self.columns[cpos] if (cpos >= 0).all() else pd.Index(cols)
+        return MaskedPanel(values, valid, missing, index, columns)
+
+    def mean(self):
+        """Row mean over valid entries, nan for rows with missing entries."""
+        count = self.valid.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            res = self.values.sum(axis=1, dtype=float) / count
+        res[(count == 0) | self.missing.any(axis=1)] = np.nan
+        return pd.Series(res, index=self.index)
+
+    def std(self, ddof=0):
+        """Row std over valid entries (ddof=0 like np.nanstd), same rules as mean()."""
+        count = self.valid.sum(axis=1)
+        mean = self.mean().values
+        dev = np.where(self.valid, self.values - mean[:, None], 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            res = np.sqrt((dev**2).sum(axis=1) / (count - ddof))
+        res[(count - ddof <= 0) | np.isnan(mean)] = np.nan
+        return pd.Series(res, index=self.index)
+
+    def window_means(self, starts, ends):
+        """
+            Row means over the column windows [starts[k], ends[k]] (inclusive
+            positions), same rules as mean(), as a (rows, len(starts)) array.
+            The running sums behind them are built once per panel.
+        """
+        if self._prefix is None:
+            self._prefix = tuple(prefix_sums(a.T) for a in (self.values, self.valid, self.missing))
+        starts, stops = np.asarray(starts, dtype=int), np.asarray(ends, dtype=int) + 1
+        total, count, missing = (p[stops] - p[starts] for p in self._prefix)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            res = total / count
+        res[(count == 0) | (missing > 0)] = np.nan
+        return res.T
+
+    def to_frame(self, sentinel=1000):
+        """Legacy encoding: nan for invalid entries, sentinel for missing ones."""
+        values = np.where(self.valid, self.values, np.nan)
+        values[self.missing] = sentinel
+        return pd.DataFrame(values, index=self.index, columns=self.columns)
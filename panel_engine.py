@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Panel mode for historical backfills: the daily matrices are loaded once
+and the windowed factors of a whole date range are computed in one pass
+along the date axis, then written out as the usual per-date factor files.
+
+    z = PanelFactorProcess('M')
+    z.backfill(z.backfill_dates('2006-01-01', '2019-06-30'))
+"""
+import os
+import time
+import numpy as np
+import pandas as pd
+from factor_calculate import FactorProcess, FileAlreadyExistError, WORK_PATH
+from kernels import prefix_sums, rolling_cmra
+from tech_state import TechState
+from trading_calendar import TradingCalendar
+
+class PanelFactorProcess(FactorProcess):
+    """
+        FactorProcess whose windowed factors are read from panels built by
+        prepare(dates) instead of one window per call:
+            DIF/DEA/MACD/RSI/PSY/BIAS  --TechState stepped through hfq_close,
+                                         from the saved state or the cal_MACD
+                                         window before the first date
+            turn_*m/bias_turn_*m       --window means of running sums of
+                                         the preprocessed turnover
+            STOM/STOQ/STOA, CMRA       --window sums of running sums
+        BETA/HALPHA/HSIGMA, DASTD and RSTR keep their kernels but slice
+        in-memory daily arrays instead of re-reading windows. Dates that
+        were not prepared go through FactorProcess unchanged.
+    """
+    #回补不读写增量技术指标状态
+    tech_state_file = None
+    #技术指标面板的起点状态文件(只读), 早于首个日期时使用, None为从窗口起算
+    seed_state_file = FactorProcess.tech_state_file
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._daily = {}
+        self._panels = {}
+
+    def _daily_array(self, name):
+        #dates×stocks数组, 各matrix只整理一次
+        if name not in self._daily:
+            dat = getattr(self.data, name)
+            values, index, columns = np.asarray(dat.values, dtype=float), pd.Index(dat.index), pd.DatetimeIndex(dat.columns)
+            if not columns.is_monotonic_increasing:
+                order = np.argsort(columns.values, kind='stable')
+                values, columns = values[:, order], columns[order]
+            self._daily[name] = (np.ascontiguousarray(values.T), index, columns)
+        return self._daily[name]
+
+    def _get_daily_data(self, name, stocks, date, offset, datelist=None):
+        values, index, columns = self._daily_array(name)
+        if datelist is None:
+            datelist = columns
+        idx = self._get_date_idx(date, datelist)
+        date_period = list(datelist[max(idx-offset+1, 0):idx+1])
+        rpos = columns.get_indexer(date_period)
+        cpos = np.arange(len(index)) if stocks is None else index.get_indexer(stocks)
+        dat = values[np.ix_(np.where(rpos < 0, 0, rpos), np.where(cpos < 0, 0, cpos))]
+        dat[(rpos < 0)[:, None] | (cpos < 0)[None, :]] = np.nan
+        return pd.DataFrame(dat, index=date_period, columns=index if stocks is None else stocks)
+
+    def prepare(self, dates):
+        """Build the panels of every date in dates, keyed by the dates as passed."""
+        dates = [pd.Timestamp(d) for d in dates]
+        self._panels = {'tech': self._tech_panel(dates)}
+        if self.updatefreq == 'M':
+            self._panels['cmra'] = self._cmra_panel(dates, self.dates_d)
+            self._panels['liquidity'] = self._liquidity_panel(dates)
+        return self
+
+    def _tech_panel(self, dates):
+        values, index, columns = self._daily_array('hfq_close')
+        cal = TradingCalendar.of(columns)
+        wanted = {}
+        for date in dates:
+            try:
+                wanted.setdefault(cal.locate(date), []).append(date)
+            except IndexError:
+                continue
+        res = {}
+        if not wanted:
+            return res
+        close = pd.DataFrame(values, index=columns, columns=index)
+        state, start = self._tech_seed(close, min(wanted))
+        for pos in sorted(wanted):
+            state.advance(close.iloc[start:pos+1])
+            start = pos + 1
+            frame = state.frame()
+            for date in wanted[pos]:
+                res[date] = frame
+        return res
+
+    def _tech_seed(self, close, first):
+        """
+            (state, position to step from) for a panel starting at position
+            first of close: the saved state when it ends within a window
+            before first and still matches close, otherwise an empty state
+            stepped from the cal_MACD window of first, like _get_tech_state.
+        """
+        offset = max(self._tech_params["MACD"]) + 240
+        if self.seed_state_file is not None:
+            fpath = os.path.join(self.data.root, self.data.cache_dir, self.seed_state_file)
+            state = TechState.load(fpath, self._tech_params)
+            if state is not None and state.last_date in close.index:
+                last = close.index.get_loc(state.last_date)
+                dates = [d for d in state.dates if d is not None]
+                if last <= first and first - last < offset and \
+                        state.matches(close.reindex(dates).T):
+                    return state, last + 1
+        return TechState(close.columns, self._tech_params), max(first - offset + 1, 0)
+
+    def _cmra_panel(self, dates, dates_d, params=(12,21)):
+        #与_get_cmra_barra一致, 日期按dates_d定位
+        months, days_pm = params
+        values, index, columns = self._daily_array('pct_chg')
+        if not columns.equals(pd.DatetimeIndex(dates_d)):
+            return {}
+        ends, keys = [], []
+        for date in dates:
+            try:
+                ends.append(self._get_date_idx(date, dates_d))
+            except IndexError:
+                continue
+            keys.append(date)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            res = rolling_cmra(np.log(1 + values), months, days_pm, ends=ends)
+        return {date: pd.Series(row, index=index) for date, row in zip(keys, res)}
+
+    def _liquidity_panel(self, dates, params=(21,1,3,12)):
+        #与_get_liquidity_barra一致: amt/mkt_cap_float_d的nansum, 含inf的窗口记为inf
+        days_pm, freq1, freq2, freq3 = params
+        amt, index, columns = self._daily_array('amt')
+        cap, cap_index, cap_columns = self._daily_array('mkt_cap_float_d')
+        if not (index.equals(cap_index) and columns.equals(cap_columns)):
+            return {}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            share_turnover = amt / cap
+        infs = np.isinf(share_turnover)
+        csum, ninf = prefix_sums(np.where(infs, 0, share_turnover)), prefix_sums(infs)
+        cal = TradingCalendar.of(columns)
+        window = freq3 * days_pm
+        res = {}
+        for date in dates:
+            try:
+                stop = cal.locate(date) + 1
+            except IndexError:
+                continue
+            dat = pd.DataFrame(index=index)
+            for col, freq in zip(['STOM_barra', 'STOQ_barra', 'STOA_barra'], [freq1, freq2, freq3]):
+                start = max(stop - min(freq*days_pm, window), 0)
+                total = np.where(ninf[stop] > ninf[start], np.inf, csum[stop] - csum[start])
+                with np.errstate(divide='ignore'):
+                    val = np.log(total / freq)
+                dat[col] = np.where(np.isinf(val), -1e10, val)
+            res[date] = dat
+        return res
+
+    def _get_tech_data(self, stocks, tdate):
+        frame = self._panels.get('tech', {}).get(pd.Timestamp(tdate))
+        if frame is None:
+            return super()._get_tech_data(stocks, tdate)
+        cols = [c for t in self.tech_indicators for c in (["DIF", "DEA", "MACD"] if t == "MACD" else [t])]
+        return TechState.reindex(frame, stocks)[cols]
+
+    def _get_turnover_data(self, stocks, qdate, dates, params=(1,3,6,12)):
+        panel = self._turnover_preprocessed
+        windows = [(2, "y")] + [(offset, "M") for offset in params]
+        starts, ends = [], []
+        for offset, freq in windows:
+            pos = panel.columns.get_indexer(self._get_period_d(qdate, offset=-offset, freq=freq, datelist=dates))
+            #窗口须在换手率矩阵中连续
+            if not len(pos) or (pos < 0).any() or pos[-1] - pos[0] + 1 != len(pos):
+                return super()._get_turnover_data(stocks, qdate, dates, params)
+            starts.append(pos[0])
+            ends.append(pos[-1])
+        rpos = panel.index.get_indexer(stocks)
+        means = panel.window_means(starts, ends)[np.where(rpos < 0, 0, rpos)]
+        means[rpos < 0] = np.nan
+
+        res = pd.DataFrame(index=stocks)
+        for k, offset in enumerate(params, 1):
+            res[f"turn_{offset}m"] = means[:, k]
+            res[f"bias_turn_{offset}m"] = means[:, k] / means[:, 0] - 1
+        return res
+
+    def _get_cmra_barra(self, stocks, tdate, dates_d, params=(12,21)):
+        dat = self._panels.get('cmra', {}).get(pd.Timestamp(tdate))
+        if dat is None or tuple(params) != (12, 21):
+            return super()._get_cmra_barra(stocks, tdate, dates_d, params)
+        return pd.DataFrame({'CMRA_barra': dat.reindex(stocks)})
+
+    def _get_liquidity_barra(self, stocks, tdate, params=(21,1,3,12)):
+        dat = self._panels.get('liquidity', {}).get(pd.Timestamp(tdate))
+        if dat is None or tuple(params) != (21, 1, 3, 12):
+            return super()._get_liquidity_barra(stocks, tdate, params)
+        stocks = self._listed_stocks(tdate)
+        return dat.reindex(stocks, fill_value=-1e10)
+
+    def backfill(self, dates, savepath=None):
+        """
+            Write the factor files of dates into savepath (the factors folder
+            by default), skipping files that already exist.
+        """
+        if savepath is None:
+            savepath = os.path.join(WORK_PATH, "factors")
+        t0 = time.time()
+        self.prepare(dates)
+        print(f"Panels of {len(dates)} dates prepared in {time.time()-t0:.1f}s.")
+        for date in dates:
+            sname = str(date)[:10]
+            try:
+                self.create_factor_file(date, os.path.join(savepath, f"{sname}.csv"))
+            except FileAlreadyExistError:
+                print(f"{sname}'s data already exists.")
+            else:
+                print(f"Create {sname}'s data complete.")
+        print(f"Backfill of {len(dates)} dates done in {time.time()-t0:.1f}s.")
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Persisted per-stock state of the technical indicators (MACD/RSI/PSY/BIAS),
+so that a new trade date updates every stock in O(1) instead of reloading
+and recomputing a 266-day hfq_close window.
+"""
+import os
+import time
+import pickle
+import threading
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+#同一进程内各线程先按路径互斥, 再取文件锁
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+@contextmanager
+def file_lock(fpath):
+    """
+        Exclusive lock on fpath (through fpath.lock) held for the block,
+        across threads and processes sharing the file.
+    """
+    with _thread_locks_guard:
+        lock = _thread_locks.setdefault(os.path.abspath(fpath), threading.Lock())
+    with lock:
+        os.makedirs(os.path.dirname(fpath) or '.', exist_ok=True)
+        with open(fpath + '.lock', 'a+') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            else:
+                while True:
+                    try:
+                        f.seek(0)
+                        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        time.sleep(0.1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+class TechState:
+    """
+        State as of last_date for every stock of hfq_close:
+            ema1, ema2, dea  --MACD EMA accumulators (nan until seeded)
+            closes           --the last closes, enough for RSI/PSY/BIAS windows
+            up               --PSY up-day count over the last m close pairs
+            csum, cnan       --BIAS rolling sum / nan count of the last n closes
+        The recurrences are those of ewm(adjust=False, ignore_na=True) and
+        of the rolling windows used by FactorProcess.cal_*; building the
+        state over the same window the cal_* methods read gives the same
+        values. RSI keeps the repo's definition (SMA over the last n+1
+        closes only), so it is re-evaluated on the close buffer.
+    """
+    version = 1
+
+    def __init__(self, stocks, params):
+        self.params = {k: tuple(v) for k, v in params.items()}
+        self.stocks = pd.Index(stocks)
+        self.n1, self.n2, self.m = self.params['MACD']
+        self.n_rsi, self.n_psy, self.n_bias = self.params['RSI'][0], self.params['PSY'][0], self.params['BIAS'][0]
+        self.buflen = max(self.n_rsi + 1, self.n_psy + 1, self.n_bias)
+        nstk = len(self.stocks)
+        self.ema1, self.ema2, self.dea = (np.full(nstk, np.nan) for _ in range(3))
+        self.closes = np.full((nstk, self.buflen), np.nan)
+        self.dates = [None] * self.buflen
+        self.up = np.zeros(nstk)
+        self.csum, self.cnan = np.zeros(nstk), np.full(nstk, float(self.n_bias))
+        self.last_date = None
+
+    @classmethod
+    def build(cls, close, params):
+        """Fresh state advanced over close (dates×stocks)."""
+        state = cls(close.columns, params)
+        state.advance(close)
+        return state
+
+    @staticmethod
+    def _ewm_step(acc, x, alpha):
+        #adjust=False, ignore_na=True: nan不更新, 首个有效值作为初值
+        return np.where(np.isnan(x), acc, np.where(np.isnan(acc), x, (1-alpha)*acc + alpha*x))
+
+    def _extend(self, stocks):
+        new = pd.Index(stocks).difference(self.stocks)
+        if not len(new):
+            return
+        k = len(new)
+        self.stocks = self.stocks.append(new)
+        self.ema1, self.ema2, self.dea = (np.append(a, np.full(k, np.nan)) for a in (self.ema1, self.ema2, self.dea))
+        self.closes = np.vstack([self.closes, np.full((k, self.buflen), np.nan)])
+        self.up = np.append(self.up, np.zeros(k))
+        self.csum, self.cnan = np.append(self.csum, np.zeros(k)), np.append(self.cnan, np.full(k, float(self.n_bias)))
+
+    def step(self, date, close):
+        """Take in one trade date, close aligned on self.stocks."""
+        c = np.asarray(close, dtype=float)
+        self.ema1 = self._ewm_step(self.ema1, c, 2/(self.n1+1))
+        self.ema2 = self._ewm_step(self.ema2, c, 2/(self.n2+1))
+        self.dea = self._ewm_step(self.dea, self.ema1 - self.ema2, 2/(self.m+1))
+
+        buf = self.closes
+        with np.errstate(invalid='ignore'):
+            #PSY: 新进入与移出窗口的相邻收盘价对
+            enter = c > buf[:, -1]
+            leave = buf[:, -self.n_psy] > buf[:, -self.n_psy-1]
+        self.up += enter.astype(float) - leave.astype(float)
+        #BIAS: 最近n_bias个收盘价的和与缺失数
+        out = buf[:, -self.n_bias]
+        self.csum += np.nan_to_num(c) - np.nan_to_num(out)
+        self.cnan += np.isnan(c).astype(float) - np.isnan(out).astype(float)
+
+        self.closes = np.column_stack([buf[:, 1:], c])
+        self.dates = self.dates[1:] + [pd.Timestamp(date)]
+        self.last_date = pd.Timestamp(date)
+
+    def advance(self, close):
+        """Take in the dates of close (dates×stocks) after last_date, in order."""
+        close = close.sort_index()
+        if self.last_date is not None:
+            close = close.loc[close.index > self.last_date]
+        self._extend(close.columns)
+        close = close.reindex(columns=self.stocks)
+        for date, row in zip(close.index, close.values):
+            self.step(date, row)
+
+    def matches(self, close):
+        """
+            Whether the buffered closes still agree with close (stocks×dates
+            over the buffered dates); a mismatch means history was rewritten
+            (e.g. adjfactor changed) and the state has to be rebuilt.
+        """
+        dates = [d for d in self.dates if d is not None]
+        if not dates:
+            return False
+        try:
+            cur = close.reindex(index=self.stocks, columns=dates).values
+        except Exception:
+            return False
+        return np.allclose(cur, self.closes[:, -len(dates):], rtol=1e-10, atol=0, equal_nan=True)
+
+    def _rsi(self):
+        closes = self.closes[:, -(self.n_rsi+1):]
+        delta = closes[:, 1:] - closes[:, :-1]
+        with np.errstate(invalid='ignore'):
+            #与cal_RSI一致: 首行差分为nan, tmp1取0, tmp2忽略
+            tmp1 = np.column_stack([np.zeros(len(delta)), np.where(delta > 0, delta, 0)])
+            tmp2 = np.column_stack([np.full(len(delta), np.nan), np.abs(delta)])
+        alpha = 1 / self.n_rsi
+        sma1 = sma2 = np.full(len(delta), np.nan)
+        for j in range(tmp1.shape[1]):
+            sma1 = self._ewm_step(sma1, tmp1[:, j], alpha)
+            sma2 = self._ewm_step(sma2, tmp2[:, j], alpha)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return 100 * sma1 / sma2
+
+    def frame(self, stocks=None):
+        """DIF/DEA/MACD/RSI/PSY/BIAS as of last_date."""
+        dif = self.ema1 - self.ema2
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ma = np.where(self.cnan > 0, np.nan, self.csum / self.n_bias)
+            bias = 100 * (self.closes[:, -1] - ma) / ma
+        psy = 100 * self.up / self.n_psy
+        #窗口不足时与rolling一致为nan
+        filled = sum(d is not None for d in self.dates)
+        if filled < self.n_psy + 1:
+            psy = np.full(len(psy), np.nan)
+        res = pd.DataFrame({'DIF': dif, 'DEA': self.dea, 'MACD': 2*(dif - self.dea),
+                            'RSI': self._rsi(), 'PSY': psy, 'BIAS': bias}, index=self.stocks)
+        return res if stocks is None else self.reindex(res, stocks)
+
+    @staticmethod
+    def reindex(frame, stocks):
+        """Rows of stocks of a frame(), absent stocks as the cal_* windows see them."""
+        res = frame.reindex(stocks)
+        if frame['PSY'].notna().any():
+            #不在hfq_close中的股票无上涨日, PSY为0
+            res.loc[~pd.Index(stocks).isin(frame.index), 'PSY'] = 0
+        return res
+
+    def save(self, fpath):
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        #各写入方使用自己的临时文件, 整体替换
+        tmpfile = f'{fpath}.{os.getpid()}-{threading.get_ident()}.tmp'
+        with open(tmpfile, 'wb') as f:
+            pickle.dump(self, f)
+        os.replace(tmpfile, fpath)
+
+    @classmethod
+    def load(cls, fpath, params):
+        if not os.path.exists(fpath):
+            return None
+        try:
+            with open(fpath, 'rb') as f:
+                state = pickle.load(f)
+        except Exception:
+            return None
+        if getattr(state, 'version', None) != cls.version or \
+                state.params != {k: tuple(v) for k, v in params.items()}:
+            return None
+        return state
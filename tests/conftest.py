@@ -0,0 +1,28 @@
+import os
+import sys
+import pytest
+
+#测试直接导入仓库根目录下的模块
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def memory_process(tmp_path):
+    """
+        Factory of FactorProcess instances over a Data rooted at tmp_path
+        whose matrices ({name: frame}) are held in its cache.
+    """
+    import factor_calculate as fc
+    class MemoryData(fc.Data):
+        root = str(tmp_path)
+    def make(frames, updatefreq='M', cls=None, **attrs):
+        data = MemoryData('csv')
+        for name, dat in frames.items():
+            data.cache.put(name, dat)
+        z = object.__new__(cls or fc.FactorProcess)
+        z.data, z.sentinel, z.updatefreq = data, 1000, updatefreq
+        if 'pct_chg' in frames:
+            z.dates_d = sorted(frames['pct_chg'].columns)
+        for name, value in attrs.items():
+            setattr(z, name, value)
+        return z
+    return make
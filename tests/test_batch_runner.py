@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+batch_runner: date chunks, skipping existing files, failures and the
+DataServer lifecycle, with the process pool run in-process.
+"""
+from concurrent.futures import Future
+import pandas as pd
+import pytest
+import batch_runner as br
+import factor_calculate as fc
+from factor_calculate import FileAlreadyExistError
+
+DATES = list(pd.bdate_range('2019-01-02', periods=5))
+
+class InlinePool:
+    #在当前进程内执行任务的ProcessPoolExecutor替身
+    initargs = None
+
+    def __init__(self, max_workers, initializer, initargs):
+        InlinePool.initargs = initargs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+class RecordingServer:
+    #记录start/close的DataServer替身
+    instances = []
+
+    def __init__(self, data, names, arrays=None):
+        self.names, self.arrays, self.closed = list(names), dict(arrays or {}), False
+        self.instances.append(self)
+
+    def start(self):
+        return self
+
+    def close(self):
+        self.closed = True
+
+class Worker:
+    def __init__(self, fail=()):
+        self.fail, self.files, self.group_timings = set(fail), [], {}
+
+    def create_factor_file(self, date, fpath):
+        if date in self.fail:
+            raise ValueError(f'no data on {date}')
+        self.files.append(fpath)
+        self.group_timings['tech'] = 0.0
+
+@pytest.fixture
+def runner(tmp_path, monkeypatch):
+    class RootData(fc.Data):
+        root = str(tmp_path)
+    tasks = []
+    run_dates = br._run_dates
+    RecordingServer.instances = []
+    monkeypatch.setattr(br, 'Data', RootData)
+    monkeypatch.setattr(br, 'ProcessPoolExecutor', InlinePool)
+    monkeypatch.setattr(br, 'DataServer', RecordingServer)
+    monkeypatch.setattr(br, '_run_dates', lambda dates, savepath: tasks.append(dates) or run_dates(dates, savepath))
+    monkeypatch.setattr(fc.FactorProcess, 'sync_tradedays', classmethod(lambda cls, data: None))
+    monkeypatch.setattr(fc.FactorProcess, 'shared_turnover', classmethod(lambda cls, data: {'turnover_csum': None}))
+    monkeypatch.setattr(br, '_worker', Worker())
+    return tmp_path / 'factors', tasks
+
+@pytest.mark.parametrize('n, sizes', [(1, [7]), (2, [4, 3]), (3, [3, 3, 1]), (7, [1]*7), (10, [1]*7)])
+def test_chunks_cover_the_dates_in_order(n, sizes):
+    dates = list(range(7))
+    chunks = br._chunks(dates, n)
+    assert [len(c) for c in chunks] == sizes
+    assert sum(chunks, []) == dates
+
+def test_chunks_of_no_dates():
+    assert br._chunks([], 4) == []
+
+def test_run_skips_existing_files(runner):
+    savepath, tasks = runner
+    savepath.mkdir()
+    for date in DATES[1:3]:
+        open(br.factor_path(str(savepath), date), 'w').close()
+    res = br.run('M', dates=DATES, workers=1, savepath=str(savepath))
+    assert tasks == [[DATES[0]], [DATES[3]], [DATES[4]]]
+    #as_completed的顺序不定
+    assert sorted(res) == [DATES[0], DATES[3], DATES[4]]
+    assert all(status == 'done' for status, _ in res.values())
+    assert sorted(br._worker.files) == [br.factor_path(str(savepath), d) for d in [DATES[0], DATES[3], DATES[4]]]
+    assert not RecordingServer.instances
+
+    #全部已存在时不启动进程池
+    tasks.clear()
+    for date in DATES:
+        open(br.factor_path(str(savepath), date), 'w').close()
+    assert br.run('M', dates=DATES, workers=1, savepath=str(savepath)) == {}
+    assert tasks == []
+
+def test_panel_run_dispatches_chunks(runner):
+    savepath, tasks = runner
+    br.run('M', dates=DATES, workers=2, savepath=str(savepath), panel=True, share=False)
+    assert tasks == [DATES[:3], DATES[3:]]
+
+def test_failed_dates_keep_the_traceback(runner, monkeypatch, capsys):
+    savepath, tasks = runner
+    monkeypatch.setattr(br, '_worker', Worker(fail=[DATES[1]]))
+    res = br._run_dates(DATES[:3], str(savepath))
+    assert [r[1] for r in res] == ['done', f"failed: ValueError('no data on {DATES[1]}')", 'done']
+    assert res[0][4] is None and res[2][4] is None
+    assert 'Traceback' in res[1][4] and 'create_factor_file' in res[1][4]
+
+    res = br.run('M', dates=DATES[:3], workers=1, savepath=str(savepath))
+    assert res[DATES[1]][0].startswith('failed')
+    out = capsys.readouterr().out
+    assert 'Traceback' in out and '1 failed' in out
+
+def test_run_closes_the_server(runner, monkeypatch):
+    savepath, tasks = runner
+    res = br.run('M', dates=DATES[:2], workers=2, savepath=str(savepath))
+    server, = RecordingServer.instances
+    assert server.closed and server.names == list(br.SHARED_NAMES)
+    assert InlinePool.initargs[2] == br.registry_path(str(savepath.parent))
+    #共享内存已复制, 父进程不再持有面板
+    assert server.arrays == {}
+    assert len(res) == 2
+
+    #任务异常时也释放共享内存
+    def fail(dates, savepath):
+        raise RuntimeError('worker died')
+    monkeypatch.setattr(br, '_run_dates', fail)
+    with pytest.raises(RuntimeError):
+        br.run('M', dates=DATES[2:], workers=2, savepath=str(savepath))
+    assert RecordingServer.instances[-1].closed
+
+def test_single_worker_or_no_share_runs_without_server(runner):
+    savepath, tasks = runner
+    br.run('M', dates=DATES[:2], workers=1, savepath=str(savepath))
+    br.run('M', dates=DATES[2:], workers=2, savepath=str(savepath), share=False)
+    assert not RecordingServer.instances and InlinePool.initargs[2] is None
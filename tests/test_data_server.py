@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+DataServer publishing matrices into shared memory and attach_shared,
+in a single process.
+"""
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import data_server
+from multiprocessing import shared_memory
+from data_server import DataServer, attach_shared, registry_path
+from data_store import CsvStore, EncodedMatrix, MmapMatrix, migrate
+from test_data_store import _data, _frame
+
+@pytest.fixture
+def served(tmp_path):
+    path = str(tmp_path / 'daily_data')
+    os.makedirs(path)
+    names = pd.DataFrame([['银行', '电子', None], ['电子', '银行', '传媒']], 
+                         index=['000001.SZ', '000002.SZ'], columns=pd.bdate_range('2019-01-02', periods=3))
+    frames = {'foo': _frame(), 'industry_citic_d': names}
+    for name, df in frames.items():
+        CsvStore().write(df, path, name)
+    migrate(str(tmp_path), 'csv', 'npy', remove_src=True)
+    arrays = {'bar': (np.arange(12.).reshape(3, 4), pd.Index(list('abc')), pd.bdate_range('2019-01-02', periods=4), 7)}
+    server = DataServer(_data(tmp_path, 'npy'), ['foo', 'industry_citic_d'], arrays)
+    yield server, frames
+    server.close()
+    #释放本进程attach的句柄
+    for shm in data_server._attached.values():
+        shm.close()
+    data_server._attached.clear()
+
+def test_attach_gives_read_only_views_of_the_published_matrices(served):
+    server, frames = served
+    data = server.data
+    with server:
+        assert os.path.exists(registry_path(data.root)) and set(server.blocks) == {'foo', 'industry_citic_d', 'bar'}
+        shared = attach_shared(registry_path(data.root))
+        assert set(shared) == {'foo', 'industry_citic_d', 'bar'}
+
+        foo, version = shared['foo']
+        assert isinstance(foo, MmapMatrix) and version == data.catalog.get('foo')['version']
+        pd.testing.assert_frame_equal(foo.to_frame(), frames['foo'], check_freq=False, check_column_type=False)
+        assert not foo.values.flags.writeable
+        with pytest.raises(ValueError):
+            foo.values[0, 0] = 0
+
+        #编码矩阵共享整数编码与字符串表
+        industry, _ = shared['industry_citic_d']
+        assert isinstance(industry, EncodedMatrix) and not industry.codes.values.flags.writeable
+        res = industry.to_frame()
+        assert res.isna().equals(frames['industry_citic_d'].isna())
+        assert (res.fillna('') == frames['industry_citic_d'].fillna('')).all().all()
+
+        bar, version = shared['bar']
+        np.testing.assert_array_equal(bar.values, np.arange(12.).reshape(3, 4))
+        assert version == 7 and list(bar.index) == list('abc')
+
+        #worker的Data直接使用共享矩阵
+        worker = _data(data.root, 'npy', shared=True)
+        assert worker.foo is worker.shared_data['foo'][0]
+        assert isinstance(worker.industry_citic_d, EncodedMatrix)
+        shm_names = [shm.name for shm in server.blocks.values()]
+
+    #close删除注册表并unlink全部共享内存
+    assert not os.path.exists(registry_path(data.root)) and not server.blocks
+    assert attach_shared(registry_path(data.root)) == {}
+    for name in shm_names:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+
+def test_object_matrices_are_not_shared(served):
+    server, _ = served
+    server.arrays = {'obj': (np.array([['a']], dtype=object), pd.Index(['x']), pd.Index([0]), None)}
+    server.start()
+    assert 'obj' not in server.registry and 'obj' not in attach_shared(server.fpath)
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Storage layer: catalog, stores, string tables and the loaded-matrix cache.
+"""
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import factor_calculate as fc
+from data_store import CATALOG_FILE, Catalog, CsvStore
+
+def _frame(rows=6, cols=5, seed=0, start='2019-01-02'):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(rng.normal(size=(rows, cols)), index=[f'{i:06d}.SZ' for i in range(rows)],
+                        columns=pd.bdate_range(start, periods=cols))
+
+def _data(root, storage='csv', **kwargs):
+    class RootData(fc.Data):
+        pass
+    RootData.root = str(root)
+    return RootData(storage, **kwargs)
+
+def test_declared_only_entries_are_not_located(tmp_path):
+    fpath = str(tmp_path / CATALOG_FILE)
+    Catalog(fpath).declare('foo', 'float32')
+    catalog = Catalog(fpath)
+    assert catalog.names() == [] and catalog.names('daily_data') == []
+    assert catalog.get('foo') is None and 'foo' not in catalog and not len(catalog)
+    assert catalog.declared('foo') == 'float32'
+
+    #声明在前, 矩阵写入后照常查找并保留声明
+    df = _frame()
+    os.makedirs(tmp_path / 'daily_data')
+    CsvStore().write(df, str(tmp_path / 'daily_data'), 'foo')
+    data = _data(tmp_path)
+    assert data.catalog.names('daily_data') == ['foo']
+    assert data.get_info('foo')['path'] == 'daily_data'
+    assert data.catalog.declared('foo') == 'float32'
+    np.testing.assert_allclose(data.foo.values, df.values)
+    data.catalog.declare('bar', 'int8')
+    assert Catalog(fpath).names() == ['foo']
+
+def test_migrate_encodes_strings_again_and_extends_the_table(tmp_path):
+    from data_store import StringTable, migrate
+    path = str(tmp_path / 'daily_data')
+    os.makedirs(path)
+    names = pd.DataFrame([['银行', '电子', None], ['电子', '银行', '银行']], 
+                         index=['000001.SZ', '000002.SZ'], columns=pd.bdate_range('2019-01-02', periods=3))
+    CsvStore().write(names, path, 'industry_citic_d')
+    migrate(str(tmp_path), 'csv', 'npy')
+    categories = list(StringTable(path, 'industry_citic_d').categories)
+
+    #字符串表已存在时再次迁移(源数据新增了行业)
+    names.iloc[1, 2] = '传媒'
+    CsvStore().write(names, path, 'industry_citic_d')
+    migrate(str(tmp_path), 'csv', 'npy')
+    table = StringTable(path, 'industry_citic_d')
+    assert table.categories[:len(categories)] == categories and '传媒' in table.categories
+
+    dat = _data(tmp_path, 'npy').industry_citic_d
+    assert dat.codes.values.dtype.kind == 'i'
+    res = dat.to_frame()
+    assert res.isna().equals(names.isna())
+    assert (res.fillna('') == names.fillna('')).all().all()
+
+def _appends(n, seed=1):
+    #每次追加新日期并重取最后一日, 隔次倒序行, 第3次起新增股票
+    frames, start = [], pd.Timestamp('2019-01-08')
+    for k in range(n):
+        df = _frame(rows=6 + (k >= 2), cols=3, seed=seed+k, start=start - pd.offsets.BDay(1))
+        frames.append(df.iloc[::-1] if k % 2 else df)
+        start += pd.offsets.BDay(2)
+    return frames
+
+def _stores(tmp_path, *stores):
+    for store in stores:
+        path = str(tmp_path / store.fmt)
+        os.makedirs(path)
+        yield store, path
+
+def test_npy_append_and_compact_match_csv(tmp_path):
+    from data_store import NpyStore
+    base, appends = _frame(), _appends(5)
+    npy = NpyStore()
+    npy.compact_every = 4
+    (csv, cpath), (npy, npath) = _stores(tmp_path, CsvStore(), npy)
+    for store, path in ((csv, cpath), (npy, npath)):
+        store.write(base, path, 'foo')
+    for k, df in enumerate(appends, 1):
+        csv.append(df, cpath, 'foo')
+        npy.append(df, npath, 'foo')
+        expected = csv.read(cpath, 'foo')
+        deltas = NpyStore._delta_dirs(os.path.join(npath, 'foo'))
+        #第4次追加后合并回基础块
+        assert len(deltas) == (k if k < 4 else k - 4)
+        for res in (npy.read(npath, 'foo'), npy.read(npath, 'foo', mmap=True).to_frame()):
+            pd.testing.assert_frame_equal(res, expected, check_freq=False, check_index_type=False, 
+                                          check_column_type=False, rtol=1e-12)
+        index, columns = npy.axes(npath, 'foo')
+        assert index.equals(expected.index) and columns.equals(expected.columns)
+        assert npy.columns(npath, 'foo').equals(expected.columns)
+
+def test_mmap_matrix_indexing_matches_dataframe(tmp_path):
+    from data_store import NpyStore
+    (store, path), = _stores(tmp_path, NpyStore())
+    store.write(_frame(), path, 'foo')
+    for df in _appends(3):
+        store.append(df, path, 'foo')
+    matrix, df = store.read(path, 'foo', mmap=True), store.read(path, 'foo')
+    assert len(matrix.blocks) == 4 and matrix.shape == df.shape
+    stocks, dates = list(df.index), list(df.columns)
+    mask = pd.Series(np.arange(len(stocks)) % 2 == 0, index=stocks)
+    keys = [(slice(None), dates[2]), (stocks[1], slice(None)), (stocks[2], dates[4]),
+            (stocks[::2], dates[1:6]), (slice(stocks[1], stocks[4]), slice(dates[3], dates[7])),
+            (mask, [dates[0], dates[-1]]), (list(mask.values), slice(None))]
+    for rows, cols in keys:
+        res, expected = matrix.loc[rows, cols], df.loc[rows, cols]
+        if np.ndim(expected) == 0:
+            assert res == expected
+        elif isinstance(expected, pd.Series):
+            pd.testing.assert_series_equal(res, expected, check_freq=False)
+        else:
+            pd.testing.assert_frame_equal(res, expected, check_freq=False)
+    pd.testing.assert_frame_equal(matrix[dates[5:7]], df[dates[5:7]], check_freq=False)
+    np.testing.assert_array_equal(matrix.column(dates[-1]), df[dates[-1]].values)
+    #缺失的股票与reindex一致为nan
+    pd.testing.assert_frame_equal(matrix.loc[['999999.SZ', stocks[0]], dates[:2]], 
+                                  df.reindex(['999999.SZ', stocks[0]])[dates[:2]], check_freq=False)
+    with pytest.raises(AttributeError):
+        matrix.mean()
+
+@pytest.mark.parametrize('start, end', [
+        ('2019-01-25', '2019-02-05'),       #跨一个月份
+        ('2019-01-31', '2019-03-01'),       #首尾恰在月末/月初
+        ('2019-02-02', '2019-04-07'),       #首尾为非交易日, 跨三个月份
+        ('2019-02-11', '2019-02-15'),       #单个分区内
+        ('2018-06-01', '2018-12-31'),       #无分区
+        (None, '2019-02-01'), ('2019-03-29', None), (None, None)])
+def test_partitioned_read_window_across_partitions(tmp_path, start, end):
+    from data_store import PartitionedStore
+    (store, path), = _stores(tmp_path, PartitionedStore())
+    df = _frame(cols=70, start='2019-01-02')
+    store.write(df.iloc[:, :50], path, 'foo')
+    #追加跨月的日期, 含重取的日期与新增股票
+    store.append(_frame(rows=7, cols=25, seed=1, start=df.columns[45]), path, 'foo')
+    full = store.read(path, 'foo')
+    assert len(store._partitions(os.path.join(path, 'foo'))) == 4
+    stocks = list(full.index[::2]) + ['999999.SZ']
+    for stks in (None, stocks):
+        res = store.read_window(path, 'foo', stks, start, end)
+        expected = full.loc[:, start:end]
+        expected = expected if stks is None else expected.reindex(stks)
+        assert list(res.columns) == list(expected.columns)
+        pd.testing.assert_frame_equal(res, expected, check_freq=False, check_column_type=False)
+
+def test_data_cache_evicts_least_recently_used_within_budget():
+    from data_store import DataCache
+    frames = {name: _frame(rows=20, cols=10, seed=k) for k, name in enumerate('abcd')}
+    size = DataCache.sizeof(frames['a'])
+    cache = DataCache(budget=3*size, pinned=['a'])
+    for name in 'abc':
+        cache.put(name, frames[name])
+    assert cache.nbytes == 3*size and not cache.evictions
+    #b最近被读取, 逐出最久未用且未固定的c
+    assert cache.get('b') is frames['b']
+    cache.put('d', frames['d'])
+    assert 'c' not in cache and {'a', 'b', 'd'} == set(cache._items)
+    assert cache.stats() == {'hits': 1, 'misses': 0, 'evictions': 1, 'nbytes': 3*size,
+                             'budget': 3*size, 'items': 3}
+    assert cache.get('c') is None and cache.misses == 1
+
+    #固定的矩阵超出预算时也不逐出
+    cache.pin('e')
+    cache.put('e', pd.concat([frames['c']]*3))
+    assert set(cache._items) == {'a', 'e'} and cache.evictions == 3
+    assert cache.nbytes == size + DataCache.sizeof(cache.get('e')) > cache.budget
+    #同名重新放入时按新大小计
+    cache.put('e', frames['c'])
+    assert cache.nbytes == 2*size
+    #未固定的矩阵单独超出预算时不保留
+    cache.put('f', pd.concat([frames['c']]*4))
+    assert 'f' not in cache and cache.nbytes == 2*size
+
+def test_data_cache_does_not_count_mapped_blocks(tmp_path):
+    from data_store import DataCache, NpyStore
+    (store, path), = _stores(tmp_path, NpyStore())
+    store.write(_frame(rows=50, cols=50), path, 'foo')
+    cache = DataCache(budget=1)
+    cache.put('foo', store.read(path, 'foo', mmap=True))
+    assert cache.nbytes == 0 and 'foo' in cache
+
+def test_data_reloads_evicted_matrices(tmp_path):
+    os.makedirs(tmp_path / 'daily_data')
+    frames = {name: _frame(rows=20, cols=10, seed=k) for k, name in enumerate(['foo', 'bar'])}
+    for name, df in frames.items():
+        CsvStore().write(df, str(tmp_path / 'daily_data'), name)
+    data = _data(tmp_path, cache_budget=1)
+    data.cache.pin('bar')
+    for name in ['bar', 'foo', 'bar']:
+        np.testing.assert_allclose(getattr(data, name).values, frames[name].values)
+    #foo超出预算被逐出, 再读时重新载入
+    assert 'foo' not in data.cache and 'bar' in data.cache
+    assert data.get_dates('foo').equals(frames['foo'].columns)
+    pd.testing.assert_frame_equal(data.read_window('foo', ['000003.SZ'], frames['foo'].columns[2]),
+                                  frames['foo'].iloc[3:4, 2:], check_freq=False)
+
+def test_data_get_dates_when_evicted_after_the_check(tmp_path, monkeypatch):
+    from data_store import DataCache
+    os.makedirs(tmp_path / 'daily_data')
+    df = _frame()
+    CsvStore().write(df, str(tmp_path / 'daily_data'), 'foo')
+    data = _data(tmp_path)
+    data.foo
+    #其他线程在判断之后、读取之前逐出了foo
+    monkeypatch.setattr(DataCache, '__contains__', lambda self, name: True)
+    data.cache.pop('foo')
+    assert data.get_dates('foo').equals(df.columns)
+    np.testing.assert_allclose(data.read_window('foo', end=df.columns[1]).values, df.iloc[:, :2].values)
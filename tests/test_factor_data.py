@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Factor groups of FactorProcess against the row-by-row implementations
+they replaced, kept here verbatim (up to pandas API changes) as references.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import factor_calculate as fc
+from test_kernels import SENTINEL, _cal_func
+
+pytestmark = pytest.mark.filterwarnings('ignore::RuntimeWarning')
+
+PARAMS = (1, 3, 6, 12)
+
+def _mom_vol_frames(n_stocks=10, n_days=330, seed=0):
+    rng = np.random.default_rng(seed)
+    stocks = [f'{i:06d}.SZ' for i in range(n_stocks)]
+    dates = pd.bdate_range('2018-01-02', periods=n_days)
+    pct_chg = pd.DataFrame(rng.normal(0, 0.02, (n_stocks, n_days)), index=stocks, columns=dates)
+    turn = pd.DataFrame(rng.uniform(0.1, 5, (n_stocks, n_days)), index=stocks, columns=dates)
+    pct_chg.iloc[1, :-30] = np.nan                  #上市不足一个半月
+    turn.iloc[1, :-30] = np.nan
+    pct_chg.iloc[2, -50:-40] = np.nan               #停牌
+    pct_chg.iloc[3, -5], turn.iloc[3, -5] = 0.05, SENTINEL * 100   #乘积超过标记值
+    pct_chg.iloc[4, -70], turn.iloc[4, -70] = 0.01, np.inf
+    pct_chg.iloc[5, -3] = -np.inf
+
+    month_ends = pd.Series(dates, index=dates).groupby([dates.year, dates.month]).max().values
+    tdate = pd.Timestamp(month_ends[-1])
+    caldate = tdate + pd.offsets.MonthEnd(0)
+    month_map = pd.Series(pd.DatetimeIndex(month_ends) + pd.offsets.MonthEnd(0), index=month_ends)
+    frames = {'pct_chg': pct_chg, 'turn': turn, 'month_map': month_map, 'tradedays': list(dates)}
+    for offset in PARAMS:
+        frames[f'pctchg_{offset}M'] = pd.DataFrame(rng.normal(size=(n_stocks, 1)), index=stocks, 
+                                                   columns=[caldate])
+    return frames, tdate
+
+def _mom_vol_reference(z, stocks, qdate, dates, params=PARAMS):
+    #FactorProcess._get_mom_vol_data原实现
+    pct_chg = z.pct_chg
+    turnover = z.turn
+    caldate = z.month_map[qdate]
+    res = pd.DataFrame(index=stocks)
+    for offset in params:
+        period_d = z._get_period_d(qdate, offset=-offset, freq="M", datelist=dates)
+        cur_pct_chg_d = pct_chg.loc[stocks, period_d]
+        cur_pct_chg_m = getattr(z, f"pctchg_{offset}M", None)
+        cur_turnover = turnover.loc[cur_pct_chg_d.index, period_d]
+        days_wgt = cur_pct_chg_d.T.expanding().\
+                   apply(lambda df: np.exp(-(len(period_d) - len(df))/4/offset)).T
+        wgt_pct_chg = cur_pct_chg_d * cur_turnover
+        exp_wgt_pct_chg = wgt_pct_chg * days_wgt
+        res[f"return_{offset}m"] = cur_pct_chg_m.loc[stocks, caldate]
+        res[f"wgt_return_{offset}m"] = wgt_pct_chg.apply(_cal_func, axis=1, args=(np.nanmean,))
+        res[f"exp_wgt_return_{offset}m"] = exp_wgt_pct_chg.apply(_cal_func, axis=1, args=(np.nanmean,))
+        res[f"std_{offset}m"] = cur_pct_chg_d.apply(_cal_func, axis=1, args=(np.nanstd,))
+    return res
+
+def test_mom_vol_matches_row_by_row(memory_process):
+    frames, tdate = _mom_vol_frames()
+    z = memory_process(frames, tradedays_synced=True)
+    stocks = list(frames['pct_chg'].index)
+    res = z._get_mom_vol_data(stocks, tdate, z.dates_d)
+    ref = _mom_vol_reference(z, stocks, tdate, z.dates_d)
+    pd.testing.assert_frame_equal(res, ref.astype(float), rtol=1e-10, atol=1e-14)
+    #nan不计入, 含标记值或inf的股票为nan, -inf传播
+    assert res.loc[[stocks[1], stocks[2]], 'wgt_return_3m'].notna().all()
+    assert np.isnan(res.loc[stocks[3], 'wgt_return_1m']) and np.isnan(res.loc[stocks[4], 'wgt_return_6m'])
+    assert res.loc[stocks[5], 'wgt_return_1m'] == -np.inf
+    #不需要预处理换手率面板
+    assert '_turnover_preprocessed' not in z.__dict__
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+Parity of the kernels against the row-by-row implementations they
+replaced, kept here verbatim as references.
+"""
+from itertools import takewhile
+import numpy as np
+import pandas as pd
+import pytest
+from kernels import (MaskedPanel, cmra, dastd, exp_weights, growth_rate, last_per_period, 
+                     rolling_cmra, rolling_dastd, rstr, shifted_wls, wls)
+
+pytestmark = pytest.mark.filterwarnings('ignore::RuntimeWarning')
+
+SENTINEL = 1000
+
+#pandas 2.2起年末频率写作'YE'
+try:
+    pd.tseries.frequencies.to_offset('YE')
+    YEAR_END = 'YE'
+except ValueError:
+    YEAR_END = 'y'
+
+def _cal_func(df, func=np.nanmean, sentinel=1000):
+    #FactorProcess._cal_func原实现, 作为掩码归约的对照
+    val = list(takewhile(lambda x: x < sentinel or pd.isnull(x), df.values))
+    if len(val) == len(df):
+        return func(val, axis=0)
+    else:
+        return np.nan
+
+def _panel(seed, rows=40, cols=63):
+    rng = np.random.default_rng(seed)
+    values = rng.normal(0, 0.03, (rows, cols))
+    values[rng.random((rows, cols)) < 0.1] = np.nan
+    values[0] = np.nan                              #全部缺失
+    values[1, :20] = SENTINEL                       #未上市
+    values[2, -1] = SENTINEL
+    values[3, 5] = SENTINEL + 1
+    values[4, 7] = np.inf
+    values[5, 9] = -np.inf
+    values[6, 3], values[6, 4] = np.nan, SENTINEL   #nan之后的标记
+    values[7, :] = 0.01
+    return pd.DataFrame(values, index=[f'{i:06d}.SZ' for i in range(rows)])
+
+def _sentinel_panel(seed):
+    #换手率面板的预处理: 标记值记为无数据, inf不计入
+    df = _panel(seed).replace([np.inf, -np.inf], np.nan)
+    return df, MaskedPanel.from_frame(df, missing=df.values >= SENTINEL)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_masked_panel_mean_matches_cal_func(seed):
+    df, panel = _sentinel_panel(seed)
+    ref = df.apply(_cal_func, axis=1, args=(np.nanmean, SENTINEL))
+    res = panel.mean()
+    assert res.index.equals(df.index)
+    np.testing.assert_allclose(res.values, ref.values.astype(float), rtol=1e-12, atol=1e-15, equal_nan=True)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_masked_panel_std_matches_cal_func(seed):
+    df, panel = _sentinel_panel(seed)
+    ref = df.apply(_cal_func, axis=1, args=(np.nanstd, SENTINEL))
+    np.testing.assert_allclose(panel.std().values, ref.values.astype(float), 
+                               rtol=1e-12, atol=1e-15, equal_nan=True)
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('func', ['mean', 'std'])
+def test_from_sentinel_matches_cal_func_with_non_finite_values(seed, func):
+    #inf按标记值处理, -inf与nanmean/nanstd一样传播
+    df = _panel(seed)
+    ref = df.apply(_cal_func, axis=1, args=(getattr(np, 'nan'+func), SENTINEL))
+    res = getattr(MaskedPanel.from_sentinel(df, SENTINEL), func)()
+    np.testing.assert_allclose(res.values, ref.values.astype(float), rtol=1e-12, atol=1e-15, equal_nan=True)
+
+def test_masked_panel_reductions_on_arrays_and_empty_windows():
+    df, panel = _sentinel_panel(0)
+    np.testing.assert_allclose(MaskedPanel.from_frame(df.values, missing=df.values >= SENTINEL).mean().values, 
+                               panel.mean().values, equal_nan=True)
+    empty = MaskedPanel.from_frame(pd.DataFrame(index=df.index, columns=[], dtype=float))
+    assert empty.mean().isna().all()
+    assert empty.std().isna().all()
+
+def test_masked_panel_leaves_out_invalid_entries():
+    values = np.array([[1., 2., 3.], [1., np.nan, 5.], [np.nan, np.nan, np.nan]])
+    valid = np.array([[True, True, False], [True, True, True], [True, True, True]])
+    panel = MaskedPanel.from_frame(values, valid)
+    np.testing.assert_allclose(panel.mean().values, [1.5, 3., np.nan], equal_nan=True)
+    np.testing.assert_allclose(panel.std().values, [0.5, 2., np.nan], equal_nan=True)
+    missing = np.zeros(values.shape, dtype=bool)
+    missing[0, 2] = True
+    assert np.isnan(MaskedPanel.from_frame(values, missing=missing).mean().values[0])
+
+def _regress(X, y, intercept=True, weights=1):
+    #FactorProcess.regress原实现(statsmodels)
+    sm = pytest.importorskip('statsmodels.api')
+    if intercept:
+        X = sm.add_constant(X)
+    result = sm.WLS(y, X, weights=weights).fit()
+    params = result.params
+    return params[0], params[1:]
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('intercept', [True, False])
+def test_wls_matches_statsmodels(seed, intercept):
+    rng = np.random.default_rng(seed)
+    x = rng.normal(0, 0.02, 120)
+    Y = 0.001 + 1.2 * x[:, None] + rng.normal(0, 0.01, (120, 30))
+    weights = exp_weights(120, 60)
+    ref_const, ref_coef = _regress(x, Y, intercept, weights)
+    params = wls(x, Y, intercept, weights)
+    np.testing.assert_allclose(params[0], ref_const, rtol=1e-9, atol=1e-14)
+    np.testing.assert_allclose(params[1:], ref_coef, rtol=1e-9, atol=1e-14)
+    ref_const, ref_coef = _regress(x, Y[:, 0], intercept, weights)
+    params = wls(x, Y[:, 0], intercept, weights)
+    np.testing.assert_allclose(params, np.r_[ref_const, ref_coef], rtol=1e-9, atol=1e-14)
+
+@pytest.mark.filterwarnings('ignore:The design matrix is rank-deficient')
+@pytest.mark.parametrize('column', [np.zeros(50), np.full(50, 3.), np.r_[np.zeros(49), 1.]])
+def test_wls_constant_detection_matches_add_constant(column):
+    rng = np.random.default_rng(0)
+    X = np.column_stack([rng.normal(size=50), column])
+    y = X @ [0.5, 0.2] + rng.normal(0, 0.1, 50)
+    ref_const, ref_coef = _regress(X, y)
+    params = wls(X, y)
+    assert len(params) == 1 + len(ref_coef)
+    np.testing.assert_allclose(params, np.r_[ref_const, ref_coef], rtol=1e-9, atol=1e-12)
+
+def _regress_barra(pct_chgs, stocks, index_code, weights, shift, intercept=True):
+    #_get_regress_barra原实现的逐窗口回归
+    window = len(weights)
+    res = pd.DataFrame(index=stocks)
+    for i in range(1, shift+1):
+        pct_chg = pct_chgs.iloc[i:i+window, :]
+        ys = pct_chg.loc[:, stocks].dropna(how='any', axis=1)
+        X, Ys = pct_chg.loc[:, index_code].values, ys.values
+        alpha, coef = _regress(X, Ys, intercept, weights)
+        res[f'alpha_{i}'] = pd.Series(alpha, index=ys.columns)
+        res[f'beta_{i}'] = pd.Series(coef[0], index=ys.columns)
+        if i == shift:
+            resid = Ys - (alpha + X.reshape(-1, 1) @ coef)
+            res['HSIGMA_barra'] = pd.Series(np.std(resid, axis=0), index=ys.columns)
+    res['HALPHA_barra'] = np.sum([res[f'alpha_{i}'] for i in range(1, shift+1)], axis=0)
+    res['BETA_barra'] = np.sum([res[f'beta_{i}'] for i in range(1, shift+1)], axis=0)
+    return res[['BETA_barra', 'HALPHA_barra', 'HSIGMA_barra']]
+
+def test_shifted_wls_matches_window_regressions():
+    rng = np.random.default_rng(1)
+    shift, window = 4, 60
+    stocks = [f'{i:06d}.SZ' for i in range(25)]
+    bm = rng.normal(0, 0.015, window+shift)
+    values = 0.9 * bm[:, None] + rng.normal(0, 0.02, (window+shift, len(stocks)))
+    values[rng.random(values.shape) < 0.01] = np.nan
+    pct_chgs = pd.DataFrame(values, columns=stocks)
+    pct_chgs['000300.SH'] = bm
+    weights = exp_weights(window, 30)
+    ref = _regress_barra(pct_chgs, stocks, '000300.SH', weights, shift)
+    
+    const, slope, sigma = shifted_wls(bm, values, weights, shift)
+    np.testing.assert_allclose(slope.sum(axis=0), ref['BETA_barra'], rtol=1e-9, equal_nan=True)
+    np.testing.assert_allclose(const.sum(axis=0), ref['HALPHA_barra'], rtol=1e-9, atol=1e-14, equal_nan=True)
+    np.testing.assert_allclose(sigma[-1], ref['HSIGMA_barra'], rtol=1e-9, equal_nan=True)
+
+def _get_date_idx(date, datelist):
+    #FactorProcess._get_date_idx原实现
+    date = pd.to_datetime(date)
+    datelist = sorted(datelist)
+    try:
+        return datelist.index(date)
+    except ValueError:
+        dlist = sorted(datelist + [date])
+        idx = dlist.index(date)
+        if idx == len(dlist)-1:
+            raise IndexError(date)
+        return idx - 1
+
+def _cal_gr(series, lyr_rptdates, periods=5):
+    #FactorProcess.__cal_gr原实现
+    lyr_date = lyr_rptdates[series.name]
+    if pd.isna(lyr_date):
+        return np.nan
+    idx = _get_date_idx(lyr_date, list(series.index))
+    y = series.iloc[idx-periods+1:idx+1]
+    x = pd.Series(range(1, len(y)+1), index=y.index)
+    x_and_y = pd.concat([x, y], axis=1).dropna(how='any', axis=1)
+    try:
+        x, y = x_and_y.iloc[:, 0].values, x_and_y.iloc[:, 1].values
+        _, coef = _regress(x, y)
+        return coef[0] / np.mean(y)
+    except Exception:
+        return np.nan
+
+def test_growth_rate_matches_per_stock_regressions():
+    rng = np.random.default_rng(2)
+    stocks = [f'{i:06d}.SZ' for i in range(30)]
+    dates = pd.date_range('2006-03-31', '2018-12-31', freq=pd.offsets.QuarterEnd())
+    values = np.cumprod(1 + rng.normal(0.02, 0.1, (len(dates), len(stocks))), axis=0)
+    values[rng.random(values.shape) < 0.03] = np.nan
+    ori = pd.DataFrame(values, index=dates, columns=stocks)
+    rptdates = pd.Series(pd.to_datetime(rng.choice(['2017-12-31', '2018-09-30', '2015-06-30', 
+                                                    '2009-12-31', '2008-12-31', '2016-03-31'], 
+                                                   len(stocks))), index=stocks)
+    rptdates.iloc[:2] = pd.NaT
+    lyr = rptdates.where(rptdates.dt.month == 12, 
+                         pd.to_datetime((rptdates.dt.year - 1).astype('Int64').astype(str) + '-12-31', 
+                                        errors='coerce'))
+    
+    yearly = ori.groupby(pd.Grouper(freq=YEAR_END)).apply(lambda df: df.iloc[-1])
+    pd.testing.assert_frame_equal(last_per_period(ori, YEAR_END), yearly, check_freq=False)
+    ref = yearly.apply(_cal_gr, args=(lyr, 5))
+    res = growth_rate(last_per_period(ori, YEAR_END), lyr, 5)
+    np.testing.assert_allclose(res.values, ref.values.astype(float), rtol=1e-9, equal_nan=True)
+    assert res.notna().sum() > 10
+
+def _cal_cmra(series, months=12, days_per_month=21):
+    #FactorProcess._cal_cmra原实现
+    z = sorted(series[-i * days_per_month:].sum() for i in range(1, months+1))
+    return z[-1] - z[0]
+
+def _std_dev(series, weight=1):
+    #FactorProcess._std_dev原实现
+    mean = np.mean(series)
+    return np.sqrt(np.sum((series - mean)**2 * weight))
+
+def _returns(seed, rows=300, cols=20):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(rng.normal(0, 0.02, (rows, cols)), 
+                        columns=[f'{i:06d}.SZ' for i in range(cols)])
+
+@pytest.mark.parametrize('seed', range(3))
+def test_cmra_matches_cal_cmra(seed):
+    log_ret = np.log(1 + _returns(seed).iloc[-252:])
+    ref = log_ret.apply(_cal_cmra, args=(12, 21))
+    np.testing.assert_allclose(cmra(log_ret, 12, 21).values, ref.values, rtol=1e-10, atol=1e-15)
+    #窗口短于months*days_per_month时与原实现一样截断
+    short = log_ret.iloc[-100:]
+    np.testing.assert_allclose(cmra(short, 12, 21).values, short.apply(_cal_cmra, args=(12, 21)).values, 
+                               rtol=1e-10, atol=1e-15)
+
+def test_rolling_cmra_matches_cmra_per_window():
+    log_ret = np.log(1 + _returns(0))
+    log_ret.iloc[150, 3] = np.nan
+    res = rolling_cmra(log_ret, 6, 21)
+    window = 6 * 21
+    for end in (window-1, 150, 200, len(log_ret)-1):
+        block = log_ret.iloc[end-window+1:end+1]
+        ref = cmra(block, 6, 21).where(block.notna().all())
+        np.testing.assert_allclose(res.loc[end].values, ref.values, rtol=1e-10, atol=1e-14, equal_nan=True)
+    ends = [10, 200, len(log_ret)-1]
+    for row, end in zip(rolling_cmra(log_ret.fillna(0), 6, 21, ends=ends), ends):
+        ref = cmra(log_ret.fillna(0).iloc[max(end-window+1, 0):end+1], 6, 21)
+        np.testing.assert_allclose(row, ref.values, rtol=1e-10, atol=1e-14)
+
+@pytest.mark.parametrize('seed', range(3))
+def test_dastd_matches_std_dev(seed):
+    returns = _returns(seed).iloc[-252:]
+    weights = exp_weights(252, 42)
+    ref = returns.apply(_std_dev, args=(weights,))
+    np.testing.assert_allclose(dastd(returns, weights).values, ref.values, rtol=1e-10)
+
+def test_rolling_dastd_matches_dastd_per_window():
+    returns = _returns(1)
+    returns.iloc[100, 5] = np.nan
+    weights = exp_weights(60, 20)
+    res = rolling_dastd(returns, weights)
+    for end in (59, 100, 130, len(returns)-1):
+        block = returns.iloc[end-59:end+1]
+        ref = dastd(block, weights).where(block.notna().all())
+        np.testing.assert_allclose(res.loc[end].values, ref.values, rtol=1e-8, equal_nan=True)
+
+def _rstr_loop(pct_chgs, stocks, index_code, weights, shift):
+    #_get_rstr_barra原实现的逐窗口加权超额收益
+    window = len(weights)
+    rs = []
+    for i in range(1, shift+1):
+        pct_chg = pct_chgs.iloc[i:i+window, :]
+        excess_ret = np.log(1 + pct_chg[stocks]).sub(np.log(1 + pct_chg[index_code]), axis=0)
+        rs.append(excess_ret.mul(weights, axis=0).apply(np.nansum, axis=0))
+    return np.sum(rs, axis=0) / shift
+
+def test_rstr_matches_window_loop():
+    shift, window = 11, 252
+    pct_chgs = _returns(3, rows=window+shift, cols=15)
+    stocks = list(pct_chgs.columns)
+    pct_chgs.iloc[40:60, 2] = np.nan
+    pct_chgs['000300.SH'] = np.random.default_rng(4).normal(0, 0.01, window+shift)
+    weights = exp_weights(window, 126)
+    ref = _rstr_loop(pct_chgs, stocks, '000300.SH', weights, shift)
+    res = rstr(pct_chgs[stocks], pct_chgs['000300.SH'], weights, shift)
+    np.testing.assert_allclose(res.values, ref, rtol=1e-10)
+    log_ret = np.log(1 + pct_chgs)
+    res = rstr(log_ret[stocks], log_ret['000300.SH'], weights, shift, log_ret=True)
+    np.testing.assert_allclose(res.values, ref, rtol=1e-10)
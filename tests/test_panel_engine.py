@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+PanelFactorProcess panels against the per-date FactorProcess output.
+"""
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import factor_calculate as fc
+from panel_engine import PanelFactorProcess
+from tech_state import TechState
+from test_sharding import _frames
+
+pytestmark = pytest.mark.filterwarnings('ignore::RuntimeWarning')
+
+TECH = ['DIF', 'DEA', 'MACD', 'RSI', 'PSY', 'BIAS']
+
+def _panel_process(memory_process, frames, **attrs):
+    return memory_process(frames, cls=PanelFactorProcess, _daily={}, _panels={}, **attrs)
+
+def _dates(frames):
+    month_ends = list(frames['month_map'].index)
+    return month_ends[-4:] + [frames['pct_chg'].columns[-7]]
+
+def test_panels_match_per_date_output(memory_process):
+    frames, _ = _frames()
+    stocks = list(frames['meta'].index) + ['999999.SZ']
+    ref = memory_process(frames, tech_state_file=None)
+    z = _panel_process(memory_process, frames, seed_state_file=None).prepare(_dates(frames))
+    for date in _dates(frames):
+        #窗口计算的EMA截断于266日前, 与逐日递推相差约(1-2/27)**266
+        pd.testing.assert_frame_equal(z._get_tech_data(stocks, date), ref._get_tech_data(stocks, date)[TECH],
+                                      rtol=1e-6, atol=1e-6)
+        pd.testing.assert_frame_equal(z._get_cmra_barra(stocks, date, z.dates_d), 
+                                      ref._get_cmra_barra(stocks, date, ref.dates_d), rtol=1e-10)
+        #_cal_liquidity逐列返回0维数组, 原实现的列为object
+        pd.testing.assert_frame_equal(z._get_liquidity_barra(stocks, date), 
+                                      ref._get_liquidity_barra(stocks, date).astype(float), rtol=1e-10)
+    assert set(z._panels['tech']) == set(_dates(frames))
+
+def test_tech_panel_starts_from_the_saved_state(memory_process, monkeypatch):
+    frames, _ = _frames()
+    close = frames['hfq_close']
+    dates = _dates(frames)
+    first = min(close.columns.get_indexer(dates))
+    #保存的状态截至首个日期前10日
+    state = TechState.build(close.T.iloc[first-300:first-10], fc.Data._tech_params)
+    z = _panel_process(memory_process, frames)
+    state.save(os.path.join(z.data.root, z.data.cache_dir, z.seed_state_file))
+
+    steps = []
+    step = TechState.step
+    monkeypatch.setattr(TechState, 'step', lambda self, *args: steps.append(args[0]) or step(self, *args))
+    z.prepare(dates)
+    assert steps[0] == close.columns[first-10]
+    assert len(steps) == max(close.columns.get_indexer(dates)) - first + 11
+
+    ref = _panel_process(memory_process, frames, seed_state_file=None).prepare(dates)
+    for date in dates:
+        pd.testing.assert_frame_equal(z._get_tech_data(list(close.index), date), 
+                                      ref._get_tech_data(list(close.index), date), rtol=1e-6, atol=1e-6)
+
+def test_tech_panel_ignores_a_saved_state_after_the_first_date(memory_process):
+    frames, _ = _frames()
+    close = frames['hfq_close']
+    dates = _dates(frames)
+    z = _panel_process(memory_process, frames)
+    TechState.build(close.T, fc.Data._tech_params).save(os.path.join(z.data.root, z.data.cache_dir, 
+                                                                     z.seed_state_file))
+    first = min(close.columns.get_indexer(dates))
+    state, start = z._tech_seed(close.T, first)
+    assert state.last_date is None and start == first - max(z._tech_params['MACD']) - 239
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Sharded get_factor_data against the whole-universe run, on a Data whose
+matrices are held in memory.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import factor_calculate as fc
+
+pytestmark = pytest.mark.filterwarnings('ignore::RuntimeWarning')
+
+INDEX_CODE = '000300.SH'
+FACTORS = ['LNCAP_barra', 'MIDCAP_barra', 'BETA_barra', 'HSIGMA_barra', 'HALPHA_barra',
+           'DASTD_barra', 'CMRA_barra', 'STOM_barra', 'STOQ_barra', 'STOA_barra', 'RSTR_barra',
+           'MACD', 'DEA', 'DIF', 'RSI', 'PSY', 'BIAS']
+
+def _frames(n_stocks=13, n_days=620, seed=0):
+    rng = np.random.default_rng(seed)
+    stocks = [f'{i:06d}.SZ' for i in range(n_stocks)]
+    codes = stocks + [INDEX_CODE]
+    dates = pd.bdate_range('2016-01-04', periods=n_days)
+    pct_chg = pd.DataFrame(rng.normal(0, 0.02, (len(codes), n_days)), index=codes, columns=dates)
+    pct_chg.iloc[3, :400] = np.nan                  #上市晚于窗口起点
+    hfq_close = 10 * np.exp(pct_chg.fillna(0).cumsum(axis=1))
+    amt = pd.DataFrame(rng.uniform(1e6, 1e8, (n_stocks, n_days)), index=stocks, columns=dates)
+    cap_d = pd.DataFrame(rng.uniform(1e9, 1e11, (n_stocks, n_days)), index=stocks, columns=dates)
+
+    #月末交易日 -> 自然月末
+    month_ends = pd.Series(dates, index=dates).groupby([dates.year, dates.month]).max().values
+    month_map = pd.Series(pd.DatetimeIndex(month_ends) + pd.offsets.MonthEnd(0), index=month_ends)
+    cap_m = pd.DataFrame(cap_d[month_ends].values, index=stocks, columns=month_map.values)
+
+    meta = pd.DataFrame({'ipo_date': pd.Timestamp('2010-01-04'), 'delist_date': pd.NaT}, index=stocks)
+    meta.loc[stocks[5], 'ipo_date'] = dates[-1] + pd.offsets.Day(1)      #未上市
+    meta.loc[stocks[8], 'delist_date'] = dates[100]                      #已退市
+    return {'pct_chg': pct_chg, 'hfq_close': hfq_close, 'amt': amt, 'mkt_cap_float_d': cap_d,
+            'mkt_cap_float': cap_m, 'month_map': month_map, 'meta': meta}, month_ends[-1]
+
+@pytest.mark.parametrize('shard_size', [1, 4, 6])
+def test_sharded_factor_data_matches_whole_universe(memory_process, shard_size):
+    frames, tdate = _frames()
+    stocks = list(frames['meta'].index)
+    ref = memory_process(frames).get_factor_data(tdate, stocks, FACTORS)
+    sharded = memory_process(frames, shard_size=shard_size)
+    res = sharded.get_factor_data(tdate, stocks, FACTORS)
+
+    assert list(res.columns) == FACTORS
+    assert res.index.equals(ref.index)
+    pd.testing.assert_frame_equal(res, ref)
+    #流动性因子只含上市股票, 规模因子按全市场截面计算
+    assert res.loc[[stocks[5], stocks[8]], 'STOM_barra'].isna().all()
+    assert res['STOM_barra'].notna().sum() == len(stocks) - 2
+    assert res['MIDCAP_barra'].notna().all()
+    assert list(sharded.group_timings)[0] == 'tech'
+    assert sharded._shard_day is None and sharded._shard is None
+
+def test_sharded_run_computes_the_day_once(memory_process, monkeypatch):
+    frames, tdate = _frames()
+    stocks = list(frames['meta'].index)
+    z = memory_process(frames, shard_size=4)
+    calls = []
+    get_stock_list = z._get_stock_list
+    monkeypatch.setattr(z, '_get_stock_list', lambda t: calls.append(t) or get_stock_list(t))
+    z.get_factor_data(tdate, stocks, ['STOM_barra', 'RSI'])
+    assert calls == [tdate]
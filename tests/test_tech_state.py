@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental TechState against the window cal_* computations, and the 
+state file under concurrent writers.
+"""
+import os
+import threading
+import multiprocessing
+import numpy as np
+import pandas as pd
+import pytest
+import factor_calculate as fc
+from tech_state import TechState, file_lock
+
+pytestmark = pytest.mark.filterwarnings('ignore::RuntimeWarning')
+
+COLUMNS = ['DIF', 'DEA', 'MACD', 'RSI', 'PSY', 'BIAS']
+
+def _closes(n_stocks=12, n_days=420, seed=0):
+    rng = np.random.default_rng(seed)
+    stocks = [f'{i:06d}.SZ' for i in range(n_stocks)]
+    dates = pd.bdate_range('2017-01-02', periods=n_days)
+    close = pd.DataFrame(10 * np.exp(rng.normal(0, 0.02, (n_stocks, n_days)).cumsum(axis=1)),
+                         index=stocks, columns=dates)
+    close.iloc[1, :330] = np.nan                    #窗口内上市
+    close.iloc[2, :380] = np.nan                    #增量更新期间上市
+    close.iloc[3, 340:352] = np.nan                 #停牌
+    close.iloc[4, rng.random(n_days) < 0.05] = np.nan
+    close.iloc[5, 390:] = np.nan                    #长期停牌至今
+    return close
+
+def test_incremental_state_matches_window_computation(tmp_path, memory_process):
+    close = _closes()
+    stocks = list(close.index) + ['999999.SZ']     #不在hfq_close中的股票
+    window = memory_process({'hfq_close': close}, tech_state_file=None)
+    state = memory_process({'hfq_close': close}, tech_state_file='tech_state.pkl')
+    fpath = os.path.join(str(tmp_path), fc.Data.cache_dir, 'tech_state.pkl')
+    for date in close.columns[300:]:
+        if date == close.columns[360]:
+            #新股进入hfq_close
+            late = close.copy()
+            late.loc['000100.SZ'] = np.where(close.columns < close.columns[355], np.nan, 12.)
+            for z in (window, state):
+                z.data.cache.put('hfq_close', late)
+        res = state._get_tech_data(stocks, date)
+        ref = window._get_tech_data(stocks, date)[COLUMNS]
+        #窗口计算的EMA截断于266日前, 与增量状态相差约(1-2/27)**266
+        pd.testing.assert_frame_equal(res[COLUMNS], ref, rtol=1e-6, atol=1e-6)
+    assert TechState.load(fpath, fc.Data._tech_params).last_date == close.columns[-1]
+
+def _bump(fpath, params, times):
+    for _ in range(times):
+        with file_lock(fpath):
+            state = TechState.load(fpath, params)
+            state.up += 1
+            state.save(fpath)
+
+def test_state_file_survives_concurrent_writers(tmp_path):
+    params = fc.Data._tech_params
+    fpath = str(tmp_path / 'state' / 'tech_state.pkl')
+    TechState(['000001.SZ'], params).save(fpath)
+    ctx = multiprocessing.get_context('fork')
+    workers = [ctx.Process(target=_bump, args=(fpath, params, 20)) for _ in range(3)] + \
+              [threading.Thread(target=_bump, args=(fpath, params, 20)) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert all(worker.exitcode == 0 for worker in workers if hasattr(worker, 'exitcode'))
+    assert TechState.load(fpath, params).up[0] == 120
+    assert sorted(os.listdir(tmp_path / 'state')) == ['tech_state.pkl', 'tech_state.pkl.lock']
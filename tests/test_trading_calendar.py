@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+"""
+TradingCalendar lookups and the calendar cache.
+"""
+import pandas as pd
+from trading_calendar import TradingCalendar
+
+def test_cache_is_keyed_on_contents():
+    first = [pd.Timestamp('2019-01-02'), pd.Timestamp('2019-01-03'), pd.Timestamp('2019-01-06')]
+    other = [pd.Timestamp('2019-01-02'), pd.Timestamp('2019-01-04'), pd.Timestamp('2019-01-06')]
+    cal, cal2 = TradingCalendar.of(first), TradingCalendar.of(other)
+    #长度与首尾日期相同的不同列表不共用日历
+    assert cal is not cal2
+    assert list(cal2) == other
+    assert cal2.locate('2019-01-04') == 1 and cal.locate('2019-01-04') == 1
+    assert '2019-01-03' in cal and '2019-01-03' not in cal2
+    #内容相同的新列表共用日历
+    assert TradingCalendar.of(list(first)) is cal
+    assert TradingCalendar.of(pd.DatetimeIndex(other)) is cal2
+
+def test_locate_between_trade_days():
+    cal = TradingCalendar.of(pd.bdate_range('2019-01-01', periods=10))
+    assert cal.locate('2019-01-05') == cal.locate('2019-01-04')
+    assert cal.prev('2019-01-07') == pd.Timestamp('2019-01-04')
+    assert cal.next('2019-01-04') == pd.Timestamp('2019-01-07')
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Trading calendar backed by a sorted datetime64 array, all lookups are
+searchsorted instead of scanning and re-sorting python lists.
+"""
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+MSG = """Date {} not in current tradedays list. If this date value is certainly a tradeday,
+              please reset tradedays list with longer periods or higher frequency."""
+
+class TradingCalendar:
+    """
+        Built once from a date list (tradedays, the columns of a matrix...)
+        and optionally month_map (trade month end -> calendar month end).
+        locate() keeps the semantics of FactorProcess._get_date_idx: the
+        position of date if it is a trade day, otherwise the position of the
+        last trade day before it; IndexError past the last trade day or,
+        with ensurein, whenever date is not a trade day.
+    """
+    _instances = OrderedDict()
+    _max_instances = 32
+    _lock = threading.Lock()
+
+    def __init__(self, dates, month_map=None):
+        self.source = dates
+        index = pd.DatetimeIndex(dates)
+        if not index.is_monotonic_increasing:
+            index = index.sort_values()
+        self.index = index
+        self.dates = index.values
+        self.month_map = month_map
+        self._trade_to_cal = self._cal_to_trade = None
+        self._resampled = {}
+
+    @classmethod
+    def of(cls, dates):
+        """
+            Calendar of a date list, cached (LRU) on its full contents. 
+            Equal lists built anew on every call, like the columns of a 
+            matrix, share one calendar.
+        """
+        if isinstance(dates, cls):
+            return dates
+        values = cls._values(dates)
+        key = hash(values.tobytes())
+        with cls._lock:
+            hit = cls._instances.get(key)
+            #哈希相同时再比较全部日期
+            if hit is not None and np.array_equal(hit[0], values):
+                cls._instances.move_to_end(key)
+                return hit[1]
+        cal = cls(dates)
+        with cls._lock:
+            cls._instances[key] = (values, cal)
+            cls._instances.move_to_end(key)
+            while len(cls._instances) > cls._max_instances:
+                cls._instances.popitem(last=False)
+        return cal
+
+    @staticmethod
+    def _values(dates):
+        if isinstance(dates, pd.DatetimeIndex):
+            return dates.values.astype('datetime64[ns]')
+        return np.asarray(pd.DatetimeIndex(dates).values, dtype='datetime64[ns]')
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __getitem__(self, key):
+        return self.index[key]
+
+    def __contains__(self, date):
+        pos = self._search(date)
+        return pos < len(self.dates) and self.dates[pos] == self._to_datetime64(date)
+
+    def _to_datetime64(self, date):
+        return np.datetime64(pd.Timestamp(date)).astype(self.dates.dtype)
+
+    def _search(self, date, side='left'):
+        return int(np.searchsorted(self.dates, self._to_datetime64(date), side=side))
+
+    def locate(self, date, ensurein=False):
+        pos = self._search(date)
+        if pos < len(self.dates) and self.dates[pos] == self._to_datetime64(date):
+            return pos
+        if ensurein or pos == len(self.dates):
+            raise IndexError(MSG.format(str(date)[:10]))
+        return pos - 1
+
+    def prev(self, date, n=1):
+        """n-th trade day strictly before date."""
+        pos = self._search(date) - n
+        if pos < 0:
+            raise IndexError(MSG.format(str(date)[:10]))
+        return self.index[pos]
+
+    def next(self, date, n=1):
+        """n-th trade day strictly after date."""
+        pos = self._search(date, side='right') + n - 1
+        if pos >= len(self.dates):
+            raise IndexError(MSG.format(str(date)[:10]))
+        return self.index[pos]
+
+    def between(self, start=None, end=None):
+        spos = 0 if start is None else self._search(start)
+        epos = len(self.dates) if end is None else self._search(end, side='right')
+        return self.index[spos:epos]
+
+    @staticmethod
+    def _month_bounds(date, months=0):
+        date = pd.Timestamp(date)
+        year, month = divmod(date.year * 12 + date.month - 1 + months, 12)
+        start = pd.Timestamp(year, month + 1, 1)
+        year, month = divmod(year * 12 + month + 1, 12)
+        return start, pd.Timestamp(year, month + 1, 1)
+
+    def month_start(self, date, months=0):
+        """First trade day of the month of date (shifted by months)."""
+        start, end = self._month_bounds(date, months)
+        pos = self._search(start)
+        if pos == len(self.dates) or self.dates[pos] >= self._to_datetime64(end):
+            raise IndexError(MSG.format(str(start)[:7]))
+        return self.index[pos]
+
+    def month_end(self, date, months=0):
+        """Last trade day of the month of date (shifted by months)."""
+        start, end = self._month_bounds(date, months)
+        pos = self._search(end) - 1
+        if pos < 0 or self.dates[pos] < self._to_datetime64(start):
+            raise IndexError(MSG.format(str(start)[:7]))
+        return self.index[pos]
+
+    def next_month_first(self, date):
+        return self.month_start(date, months=1)
+
+    @property
+    def trade_to_cal(self):
+        if self._trade_to_cal is None:
+            self._trade_to_cal = {} if self.month_map is None else self.month_map.to_dict()
+        return self._trade_to_cal
+
+    @property
+    def cal_to_trade(self):
+        if self._cal_to_trade is None:
+            self._cal_to_trade = {cday: tday for tday, cday in self.trade_to_cal.items()}
+        return self._cal_to_trade
+
+    def resampled(self, freq):
+        """
+            Trade days closing each period of freq ('M', 'Q'...), mapped from
+            the calendar period ends through month_map; memoized per freq.
+        """
+        if freq not in self._resampled:
+            cdays = pd.Series(index=self.index).resample(freq).asfreq().index
+            c_to_t_dict = self.cal_to_trade
+            try:
+                tdays = [c_to_t_dict[cday] for cday in cdays]
+            except KeyError:
+                tdays = [c_to_t_dict[cday] for cday in cdays[:-1]]
+            self._resampled[freq] = tdays
+        return self._resampled[freq]
+
+    def to_calendar(self, tdate):
+        return self.trade_to_cal.get(tdate, tdate)
+
+    def to_trade(self, cdate):
+        return self.cal_to_trade.get(cdate, cdate)
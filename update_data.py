@@ -14,6 +14,7 @@ import pandas.tseries.offsets as toffsets
 from WindPy import w
 from functools import wraps
 from factor_calculate import FactorProcess, WindQueryFailError
+from data_store import EncodedMatrix
 
 START_YEAR = 2006
 
@@ -39,10 +40,17 @@ def backup_decorator(dirname=None):
 
 class UpdateOriginData(FactorProcess): 
     backup_path = os.path.join(os.path.dirname(FPATH), 'wind_factor_backup')
+    append_only = True
     
     def __init__(self, *args, **kwargs):
         kwargs['update_only'] = True
         super().__init__(*args, **kwargs)
+    
+    def _save_new_data(self, new_data, qname):
+        if self.append_only:
+            self.append_file(new_data, qname)
+        else:
+            self.close_file(new_data, qname)
 
     def get_listday_matrix(self):
         all_stocks_info = self.meta
@@ -227,21 +235,23 @@ class UpdateOriginData(FactorProcess):
         self.close_file(new_meta, 'meta')
         print("Update meta data complete.")
     
-    def _update_new_data(self, ori_data, tdays, stockslist, qname, freq):
+    def _update_new_data(self, ori_data, tdays, stockslist, qname, freq, ori_cols=None):
         qname = "_".join(qname.split('_')[:-1]) if qname.endswith('_d') else qname
         wsscond = self.ind_wsscond[qname]
         wsdcond = self.ind_wsdcond[qname]
-        t_to_c_dict = {tday:cday for tday, cday in self.month_map.to_dict().items()}
+        t_to_c_dict = self.calendar.trade_to_cal
 
         if qname in ('close', 'pct_chg'):
             stockslist.extend(['000001.SH', '000300.SH', '000905.SH'])
         if ori_data is None:
             ori_data = pd.DataFrame(index=stockslist)
+        if ori_cols is None:
+            ori_cols = ori_data.columns
             
         new_cols = []
         for date in tdays[::-1]:
-            if date in ori_data.columns or ((date in self.month_map.index) and \
-                                (self.month_map[date] in ori_data.columns)):
+            if date in ori_cols or ((date in self.month_map.index) and \
+                                (self.month_map[date] in ori_cols)):
                 continue
             qdate = "".join(str(date)[:10].split("-"))
             try:
@@ -267,12 +277,23 @@ class UpdateOriginData(FactorProcess):
         return new_cols, ori_data
 
     def update_ori_data(self, fname, freq, stockslist=None, new_date=None,
-                        start_date=None, end_date=None, include_today=False):
+                        start_date=None, end_date=None, include_today=False, append=False):
+        """
+            With append=True only the fetched date columns are returned (and 
+            the last two stored dates re-fetched when update_past), to be 
+            written through append_file instead of rewriting the history.
+        """
         try:
 #            self = z; fname = qname; freq='M'
             
-            ori_data = getattr(self, fname, None)
-            ori_periods = ori_data.columns.sort_values()
+            if append:
+                ori_data = None
+                ori_periods = self.data.get_dates(fname).sort_values()
+            else:
+                ori_data = getattr(self, fname, None)
+                if isinstance(ori_data, EncodedMatrix):
+                    ori_data = ori_data.to_frame()
+                ori_periods = ori_data.columns.sort_values()
             ori_sdate, ori_edate = ori_periods[0], ori_periods[-1]
         except:
             raise Exception(f'{fname} not found or specific error encountered while parsing data structure.')
@@ -302,10 +323,13 @@ class UpdateOriginData(FactorProcess):
             
             if update_past:
                 sec_lst_date = ori_periods[-2]
-                del ori_data[lst_date]
-                del ori_data[sec_lst_date]
+                if append:
+                    ori_periods = ori_periods.drop([lst_date, sec_lst_date])
+                else:
+                    del ori_data[lst_date]
+                    del ori_data[sec_lst_date]
                 
-            lst_date = ori_data.columns[-1]
+            lst_date = ori_periods[-1] if append else ori_data.columns[-1]
             tdays = self._get_trade_days(lst_date, new_date, freq=freq)
             
             if stockslist is None:
@@ -325,6 +349,8 @@ class UpdateOriginData(FactorProcess):
             
         qname = 'pct_chg' if fname.startswith("pct_chg") else fname.split(".")[0]
         if tdays:
+            if append:
+                return self._update_new_data(None, tdays, stockslist, qname, freq, ori_periods)
             return self._update_new_data(ori_data, tdays, stockslist, qname, freq)
         else:
             return None, None
@@ -430,7 +456,8 @@ class UpdateOriginData(FactorProcess):
 
         for qname in inds_to_update:
             new_cols, new_data = self.update_ori_data(qname, 'd', stockslist, date,
-                                                      start_date, end_date, include_today)
+                                                      start_date, end_date, include_today,
+                                                      append=self.append_only)
             if new_cols:
                 new_date = sorted(new_cols)[-1]
                 if qname == 'trade_status':
@@ -438,7 +465,7 @@ class UpdateOriginData(FactorProcess):
                                             applymap(lambda x: 0 if x != '交易' else 1)
                 elif qname == 'pct_chg' or qname == 'turn':
                     new_data.loc[:, new_cols] = new_data.loc[:, new_cols] / 100
-                self.close_file(new_data, qname)
+                self._save_new_data(new_data, qname)
                 print("\"{}\" data updated to date {}.".format(qname, str(new_date)[:10]))
             else:
                 print(f"\"{qname}\"'s data don't need to be updated.")
@@ -476,9 +503,12 @@ class UpdateOriginData(FactorProcess):
                 lstdate = toffsets.datetime(date.year-1, date.month, date.day)
                 lstdate = self._get_date(lstdate, 0, datelist)
                 yoy[date] = self.profit_ttm_d[date] / self.profit_ttm_d[lstdate] - 1
-            profit_ttm_G_d = pd.concat([profit_ttm_G_d, yoy], axis=1)
-            profit_ttm_G_d = profit_ttm_G_d[profit_ttm_G_d.columns.sort_values()]
-            self.close_file(profit_ttm_G_d, 'profit_ttm_G_d')
+            if self.append_only:
+                self.append_file(yoy, 'profit_ttm_G_d')
+            else:
+                profit_ttm_G_d = pd.concat([profit_ttm_G_d, yoy], axis=1)
+                profit_ttm_G_d = profit_ttm_G_d[profit_ttm_G_d.columns.sort_values()]
+                self.close_file(profit_ttm_G_d, 'profit_ttm_G_d')
             print("'profit_ttm_G_d' updated.")
 
             for offset in [1,3,6,12]:   
@@ -502,9 +532,12 @@ class UpdateOriginData(FactorProcess):
                     lstdate = self._get_date(lstdate, 0, datelist)
                     res[date] = hfq_close[date] / hfq_close[lstdate] - 1
                 
-                pctchg_d = pd.concat([pctchg_d, res], axis=1)
-                pctchg_d = pctchg_d[pctchg_d.columns.sort_values()]
-                self.close_file(pctchg_d, f'pctchg_{offset}M_d')
+                if self.append_only:
+                    self.append_file(res, f'pctchg_{offset}M_d')
+                else:
+                    pctchg_d = pd.concat([pctchg_d, res], axis=1)
+                    pctchg_d = pctchg_d[pctchg_d.columns.sort_values()]
+                    self.close_file(pctchg_d, f'pctchg_{offset}M_d')
                 print(f"'pctchg_{offset}M_d' updated.")
         
     @backup_decorator(dirname='monthly_data')
@@ -522,13 +555,20 @@ class UpdateOriginData(FactorProcess):
         ndate = curdate - toffsets.MonthEnd(n=1)
         for qname in inds_to_update:
             new_cols, new_data = self.update_ori_data(qname, 'M', stockslist, date,
-                                                      start_date, end_date)
+                                                      start_date, end_date, 
+                                                      append=self.append_only)
             if new_cols:
-                if len(new_cols) == 1:
+                if len(new_cols) == 1 and self.append_only:
+                    ori_periods = self.data.get_dates(qname)
+                    new_col = new_data.columns[-1]
+                    lst_col = ori_periods[ori_periods < new_col].max()
+                    lst_data = self.data.read_window(qname, new_data.index, lst_col, lst_col)
+                    new_data[new_col] = new_data[new_col].fillna(lst_data.iloc[:, 0])
+                elif len(new_cols) == 1:
                     fill_cols = new_data.columns[-2:]        
                     new_data.loc[:, fill_cols] = new_data.loc[:, fill_cols].\
                                                  fillna(axis=1, method='ffill')
-                self.close_file(new_data, qname)
+                self._save_new_data(new_data, qname)
                 print("\"{}\" data updated to date {}.".format(qname, str(ndate)[:10]))
             else:
                 print(f"\"{qname}\"'s data don't need to be updated.")
@@ -556,14 +596,15 @@ class UpdateOriginData(FactorProcess):
         print("'holder_avgpct' updated.")
                 
     def _align_month_end_to_calendar(self):
-        for f in os.listdir(MPATH)[:]:   
-            if 'mrq' in f or 'pctchg' in f:
+        for fname in sorted(self.data.catalog.names('monthly_data')):   
+            if 'mrq' in fname or 'pctchg' in fname:
                 continue
-            fname = f.split('.')[0]
             if fname in ('industry2',):
                 continue
             
             tmp = getattr(self, fname, None)
+            if isinstance(tmp, EncodedMatrix):
+                tmp = tmp.to_frame()
             lst4dates = [pd.to_datetime(d) for d in self.month_map.values[-4:]]
             
             dat_lst_date, dat_4thlst_date = str(tmp.columns[-1])[:7], str(tmp.columns[-4])[:7]
@@ -590,17 +631,18 @@ class UpdateOriginData(FactorProcess):
         
         for qname in inds_to_update:
             new_cols, new_data = self.update_ori_data(qname, 'q', stockslist, 
-                                                      date, start_date, end_date)
+                                                      date, start_date, end_date,
+                                                      append=self.append_only)
             if new_cols:
-                self.close_file(new_data, qname)
+                self._save_new_data(new_data, qname)
                 print("\"{}\" data updated to date {}.".format(qname, str(ndate)[:10]))
             else:
                 print(f"\"{qname}\"'s data don't need to be updated.")
     
     def qdata_to_mdata(self, update_past=False):
         self.update_real_rptdate('M')
-        inds_to_transfer = [f.split(".")[0] for f in os.listdir(QPATH) \
-                            if not f.startswith("stm") and not 'mrq' in f and '~' not in f] 
+        inds_to_transfer = sorted(f for f in self.data.catalog.names('quarterly_data') \
+                                  if not f.startswith("stm") and not 'mrq' in f and '~' not in f)
         cur_caldates = self.month_map.tolist()
         val_date = self.applied_rpt_date_M
         